@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the fused single-pass histogramming of :mod:`xrt.multipro` with the
+separate ``numpy.histogram`` / ``numpy.histogram2d`` calls in terms of the
+results and the execution time, for 1e5 to 1e7 rays. The deferred coloring
+(hue moments converted to RGB per bin) is compared with the coloring of
+individual rays.
+"""
+__author__ = "Konstantin Klementiev, Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os
+import sys
+import time
+import numpy as np
+import matplotlib as mpl
+sys.path.append(os.path.join('..'))  # analysis:ignore
+import xrt.multipro as mp
+
+
+mp_saturation = 0.85
+
+
+class Axis(object):
+    def __init__(self, limits, bins, density='histogram'):
+        self.limits = limits
+        self.bins = bins
+        self.density = density
+
+
+class Plot(object):
+    def __init__(self, fluxKind='total', bins=256):
+        self.xaxis = Axis([-1.5, 1.5], bins)
+        self.yaxis = Axis([-1.5, 1.5], bins)
+        self.caxis = Axis([8990., 9010.], bins)
+        self.fluxKind = fluxKind
+        self.ePos = 1
+
+
+class Card(object):
+    backend = 'raycing'
+    iteration = 0
+
+
+def make_rays(nrays, fluxKind):
+    x = np.random.normal(0, 0.5, nrays)
+    y = np.random.normal(0, 0.5, nrays)
+    c = np.random.normal(9000, 4, nrays)
+    if fluxKind.startswith('E'):
+        intensity = np.random.normal(size=nrays) + \
+            1j*np.random.normal(size=nrays)
+        flux = intensity.real**2 + intensity.imag**2
+    else:
+        intensity = flux = np.random.uniform(size=nrays)
+    cDataRGB = np.random.uniform(size=(nrays, 3))
+    return x, y, c, intensity, flux, cDataRGB
+
+
+def separate_hists(worker, plot, x, y, c, intensity, flux, cDataRGB):
+    xh, xhRGB, xbe = worker.do_hist1d(x, flux, cDataRGB, plot.xaxis)
+    yh, yhRGB, ybe = worker.do_hist1d(y, flux, cDataRGB, plot.yaxis)
+    eh, ehRGB, ebe = worker.do_hist1d(c, flux, cDataRGB, plot.caxis)
+    xyh, xyhRGB, xyh4 = worker.do_hist2d(x, y, intensity, cDataRGB, plot)
+    return xh, xhRGB, xbe, yh, yhRGB, ybe, eh, ehRGB, ebe, xyh, xyhRGB, xyh4
+
+
+def main(fluxKind='total'):
+    np.random.seed(1)
+    worker = mp.GenericProcessOrThread(Card(), [], [], None, 0)
+    plot = Plot(fluxKind)
+    print('fluxKind = {0}'.format(fluxKind))
+    for nrays in (int(1e5), int(1e6), int(1e7)):
+        rays = make_rays(nrays, fluxKind)
+        t0 = time.time()
+        res0 = separate_hists(worker, plot, *rays)
+        t1 = time.time()
+        res1 = worker.do_fused_hists(*(rays + (plot,)))
+        t2 = time.time()
+        for ih, (h0, h1) in enumerate(zip(res0, res1)):
+            if h0 is None:
+                assert h1 is None
+                continue
+            assert np.allclose(h0, h1, rtol=1e-10, atol=0), ih
+        print('{0:.0e} rays: separate {1:.3f} s, fused {2:.3f} s'.format(
+            nrays, t1-t0, t2-t1))
+
+        x, y, c, intensity, flux, cDataRGB = rays
+        hue = np.random.uniform(size=nrays)
+        t0 = time.time()
+        cDataHSV = np.dstack((hue.reshape(-1, 1),
+                              np.ones((nrays, 1)) * mp_saturation,
+                              flux.reshape(-1, 1)))
+        cDataRGB = mpl.colors.hsv_to_rgb(cDataHSV).reshape(-1, 3)
+        res0 = worker.do_fused_hists(
+            x, y, c, intensity, flux, cDataRGB, plot)
+        t1 = time.time()
+        res1 = worker.do_fused_hists(
+            x, y, c, intensity, flux, None, plot, hue)
+        res1 = [mp.hue_moments_to_rgb(h, mp_saturation)
+                if ih in (1, 4, 7, 10) else h for ih, h in enumerate(res1)]
+        t2 = time.time()
+        for ih, (h0, h1) in enumerate(zip(res0, res1)):
+            if h0 is None:
+                continue
+            assert np.allclose(h0, h1, rtol=1e-9, atol=1e-9), ih
+        print('{0:.0e} rays: colored rays {1:.3f} s, colored bins {2:.3f} s'
+              .format(nrays, t1-t0, t2-t1))
+
+
+if __name__ == '__main__':
+    main('total')
+    main('Es')
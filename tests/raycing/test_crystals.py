@@ -6,6 +6,7 @@ Created on Thu Jun 19 15:15:38 2014
 """
 
 import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import numpy as np
 import xrt.backends.raycing.materials as rm
 
 xtalSi = rm.CrystalSi(hkl=(1, 1, 1), tK=300, rho=2.3296)
@@ -29,3 +30,29 @@ print(xtal.get_structure_factor(E0, 0.5/xtal.d))
 
 xtal = xtalSiGeneral
 print(xtal.get_structure_factor(E0, 0.5/xtal.d))
+
+# per-ray energies and sin(theta)/lambda with a general cell; must be equal
+# to the ray-by-ray calculation:
+xtalQuartz = rm.CrystalFromCell(
+    'alphaQuartz', (1, 0, 2), a=4.91304, c=5.40463, gamma=120,
+    atoms=[14, 14, 14, 8, 8, 8, 8, 8, 8],
+    atomsXYZ=[[0.4697, 0., 0.],
+              [-0.4697, -0.4697, 1./3],
+              [0., 0.4697, 2./3],
+              [0.4125, 0.2662, 0.1188],
+              [-0.1463, -0.4125, 0.4521],
+              [-0.2662, 0.1463, -0.2145],
+              [0.1463, -0.2662, -0.1188],
+              [-0.4125, -0.1463, 0.2145],
+              [0.2662, 0.4125, 0.5479]])
+E = np.linspace(8000, 9000, 5)
+dw = xtalQuartz.get_Darwin_width(E)
+dw1 = [xtalQuartz.get_Darwin_width(e) for e in E]
+print(dw)
+assert np.allclose(dw, dw1, rtol=1e-12, atol=0)
+sinTheta = np.sin(xtalQuartz.get_Bragg_angle(E) - 1e-5)
+amp = xtalQuartz.get_amplitude(E, sinTheta)[0]
+amp1 = [xtalQuartz.get_amplitude(e[None], st[None])[0][0]
+        for e, st in zip(E, sinTheta)]
+print(amp)
+assert np.allclose(amp, amp1, rtol=1e-12, atol=0)
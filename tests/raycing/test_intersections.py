@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Validates the closed form intersections of the OEs that implement
+``intersect_analytic`` against the iterative search. Every OE is created with
+its default physical limits and illuminated by a divergent source; the rays
+are traced twice, with the analytic intersections and with the iterative
+search forced by a disabled ``_is_analytic``. The script prints, for the local
+beam of every OE, the max deviations of the local coordinates and of the
+intensity and the number of rays that have got a different state, and raises
+an AssertionError if the two searches have found different crossings.
+"""
+__author__ = "Konstantin Klementiev, Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.oes as roe
+import xrt.backends.raycing.materials as rm
+
+E0 = 9000.
+p = 20000.
+fields = 'x', 'y', 'z', 'Jss', 'Jpp'
+
+
+def make_oes(beamLine):
+    siBragg = rm.CrystalSi(hkl=(1, 1, 1))
+    siLaue = rm.CrystalSi(hkl=(1, 1, 1), geom='Laue reflected', t=0.2)
+    rh = rm.Material('Rh', rho=12.41)
+    be = rm.Material('Be', rho=1.848, kind='lens')
+    thetaB = siBragg.get_Bragg_angle(E0)
+    center = (0, p, 0)
+    return [
+        roe.JohannCylinder(beamLine, 'JohannCylinder', center, pitch=thetaB,
+                           Rm=1000., material=siBragg),
+        roe.JohannCylinder(beamLine, 'JohannCylinderParabolic', center,
+                           pitch=thetaB, Rm=1000., crossSection='parabolic',
+                           material=siBragg),
+        roe.JohannToroid(beamLine, 'JohannToroid', center, pitch=thetaB,
+                         Rm=1000., Rs=300., material=siBragg),
+        roe.BentLaueCylinder(beamLine, 'BentLaueCylinder', center,
+                             pitch=np.pi/2, R=1e4, material=siLaue),
+        roe.BentLaueSphere(beamLine, 'BentLaueSphere', center,
+                           pitch=np.pi/2, R=1e4, material=siLaue),
+        roe.ToroidMirror(beamLine, 'ToroidMirror', center, pitch=3e-3,
+                         R=1e6, r=50., material=rh),
+        roe.EllipticalMirror(beamLine, 'EllipticalMirror', center,
+                             pitch=3e-3, p=p, q=5000., material=rh),
+        roe.ParabolicMirror(beamLine, 'ParabolicMirror', center, pitch=3e-3,
+                            p=p, material=rh),
+        roe.ParaboloidFlatLens(beamLine, 'ParaboloidFlatLens', center,
+                               pitch=np.pi/2, focus=500., zmax=1.,
+                               t=0.1, material=be)]
+
+
+def trace(oe, beamSource, analytic):
+    if not analytic:
+        oe._is_analytic = lambda local_f: False
+    raycing.seed_rng(1)
+    t0 = time.time()
+    if isinstance(oe, roe.ParaboloidFlatLens):
+        beamGlobal, beamLocal1, beamLocal = oe.multiple_refract(beamSource)
+    else:
+        beamGlobal, beamLocal = oe.reflect(beamSource)
+    dt = time.time() - t0
+    if not analytic:
+        del oe._is_analytic
+    else:
+        methods = set(stats['method'] for stats in oe.intersectionStats)
+        assert 'analytic' in methods, oe.name
+    oe.intersectionStats.clear()
+    return beamLocal, dt
+
+
+def compare(nrays=int(1e5)):
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(
+        beamLine, 'source', (0, 0, 0), nrays=nrays, dx=0.5, dz=0.5,
+        dxprime=2e-4, dzprime=2e-4, distE='flat', energies=(E0-5, E0+5),
+        polarization='h')
+    for oe in make_oes(beamLine):
+        raycing.seed_rng(1)
+        beamSource = source.shine()
+        local0, t0 = trace(oe, beamSource, False)
+        local1, t1 = trace(oe, beamSource, True)
+        good = (local0.state > 0) & (local1.state > 0)
+        deviations = dict((field, np.abs(getattr(local0, field)[good] -
+                                         getattr(local1, field)[good]).max()
+                           if good.any() else 0.) for field in fields)
+        nDiff = (local0.state != local1.state).sum()
+        print('{0}: iterative {1:.3f} s, analytic {2:.3f} s; max abs '
+              'deviations {3}; {4} rays of different state'.format(
+                  oe.name, t0, t1, ', '.join('{0}: {1:.1e}'.format(
+                      field, deviations[field]) for field in fields), nDiff))
+        assert nDiff == 0, oe.name
+        assert max(deviations[f] for f in ('x', 'y', 'z')) < 1e-6, oe.name
+        assert max(deviations[f] for f in ('Jss', 'Jpp')) < 1e-6, oe.name
+
+
+if __name__ == '__main__':
+    compare()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Validates the single precision beam policy (see
+:func:`xrt.backends.raycing.sources_beams.set_beam_precision`) against double
+precision. A beamline of a geometric source, a slit, a toroidal mirror, a
+Si111 crystal and a screen is ray traced twice with the same random seed. The
+script prints the execution times and, for every beam, the max deviations of
+the ray coordinates, directions, path and intensity and the number of rays that
+have got a different state. The comparison is repeated for packed beams (see
+*packed* in :class:`xrt.backends.raycing.sources_beams.Beam`).
+"""
+__author__ = "Konstantin Klementiev, Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.sources_beams as rsb
+import xrt.backends.raycing.apertures as ra
+import xrt.backends.raycing.oes as roe
+import xrt.backends.raycing.screens as rsc
+import xrt.backends.raycing.materials as rm
+
+fields = 'x', 'y', 'z', 'a', 'b', 'c', 'path', 'Jss', 'Jpp'
+
+
+def build_beamline(nrays):
+    beamLine = raycing.BeamLine()
+    beamLine.source = rs.GeometricSource(
+        beamLine, 'source', (0, 0, 0), nrays=nrays, dx=0.1, dz=0.05,
+        dxprime=1e-4, dzprime=5e-5, distE='flat', energies=(8990, 9010),
+        polarization='h')
+    beamLine.slit = ra.RectangularAperture(
+        beamLine, 'slit', (0, 15000, 0), ('left', 'right', 'bottom', 'top'),
+        [-1, 1, -0.5, 0.5])
+    beamLine.mirror = roe.ToroidMirror(
+        beamLine, 'mirror', (0, 20000, 0), pitch=3e-3, R=1e6, r=50,
+        material=rm.Material('Si', rho=2.33))
+    beamLine.crystal = roe.OE(
+        beamLine, 'crystal', (0, 22000, 0), pitch=np.radians(12.7),
+        material=rm.CrystalSi(hkl=(1, 1, 1)))
+    beamLine.screen = rsc.Screen(beamLine, 'screen', (0, 30000, 0))
+    return beamLine
+
+
+def trace(beamLine):
+    beamSource = beamLine.source.shine()
+    beamLine.slit.propagate(beamSource)
+    beamMirrorGlobal, beamMirrorLocal = beamLine.mirror.reflect(beamSource)
+    beamCrystalGlobal, beamCrystalLocal = beamLine.crystal.reflect(
+        beamMirrorGlobal)
+    beamScreen = beamLine.screen.expose(beamCrystalGlobal)
+    return {'source': beamSource, 'mirrorLocal': beamMirrorLocal,
+            'crystalLocal': beamCrystalLocal, 'screen': beamScreen}
+
+
+def run(policy, nrays, seed, packed):
+    rs.set_beam_precision(policy)
+    rsb.defaultPacked = packed
+    raycing.seed_rng(seed)
+    beamLine = build_beamline(nrays)
+    t0 = time.time()
+    beams = trace(beamLine)
+    dt = time.time() - t0
+    rs.set_beam_precision('float64')
+    rsb.defaultPacked = False
+    return beams, dt
+
+
+def compare(nrays=int(1e6), seed=1, packed=False):
+    beams64, t64 = run('float64', nrays, seed, packed)
+    beams32, t32 = run('float32', nrays, seed, packed)
+    print('{0:.0e} {1}rays: float64 {2:.2f} s, float32 {3:.2f} s'.format(
+        nrays, 'packed ' if packed else '', t64, t32))
+    for key in beams64:
+        b64, b32 = beams64[key], beams32[key]
+        assert b32.x.dtype == np.float32, key
+        good = (b64.state == 1) & (b32.state == 1)
+        deviations = ', '.join('{0}: {1:.1e}'.format(
+            field, np.abs(getattr(b64, field)[good] -
+                          getattr(b32, field)[good]).max())
+            for field in fields)
+        flux64 = (b64.Jss[good] + b64.Jpp[good]).sum()
+        flux32 = (b32.Jss[good] + b32.Jpp[good]).sum()
+        print('{0} ({1}): max abs deviations {2}; relative flux deviation '
+              '{3:.1e}; {4} rays of different state'.format(
+                  key, b32.x.dtype, deviations, abs(flux32/flux64 - 1),
+                  (b64.state != b32.state).sum()))
+
+
+if __name__ == '__main__':
+    compare(int(1e5))
+    compare(int(1e6))
+    compare(int(1e5), packed=True)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Validates the interpolated amplitudes of
+:class:`xrt.backends.raycing.materials.ResponseTable` against the direct
+``get_amplitude`` of the materials: a Rh mirror, a thin Rh mirror, a W/Si
+multilayer and a Si111 crystal, each for random energies and angles within a
+band. The script prints the max absolute deviations of the s and p
+amplitudes, the table sizes and the execution times of the interpolation and
+of the direct calculation, and fails if a deviation exceeds the targeted
+accuracy. The degenerate bands of a single energy or a single angle and a
+scalar ray are checked too, and so is the disk cache.
+"""
+__author__ = "Konstantin Klementiev, Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import shutil
+import tempfile
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.materials as rm
+
+
+def get_cases():
+    Si = rm.Material('Si', rho=2.33)
+    W = rm.Material('W', rho=19.3)
+    return [
+        ('Rh mirror', rm.Material('Rh', rho=12.41), (5000, 15000),
+         (1e-3, 8e-3)),
+        ('thin Rh mirror',
+         rm.Material('Rh', rho=12.41, kind='thin mirror', t=5e-5),
+         (5000, 15000), (1e-3, 8e-3)),
+        ('W/Si multilayer', rm.Multilayer(Si, 40, W, 20, 50, Si),
+         (8000, 10000), (5e-3, 2e-2)),
+        ('Si111', rm.CrystalSi(hkl=(1, 1, 1)), (8990, 9010), None)]
+
+
+def get_rays(material, eBand, thetaBand, nrays, seed=1):
+    rng = np.random.RandomState(seed)
+    E = rng.uniform(eBand[0], eBand[1], nrays)
+    if thetaBand is None:  # around the Bragg angle
+        theta = material.get_Bragg_angle(E) + rng.uniform(-1e-4, 1e-4, nrays)
+    else:
+        theta = rng.uniform(thetaBand[0], thetaBand[1], nrays)
+    return E, -np.sin(theta)
+
+
+def get_deviation(material, E, beamInDotNormal, accuracy):
+    rt = rm.ResponseTable(accuracy)
+    rt.get_amplitude(material, E, beamInDotNormal)  # builds the table
+    t0 = time.time()
+    r1 = rt.get_amplitude(material, E, beamInDotNormal)
+    t1 = time.time()
+    r0 = material.get_amplitude(E, beamInDotNormal)
+    t2 = time.time()
+    dev = [np.abs(np.asarray(a1) - np.asarray(a0)).max()
+           for a1, a0 in zip(r1[:2], r0[:2])]
+    return dev, rt, t1 - t0, t2 - t1
+
+
+def test_accuracy(nrays=int(2e5)):
+    raycing.cacheDir = None
+    for name, material, eBand, thetaBand in get_cases():
+        E, beamInDotNormal = get_rays(material, eBand, thetaBand, nrays)
+        for accuracy in (1e-4, 1e-3):
+            dev, rt, tInterp, tDirect = get_deviation(
+                material, E, beamInDotNormal, accuracy)
+            table = list(rt.tables.values())[0]
+            print('{0}, accuracy {1:.0e}: max deviation rs {2:.1e}, rp '
+                  '{3:.1e}; {4}x{5} nodes; interpolated {6:.3f} s, direct '
+                  '{7:.3f} s'.format(
+                      name, accuracy, dev[0], dev[1], len(table['eNodes']),
+                      len(table['xNodes']), tInterp, tDirect))
+            assert max(dev) < accuracy, name
+
+
+def test_degenerate_bands():
+    raycing.cacheDir = None
+    material = rm.Material('Rh', rho=12.41)
+    accuracy = 1e-4
+    cases = [('scalar', 9000., -np.sin(5e-3)),
+             ('single energy and angle', np.full(10, 9000.),
+              np.full(10, -np.sin(5e-3))),
+             ('single angle', np.linspace(8000, 9000, 10),
+              np.full(10, -np.sin(5e-3))),
+             ('single energy', np.full(10, 9000.),
+              -np.sin(np.linspace(1e-3, 5e-3, 10)))]
+    for name, E, beamInDotNormal in cases:
+        dev = get_deviation(material, E, beamInDotNormal, accuracy)[0]
+        print('{0}: max deviation rs {1:.1e}, rp {2:.1e}'.format(
+            name, dev[0], dev[1]))
+        assert max(dev) < accuracy, name
+
+
+def test_cache(nrays=int(1e4)):
+    cacheDir = raycing.cacheDir
+    raycing.cacheDir = tempfile.mkdtemp()
+    try:
+        name, material, eBand, thetaBand = get_cases()[2]
+        E, beamInDotNormal = get_rays(material, eBand, thetaBand, nrays)
+        r0 = rm.ResponseTable().get_amplitude(material, E, beamInDotNormal)
+        cacheFiles = os.listdir(raycing.cacheDir)
+        assert len(cacheFiles) == 1 and cacheFiles[0].endswith('.npz')
+        r1 = rm.ResponseTable().get_amplitude(material, E, beamInDotNormal)
+        assert all(np.all(a1 == a0) for a1, a0 in zip(r1, r0))
+        with open(os.path.join(raycing.cacheDir, cacheFiles[0]), 'r+b') as f:
+            f.truncate(100)  # a broken cache file is a cache miss
+        r1 = rm.ResponseTable().get_amplitude(material, E, beamInDotNormal)
+        assert all(np.all(a1 == a0) for a1, a0 in zip(r1, r0))
+        print('{0}: the cached table is reused, the broken one is '
+              'rebuilt'.format(name))
+    finally:
+        shutil.rmtree(raycing.cacheDir)
+        raycing.cacheDir = cacheDir
+
+
+if __name__ == '__main__':
+    test_accuracy()
+    test_degenerate_bands()
+    test_cache()
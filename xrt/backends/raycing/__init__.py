@@ -89,6 +89,28 @@ user supplies `physical` and `optical` limits, where the latter is used to
 define the ``out`` category (for rays between `physical` and `optical` limits).
 An alarm is triggered if the fraction of dead rays exceeds a specified level.
 
+Random numbers
+--------------
+
+The sources and the optical elements draw their random numbers from a
+``numpy.random.Generator`` of the calling thread returned by
+:func:`get_rng`. :func:`~xrt.runner.run_ray_tracing` seeds an independent
+stream for every scan step, iteration and worker from one run seed (see its
+*randomSeed* parameter), so that a run can be repeated with the same rays.
+The legacy global ``np.random`` is still seeded per worker from the same
+stream for user code in *run_process*.
+
+Disk caches
+-----------
+
+Tables that are expensive to build from large input files, e.g. the spline
+coefficients of surface figure error maps (see
+:class:`~xrt.backends.raycing.distortions.DistortionMap`), are stored as
+``.npy`` files in the directory *cacheDir* of this module (by default
+``~/.xrt/cache``) under the hash of their input. The cached tables are
+memory-mapped when loaded again. The cache can be safely deleted at any time.
+Setting *cacheDir* to None disables the disk caches.
+
 Scripting in python
 -------------------
 
@@ -125,7 +147,10 @@ __author__ = "Konstantin Klementiev, Roman Chernikov"
 __date__ = "26 Mar 2016"
 
 # import copy
+import os
 import types
+import tempfile
+import threading
 import numpy as np
 
 try:  # for Python 3 compatibility:
@@ -147,7 +172,9 @@ dt = 1e-5  # mm: margin around OE within which the intersection is searched
 ds = 0.  # mm: margin used in multiple reflections
 nrays = 100000
 maxIteration = 100  # max number of iterations while searching for intersection
+maxNewtonIteration = 4  # max number of Newton steps after analytic solution
 maxHalfSizeOfOE = 1000.
+cacheDir = os.path.join(os.path.expanduser('~'), '.xrt', 'cache')
 maxDepthOfOE = 100.
 # maxZDeviationAtOE = 100.
 
@@ -160,6 +187,46 @@ hueMin = 0.
 hueMax = 10.
 
 
+def get_cache_file(name):
+    """Returns the full path of the cache file *name* in *cacheDir*, creating
+    the directory if needed, or None if the disk caches are disabled or the
+    directory is not writable."""
+    if cacheDir is None:
+        return
+    try:
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+    except OSError:
+        return
+    if not os.access(cacheDir, os.W_OK):
+        return
+    return os.path.join(cacheDir, name)
+
+
+def save_cache_file(fname, save):
+    """Writes the cache file *fname* by *save*, a function of an open binary
+    file, into a temporary file in the same directory and then moves it to
+    *fname* in one step, so that the processes that read or write the same
+    cache file concurrently never see a partial file. Returns True on
+    success."""
+    try:
+        fd, tmpName = tempfile.mkstemp(
+            dir=os.path.dirname(fname), suffix='.tmp')
+    except (IOError, OSError):
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            save(f)
+        getattr(os, 'replace', os.rename)(tmpName, fname)
+    except (IOError, OSError):
+        try:
+            os.remove(tmpName)
+        except OSError:
+            pass
+        return False
+    return True
+
+
 def is_sequence(arg):
     """Checks whether *arg* is a sequence."""
     result = (not hasattr(arg, "strip") and hasattr(arg, "__getitem__") or
@@ -174,6 +241,64 @@ def is_sequence(arg):
     return result
 
 
+class _LegacyGenerator(object):
+    """A minimal stand-in for numpy.random.Generator for numpy < 1.17."""
+    def __init__(self, seed=None):
+        self.randomState = np.random.RandomState(seed)
+
+    def __getattr__(self, name):
+        return getattr(self.randomState, name)
+
+    def random(self, size=None):
+        return self.randomState.random_sample(size)
+
+    def integers(self, low, high=None, size=None, endpoint=False):
+        if high is None:
+            low, high = 0, low
+        return self.randomState.randint(
+            low, high+1 if endpoint else high, size)
+
+
+_rngLocal = threading.local()
+_rotationMatrices = {}
+
+
+def seed_rng(seed=None, key=()):
+    """
+    Seeds the random generator of the calling thread, see :func:`get_rng`.
+    *seed* is the seed of the whole run, an int or None for fresh entropy.
+    *key* is a tuple of non-negative ints, e.g. (iteration, worker index),
+    that selects an independent stream of the run, in the same way as the
+    children spawned by ``numpy.random.SeedSequence.spawn``. Returns the run
+    seed (the entropy), which reproduces the run when given again.
+    """
+    if hasattr(np.random, 'SeedSequence'):
+        seedSequence = np.random.SeedSequence(seed, spawn_key=key)
+        _rngLocal.generator = np.random.Generator(
+            np.random.PCG64(seedSequence))
+        return seedSequence.entropy
+    if seed is None:
+        seed = np.random.RandomState().randint(2**31)
+    _rngLocal.generator = _LegacyGenerator(hash((seed,) + key) % 2**32)
+    return seed
+
+
+def get_rng():
+    """
+    Returns the random generator (an instance of
+    ``numpy.random.Generator``) of the calling thread, which is used by the
+    sources and the optical elements. In a ray tracing run by
+    :func:`~xrt.runner.run_ray_tracing`, each worker is seeded by
+    :func:`seed_rng` from the run seed for each iteration. A thread that was
+    not seeded gets a generator with fresh entropy.
+    """
+    try:
+        return _rngLocal.generator
+    except AttributeError:
+        seed_rng()
+        return _rngLocal.generator
+
+
 def distance_xy(p1, p2):
     """Calculates 2D distance between p1 and p2. p1 and p2 are vectors of
     length >= 2."""
@@ -204,40 +329,75 @@ def rotate_z(x, y, cosangle, sinangle):
     return cosangle*x - sinangle*y, sinangle*x + cosangle*y
 
 
-def rotate_beam(beam, indarr=None, rotationSequence='RzRyRx',
-                pitch=0, roll=0, yaw=0, skip_xyz=False, skip_abc=False):
-    """Rotates the *beam* indexed by *indarr* by the angles *yaw, roll, pitch*
-    in the sequence given by *rotationSequence*. A leading '-' symbol of
-    *rotationSequence* reverses the sequences.
-    """
+def rotation_matrix(rotationSequence='RzRyRx', pitch=0, roll=0, yaw=0):
+    """Returns the 3×3 matrix of the rotations by the angles *yaw, roll,
+    pitch* in the sequence given by *rotationSequence*, as done by
+    :func:`rotate_x`, :func:`rotate_y` and :func:`rotate_z`. A leading '-'
+    symbol of *rotationSequence* reverses the sequences. The matrices are
+    cached by the sequence and the angles."""
+    key = (rotationSequence, pitch, roll, yaw)
+    try:
+        return _rotationMatrices[key]
+    except KeyError:
+        pass
     angles = {'z': yaw, 'y': roll, 'x': pitch}
-    rotates = {'z': rotate_z, 'y': rotate_y, 'x': rotate_x}
-    if not skip_xyz:
-        coords1 = {'z': beam.x, 'y': beam.x, 'x': beam.y}
-        coords2 = {'z': beam.y, 'y': beam.z, 'x': beam.z}
-    if not skip_abc:
-        vcomps1 = {'z': beam.a, 'y': beam.a, 'x': beam.b}
-        vcomps2 = {'z': beam.b, 'y': beam.c, 'x': beam.c}
-
+    axes = {'z': (0, 1), 'y': (2, 0), 'x': (1, 2)}
     if rotationSequence[0] == '-':
         seq = rotationSequence[6] + rotationSequence[4] + rotationSequence[2]
     else:
         seq = rotationSequence[1] + rotationSequence[3] + rotationSequence[5]
+    matrix = np.eye(3)
     for s in seq:
-        angle, rotate = angles[s], rotates[s]
-        if not skip_xyz:
-            c1, c2 = coords1[s], coords2[s]
-        if not skip_abc:
-            v1, v2 = vcomps1[s], vcomps2[s]
+        angle = angles[s]
         if angle != 0:
-            cA = np.cos(angle)
-            sA = np.sin(angle)
-            if indarr is None:
-                indarr = slice(None)
-            if not skip_xyz:
-                c1[indarr], c2[indarr] = rotate(c1[indarr], c2[indarr], cA, sA)
-            if not skip_abc:
-                v1[indarr], v2[indarr] = rotate(v1[indarr], v2[indarr], cA, sA)
+            i, j = axes[s]
+            rotation = np.eye(3)
+            rotation[i, i] = rotation[j, j] = np.cos(angle)
+            rotation[j, i] = np.sin(angle)
+            rotation[i, j] = -rotation[j, i]
+            matrix = np.dot(rotation, matrix)
+    if len(_rotationMatrices) > 1024:
+        _rotationMatrices.clear()
+    _rotationMatrices[key] = matrix
+    return matrix
+
+
+def rotate_vectors(matrix, vectors, indarr=None, shift=None, inverse=False,
+                   out=None):
+    """Multiplies the 3D *vectors*, given as a sequence of 3 component arrays
+    indexed by *indarr*, by *matrix* as one product of an N×3 array and adds
+    *shift*. If *inverse* is True, *shift* is subtracted and the product is
+    done with the transposed (i.e. inverse for rotations) *matrix*. The result
+    is written to *out* (3 arrays) or back to *vectors* if *out* is None."""
+    if indarr is None:
+        indarr = slice(None)
+    v = np.stack([comp[indarr] for comp in vectors], axis=1)
+    if inverse:
+        if shift is not None:
+            v -= shift
+        v = np.dot(v, matrix)
+    else:
+        v = np.dot(v, matrix.T)
+        if shift is not None:
+            v += shift
+    for comp, vcomp in zip(vectors if out is None else out, v.T):
+        comp[indarr] = vcomp
+
+
+def rotate_beam(beam, indarr=None, rotationSequence='RzRyRx',
+                pitch=0, roll=0, yaw=0, skip_xyz=False, skip_abc=False):
+    """Rotates the *beam* indexed by *indarr* by the angles *yaw, roll, pitch*
+    in the sequence given by *rotationSequence*. A leading '-' symbol of
+    *rotationSequence* reverses the sequences. The rotations are composed into
+    one matrix, see :func:`rotation_matrix`.
+    """
+    if pitch == 0 and roll == 0 and yaw == 0:
+        return
+    matrix = rotation_matrix(rotationSequence, pitch, roll, yaw)
+    if not skip_xyz:
+        rotate_vectors(matrix, (beam.x, beam.y, beam.z), indarr)
+    if not skip_abc:
+        rotate_vectors(matrix, (beam.a, beam.b, beam.c), indarr)
 
 
 def rotate_xyz(x, y, z, indarr=None, rotationSequence='RzRyRx',
@@ -246,24 +406,10 @@ def rotate_xyz(x, y, z, indarr=None, rotationSequence='RzRyRx',
     *yaw, roll, pitch* in the sequence given by *rotationSequence*. A leading
     '-' symbol of *rotationSequence* reverses the sequences.
     """
-    angles = {'z': yaw, 'y': roll, 'x': pitch}
-    rotates = {'z': rotate_z, 'y': rotate_y, 'x': rotate_x}
-    coords1 = {'z': x, 'y': x, 'x': y}
-    coords2 = {'z': y, 'y': z, 'x': z}
-
-    if rotationSequence[0] == '-':
-        seq = rotationSequence[6] + rotationSequence[4] + rotationSequence[2]
-    else:
-        seq = rotationSequence[1] + rotationSequence[3] + rotationSequence[5]
-    for s in seq:
-        angle, rotate = angles[s], rotates[s]
-        c1, c2 = coords1[s], coords2[s]
-        if angle != 0:
-            cA = np.cos(angle)
-            sA = np.sin(angle)
-            if indarr is None:
-                indarr = slice(None)
-            c1[indarr], c2[indarr] = rotate(c1[indarr], c2[indarr], cA, sA)
+    if pitch == 0 and roll == 0 and yaw == 0:
+        return x, y, z
+    rotate_vectors(rotation_matrix(rotationSequence, pitch, roll, yaw),
+                   (x, y, z), indarr)
     return x, y, z
 
 
@@ -299,19 +445,21 @@ def global_to_virgin_local(bl, beam, lo, center=None, part=None):
     *bl* is an instance of :class:`BeamLine`"""
     if part is None:
         part = np.ones(beam.x.shape, dtype=np.bool)
-    a0, b0 = bl.sinAzimuth, bl.cosAzimuth
     if center is None:
         center = [0, 0, 0]
-    lo.x[part] = beam.x[part] - center[0]
-    lo.y[part] = beam.y[part] - center[1]
-    lo.z[part] = beam.z[part] - center[2]
-    if a0 == 0:
+    if bl.sinAzimuth == 0:
+        lo.x[part] = beam.x[part] - center[0]
+        lo.y[part] = beam.y[part] - center[1]
+        lo.z[part] = beam.z[part] - center[2]
         lo.a[part] = beam.a[part]
         lo.b[part] = beam.b[part]
+        lo.c[part] = beam.c[part]
     else:
-        lo.x[part], lo.y[part] = rotate_z(lo.x[part], lo.y[part], b0, a0)
-        lo.a[part], lo.b[part] = rotate_z(beam.a[part], beam.b[part], b0, a0)
-    lo.c[part] = beam.c[part]  # unchanged
+        matrix, shift = bl.get_azimuth_transform(center)
+        rotate_vectors(matrix, (beam.x, beam.y, beam.z), part, shift,
+                       out=(lo.x, lo.y, lo.z))
+        rotate_vectors(matrix, (beam.a, beam.b, beam.c), part,
+                       out=(lo.a, lo.b, lo.c))
 
 
 def virgin_local_to_global(bl, vlb, center=None, part=None,
@@ -323,18 +471,18 @@ def virgin_local_to_global(bl, vlb, center=None, part=None,
     *bl* is an instance of :class:`BeamLine`"""
     if part is None:
         part = np.ones(vlb.x.shape, dtype=np.bool)
-    a0, b0 = bl.sinAzimuth, bl.cosAzimuth
-    if a0 != 0:
-        if not skip_abc:
-            vlb.a[part], vlb.b[part] = rotate_z(
-                vlb.a[part], vlb.b[part], b0, -a0)
-        if not skip_xyz:
-            vlb.x[part], vlb.y[part] = rotate_z(
-                vlb.x[part], vlb.y[part], b0, -a0)
-    if (center is not None) and (not skip_xyz):
-        vlb.x[part] += center[0]
-        vlb.y[part] += center[1]
-        vlb.z[part] += center[2]
+    if bl.sinAzimuth == 0:
+        if (center is not None) and (not skip_xyz):
+            vlb.x[part] += center[0]
+            vlb.y[part] += center[1]
+            vlb.z[part] += center[2]
+        return
+    matrix, shift = bl.get_azimuth_transform(center)
+    if not skip_abc:
+        rotate_vectors(matrix, (vlb.a, vlb.b, vlb.c), part, inverse=True)
+    if not skip_xyz:
+        rotate_vectors(matrix, (vlb.x, vlb.y, vlb.z), part, shift,
+                       inverse=True)
 
 
 def check_alarm(self, incoming, beam):
@@ -511,7 +659,7 @@ def get_b(beam):
 get_theta = get_incidence_angle
 
 
-def get_output(plot, beamsReturnedBy_run_process):
+def get_output(plot, beamsReturnedBy_run_process, cache=None):
     """Used by :mod:`multipro` for creating images of *plot* - instance of
     :class:`XYCPlot`. *beamsReturnedBy_run_process* is a dictionary of
     :class:`Beam` instances returned by user-defined :func:`run_process`.
@@ -519,31 +667,53 @@ def get_output(plot, beamsReturnedBy_run_process):
     :func:`get_output` creates an indexing array corresponding to the requested
     properties of rays in *plot*. It also calculates the number of rays with
     various properties defined in `raycing` backend.
+
+    *cache* is an optional dictionary that lives for one iteration of a
+    worker and is shared by all its plots. The ray masks, the axis data and
+    the flux arrays are stored there under the keys made of the beam name,
+    the accessor function, *rayFlag* and *fluxKind*, so that several plots
+    of the same beam do not repeat the extraction. The returned arrays can
+    therefore be shared by several plots and must not be modified in place.
      """
+    if cache is None:
+        cache = {}
+
+    def cached(key, func):
+        if key not in cache:
+            cache[key] = func()
+        return cache[key]
+
     beam = beamsReturnedBy_run_process[plot.beam]
+    stateName = plot.beam if plot.beamState is None else plot.beamState
     if plot.beamState is None:
         beamState = beam.state
     else:
         beamState = beamsReturnedBy_run_process[plot.beamState].state
     nrays = len(beam.x)
 
-    locAlive = (beamState > 0).sum()
-    part = np.zeros(nrays, dtype=np.bool)
-    locGood = 0
-    locOut = 0
-    locOver = 0
-    locDead = 0
-    for rayFlag in plot.rayFlag:
-        locPart = beamState == rayFlag
-        if rayFlag == 1:
-            locGood = locPart.sum()
-        if rayFlag == 2:
-            locOut = locPart.sum()
-        if rayFlag == 3:
-            locOver = locPart.sum()
-        if rayFlag < 0:
-            locDead += locPart.sum()
-        part = part | locPart
+    def get_part():
+        locAlive = (beamState > 0).sum()
+        part = np.zeros(nrays, dtype=np.bool)
+        locGood = 0
+        locOut = 0
+        locOver = 0
+        locDead = 0
+        for rayFlag in plot.rayFlag:
+            locPart = beamState == rayFlag
+            if rayFlag == 1:
+                locGood = locPart.sum()
+            if rayFlag == 2:
+                locOut = locPart.sum()
+            if rayFlag == 3:
+                locOver = locPart.sum()
+            if rayFlag < 0:
+                locDead += locPart.sum()
+            part = part | locPart
+        return part, locAlive, locGood, locOut, locOver, locDead
+
+    partKey = (stateName, tuple(plot.rayFlag))
+    part, locAlive, locGood, locOut, locOver, locDead = cached(
+        ('part',) + partKey, get_part)
     if hasattr(beam, 'accepted'):
         locAccepted = beam.accepted
         locAcceptedE = beam.acceptedE
@@ -557,56 +727,75 @@ def get_output(plot, beamsReturnedBy_run_process):
 
     if hasattr(beam, 'displayAsAbsorbedPower'):
         plot.displayAsAbsorbedPower = True
-    if isinstance(plot.xaxis.data, types.FunctionType):
-        x = plot.xaxis.data(beam) * plot.xaxis.factor
-    elif isinstance(plot.xaxis.data, np.ndarray):
-        x = plot.xaxis.data * plot.xaxis.factor
-    else:
-        raise ValueError('cannot find data for x!')
-    if isinstance(plot.yaxis.data, types.FunctionType):
-        y = plot.yaxis.data(beam) * plot.yaxis.factor
-    elif isinstance(plot.yaxis.data, np.ndarray):
-        y = plot.yaxis.data * plot.yaxis.factor
-    else:
-        raise ValueError('cannot find data for y!')
+
+    def get_data(axis, aBeam, beamName, what):
+        if isinstance(axis.data, types.FunctionType):
+            return cached(
+                ('data', beamName, axis.data, axis.factor) + partKey,
+                lambda: (axis.data(aBeam) * axis.factor)[part])
+        elif isinstance(axis.data, np.ndarray):
+            return (axis.data * axis.factor)[part]
+        else:
+            raise ValueError('cannot find data for {0}!'.format(what))
+
+    x = get_data(plot.xaxis, beam, plot.beam, 'x')
+    y = get_data(plot.yaxis, beam, plot.beam, 'y')
     if plot.caxis.useCategory:
-        cData = np.zeros_like(beamState)
-        cData[beamState == 1] = hueGood
-        cData[beamState == 2] = hueOut
-        cData[beamState == 3] = hueOver
-        cData[beamState < 0] = hueDead
-        flux = np.ones_like(x)
+        def get_category():
+            cData = np.zeros_like(beamState)
+            cData[beamState == 1] = hueGood
+            cData[beamState == 2] = hueOut
+            cData[beamState == 3] = hueOver
+            cData[beamState < 0] = hueDead
+            return cData[part], np.ones(part.sum())
+        cData, flux = cached(('category',) + partKey, get_category)
     else:
         if plot.beamC is None:
-            beamC = beam
+            beamC, beamCName = beam, plot.beam
         else:
             beamC = beamsReturnedBy_run_process[plot.beamC]
-        if isinstance(plot.caxis.data, types.FunctionType):
-            cData = plot.caxis.data(beamC) * plot.caxis.factor
-        elif isinstance(plot.caxis.data, np.ndarray):
-            cData = plot.caxis.data * plot.caxis.factor
-        else:
-            raise ValueError('cannot find data for cData!')
+            beamCName = plot.beamC
+        cData = get_data(plot.caxis, beamC, beamCName, 'cData')
 
         if plot.fluxKind.startswith('power'):
-            flux = ((beam.Jss + beam.Jpp) *
-                    beam.E * beam.accepted / beam.seeded * SIE0)
+            fluxKind = 'power'
         elif plot.fluxKind.startswith('s'):
-            flux = beam.Jss
+            fluxKind = 's'
         elif plot.fluxKind.startswith('p'):
-            flux = beam.Jpp
+            fluxKind = 'p'
         elif plot.fluxKind.startswith('+-45'):
-            flux = 2*beam.Jsp.real
+            fluxKind = '+-45'
         elif plot.fluxKind.startswith('left-right'):
-            flux = 2*beam.Jsp.imag
+            fluxKind = 'left-right'
         elif plot.fluxKind.startswith('Es'):
-            flux = beam.Es
+            fluxKind = 'Es'
         elif plot.fluxKind.startswith('Ep'):
-            flux = beam.Ep
+            fluxKind = 'Ep'
         else:
-            flux = beam.Jss + beam.Jpp
-
-    return x[part], y[part], flux[part], cData[part], nrays, locAlive,\
+            fluxKind = 'total'
+
+        def get_flux():
+            if fluxKind == 'power':
+                flux = ((beam.Jss + beam.Jpp) *
+                        beam.E * beam.accepted / beam.seeded * SIE0)
+            elif fluxKind == 's':
+                flux = beam.Jss
+            elif fluxKind == 'p':
+                flux = beam.Jpp
+            elif fluxKind == '+-45':
+                flux = 2*beam.Jsp.real
+            elif fluxKind == 'left-right':
+                flux = 2*beam.Jsp.imag
+            elif fluxKind == 'Es':
+                flux = beam.Es
+            elif fluxKind == 'Ep':
+                flux = beam.Ep
+            else:
+                flux = beam.Jss + beam.Jpp
+            return flux[part]
+        flux = cached(('flux', plot.beam, fluxKind) + partKey, get_flux)
+
+    return x, y, flux, cData, nrays, locAlive,\
         locGood, locOut, locOver, locDead, locAccepted, locAcceptedE,\
         locSeeded, locSeededI
 
@@ -635,3 +824,22 @@ class BeamLine(object):
         self.slits = []
         self.screens = []
         self.alarms = []
+        self.azimuthTransforms = {}
+
+    def get_azimuth_transform(self, center=None):
+        """Returns the cached matrix and shift of the transformation from the
+        global to the virgin local system with the origin at *center*, see
+        :func:`rotate_vectors`."""
+        key = (self.sinAzimuth, self.cosAzimuth,
+               None if center is None else tuple(center))
+        try:
+            return self.azimuthTransforms[key]
+        except KeyError:
+            pass
+        a0, b0 = self.sinAzimuth, self.cosAzimuth
+        matrix = np.array([[b0, -a0, 0], [a0, b0, 0], [0, 0, 1]])
+        shift = None if center is None else -np.dot(matrix, center)
+        if len(self.azimuthTransforms) > 1024:
+            self.azimuthTransforms.clear()
+        self.azimuthTransforms[key] = matrix, shift
+        return matrix, shift
@@ -206,7 +206,7 @@ class RectangularAperture(object):
         from . import waves as rw
 
         wave = rs.Beam(nrays=nrays, forceState=1, withAmplitudes=True)
-        xy = np.random.rand(nrays, 2)
+        xy = raycing.get_rng().random((nrays, 2))
         dX = self.limOptX[1] - self.limOptX[0]
         dZ = self.limOptY[1] - self.limOptY[0]
         wave.x[:] = xy[:, 0] * dX + self.limOptX[0]
@@ -385,7 +385,7 @@ class RoundAperture(object):
         from . import waves as rw
 
         wave = rs.Beam(nrays=nrays, forceState=1, withAmplitudes=True)
-        xy = np.random.rand(nrays, 2)
+        xy = raycing.get_rng().random((nrays, 2))
         r = xy[:, 0]**0.5 * self.r
         phi = xy[:, 1] * 2*np.pi
         wave.x[:] = r * np.cos(phi)
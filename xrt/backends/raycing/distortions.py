@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+u"""
+Surface figure error maps
+-------------------------
+
+A measured (e.g. by NOM or LTP) or modelled figure error of an optical surface
+can be attached to any non-parametric OE as an instance of
+:class:`DistortionMap` passed in its *distortionMap* parameter. The map is then
+added to the ideal surface when searching for the intersections and its slopes
+tilt the ideal normals, without subclassing the OE and overriding its
+``local_z_distorted`` and ``local_n_distorted`` methods.
+
+The map is represented by bicubic B-spline coefficients. The height and both
+slopes at arbitrary (x, y) points are obtained from one gather of the 4×4
+neighbouring coefficients per point; the height alone, as needed in the search
+for the intersections, is evaluated by ``scipy.ndimage``. The coefficients are
+calculated once and stored in the disk cache (see *cacheDir* in
+:mod:`~xrt.backends.raycing`) under the hash of the map file and of the map
+parameters, so that a large map is read and filtered only on its first use;
+later it is memory-mapped.
+
+.. autoclass:: DistortionMap()
+   :members: __init__, evaluate, get_height, get_angles
+"""
+__author__ = "Konstantin Klementiev, Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os
+import hashlib
+import numpy as np
+from scipy import ndimage
+
+from .. import raycing
+
+__all__ = 'DistortionMap',
+
+_hashChunk = 2**24  # bytes read at once when hashing a map file
+
+
+class DistortionMap(object):
+    u"""A figure error map z(x, y) of an optical surface, in the local system
+    of the OE. Outside of the map, the height is taken from the nearest map
+    edge."""
+
+    def __init__(self, fname=None, x=None, y=None, z=None, kind='height',
+                 scale=1., center=False, xLimits=None, yLimits=None):
+        u"""
+        *fname*: str
+            The map file. It can be a text file with three columns x, y and
+            value (in any order of the points, the points must form a regular
+            grid, as in a NOM measurement), an .npz file with the arrays `x`,
+            `y` and `z` or an .npy file with a 2D value array of the shape
+            (len(x), len(y)), for which *xLimits* and *yLimits* must be given.
+            A 2D .npy file is memory-mapped.
+
+        *x*, *y*, *z*: 1D, 1D and 2D arrays
+            Alternatively to *fname*, the map can be given by the equidistant
+            coordinates *x* and *y* (mm) and the values *z* of the shape
+            (len(x), len(y)).
+
+        *kind*: 'height' or 'slope'
+            The map values are either heights or meridional slopes dz/dy (rad).
+            The slopes are integrated along y to heights with zero mean.
+
+        *scale*: float
+            The map values are multiplied by *scale* to get mm (heights) or
+            rad (slopes), e.g. 1e-6 for heights in nm.
+
+        *center*: bool
+            If True, the map coordinates are shifted to have their midpoints
+            at the OE origin.
+
+        *xLimits*, *yLimits*: 2-sequences of floats
+            The extents of the map in x and y for a 2D .npy file.
+
+
+        """
+        if kind not in ('height', 'slope'):
+            raise ValueError("unknown kind of the map: {0}".format(kind))
+        self.fname = fname
+        self.kind = kind
+        self.scale = scale
+        if fname is not None:
+            key = self._hash_file(fname)
+            for limits in (xLimits, yLimits):  # the extents of a 2D .npy map
+                if limits is not None:
+                    key.update(np.asarray(limits, dtype=np.float64).tobytes())
+        else:
+            z = np.asarray(z, dtype=np.float64)
+            key = hashlib.sha1(np.ascontiguousarray(z).view(np.uint8))
+            key.update(np.asarray(x, dtype=np.float64).tobytes())
+            key.update(np.asarray(y, dtype=np.float64).tobytes())
+        key.update('{0} {1!r}'.format(kind, scale).encode())
+        self.hash = key.hexdigest()
+
+        cached = self._load_cached()
+        if cached is None:
+            if fname is not None:
+                x, y, z = self._read_map(fname, xLimits, yLimits)
+            x, y, z = self._make_heights(x, y, z)
+            self._make_coeffs(x, y, z)
+            self._save_cached()
+        if center:
+            self.x0 -= self.x0 + (self.nx-1)*self.dx*0.5
+            self.y0 -= self.y0 + (self.ny-1)*self.dy*0.5
+        self._flat = self.coeffs.ravel()
+        self._offsets = (np.arange(4)[:, None]*self.coeffs.shape[1] +
+                         np.arange(4)).ravel()
+
+    @property
+    def limPhysX(self):
+        """The extent of the map in x."""
+        return self.x0, self.x0 + (self.nx-1)*self.dx
+
+    @property
+    def limPhysY(self):
+        """The extent of the map in y."""
+        return self.y0, self.y0 + (self.ny-1)*self.dy
+
+    def _hash_file(self, fname):
+        key = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            while True:
+                chunk = f.read(_hashChunk)
+                if not chunk:
+                    break
+                key.update(chunk)
+        return key
+
+    def _read_map(self, fname, xLimits, yLimits):
+        ext = os.path.splitext(fname)[1].lower()
+        if ext == '.npz':
+            with np.load(fname) as data:
+                return data['x'], data['y'], data['z']
+        elif ext == '.npy':
+            if xLimits is None or yLimits is None:
+                raise ValueError('xLimits and yLimits are required for .npy')
+            z = np.load(fname, mmap_mode='r')
+            return (np.linspace(xLimits[0], xLimits[1], z.shape[0]),
+                    np.linspace(yLimits[0], yLimits[1], z.shape[1]), z)
+        xL, yL, zL = np.loadtxt(fname, unpack=True)
+        x, ix = np.unique(xL, return_inverse=True)
+        y, iy = np.unique(yL, return_inverse=True)
+        if len(x)*len(y) != len(zL):
+            raise ValueError('the map in {0} is not on a regular grid'.format(
+                fname))
+        z = np.empty((len(x), len(y)))
+        z[ix, iy] = zL
+        return x, y, z
+
+    def _make_heights(self, x, y, z):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64) * self.scale
+        if z.shape != (len(x), len(y)):
+            raise ValueError('the map must be of the shape (len(x), len(y))')
+        if self.kind == 'slope':
+            dy = y[1] - y[0]
+            z = np.concatenate((np.zeros((len(x), 1)), np.cumsum(
+                (z[:, 1:] + z[:, :-1]) * 0.5 * dy, axis=1)), axis=1)
+            z -= z.mean()
+        return x, y, z
+
+    def _make_coeffs(self, x, y, z):
+        self.nx, self.ny = z.shape
+        self.x0, self.dx = x[0], (x[-1]-x[0]) / (self.nx-1)
+        self.y0, self.dy = y[0], (y[-1]-y[0]) / (self.ny-1)
+# the spline is mirror-symmetric at the map edges, hence 'reflect' padding of
+# the coefficients by one node for the 4x4 neighbourhoods at the edges:
+        coeffs = ndimage.spline_filter(z, order=3, mode='mirror')
+        self.coeffs = np.pad(coeffs, 1, mode='reflect')
+
+    def _cache_names(self):
+        coeffsName = raycing.get_cache_file(
+            'distortion_{0}.npy'.format(self.hash))
+        if coeffsName is None:
+            return None, None
+        return coeffsName, coeffsName[:-4] + '_axes.npy'
+
+    def _load_cached(self):
+        coeffsName, axesName = self._cache_names()
+        if coeffsName is None or not os.path.exists(axesName):
+            return
+        try:
+            self.coeffs = np.load(coeffsName, mmap_mode='r')
+            self.x0, self.dx, self.y0, self.dy = np.load(axesName)
+        except (IOError, OSError, ValueError):
+            return
+        self.nx, self.ny = self.coeffs.shape[0] - 2, self.coeffs.shape[1] - 2
+        return True
+
+    def _save_cached(self):
+        coeffsName, axesName = self._cache_names()
+        if coeffsName is None:
+            return
+        try:
+            np.save(coeffsName, self.coeffs)
+            np.save(axesName, np.array([self.x0, self.dx, self.y0, self.dy]))
+        except (IOError, OSError):
+            pass
+
+    def evaluate(self, x, y, withGradient=False):
+        """Returns the height at the points (*x*, *y*) or, if *withGradient*
+        is True, a tuple of the height, dz/dx and dz/dy, from one lookup of
+        the 4×4 spline coefficients per point."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        u = np.clip((x - self.x0) / self.dx, 0, self.nx-1)
+        v = np.clip((y - self.y0) / self.dy, 0, self.ny-1)
+        if not withGradient:  # the compiled spline evaluation is faster
+            return ndimage.map_coordinates(
+                self.coeffs[1:-1, 1:-1], np.array([u.ravel(), v.ravel()]),
+                order=3, mode='mirror', prefilter=False).reshape(u.shape)
+        iu = np.minimum(u.astype(int), self.nx-2)
+        iv = np.minimum(v.astype(int), self.ny-2)
+        u -= iu
+        v -= iv
+# the coefficients of the 4x4 neighbourhoods, of shape (npoints, 4, 4):
+        c = self._flat[(iu*self.coeffs.shape[1] + iv)[..., None] +
+                       self._offsets].reshape(u.shape + (4, 4))
+        wu, wv = _bspline_weights(u), _bspline_weights(v)
+        cv = np.einsum('...ij,...j->...i', c, wv)
+        z = np.einsum('...i,...i->...', wu, cv)
+        dzdx = np.einsum('...i,...i->...', _bspline_derivatives(u), cv) /\
+            self.dx
+        dzdy = np.einsum('...i,...ij,...j->...', wu, c,
+                         _bspline_derivatives(v)) / self.dy
+        return z, dzdx, dzdy
+
+    def get_height(self, x, y):
+        """The height of the map at (*x*, *y*), as ``local_z_distorted``."""
+        return self.evaluate(x, y)
+
+    def get_angles(self, x, y):
+        """The angles d_pitch and d_roll of the normal at (*x*, *y*), as
+        ``local_n_distorted``."""
+        z, dzdx, dzdy = self.evaluate(x, y, withGradient=True)
+        return np.arctan(dzdy), -np.arctan(dzdx)
+
+
+def _bspline_weights(t):
+    """The weights of the cubic B-spline coefficients at the nodes i-1, i,
+    i+1 and i+2 for the fractional positions *t* in [i, i+1]."""
+    t2 = t * t
+    t3 = t2 * t
+    return np.stack(((1-t)**3, 3*t3 - 6*t2 + 4, -3*t3 + 3*t2 + 3*t + 1, t3),
+                    axis=-1) / 6.
+
+
+def _bspline_derivatives(t):
+    """The derivatives of :func:`_bspline_weights` over *t*."""
+    t2 = t * t
+    return np.stack((-(1-t)**2, 3*t2 - 4*t, -3*t2 + 2*t + 1, t2),
+                    axis=-1) * 0.5
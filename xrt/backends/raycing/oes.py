@@ -73,6 +73,12 @@ your descendant of the :class:`OE`: ``local_z_distorted`` (or
 ``local_r_distorted`` for a parametric surface) and ``local_n_distorted``. The
 latter method returns two angles d_pitch and d_roll. See the example
 ':ref:`warping`'.
+
+Alternatively, a measured or modelled height or slope map can be given to any
+non-parametric OE as its *distortionMap* parameter, an instance of
+:class:`~xrt.backends.raycing.distortions.DistortionMap` or the name of the map
+file. The default ``local_z_distorted`` and ``local_n_distorted`` then take the
+height and the angles from the bicubic spline of the map.
 """
 __author__ = "Konstantin Klementiev, Roman Chernikov"
 __date__ = "26 Mar 2016"
@@ -261,6 +267,16 @@ class JohannCylinder(OE):
         else:  # 'parabolic'
             return y**2 / 2.0 / self.Rm
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Intersections with the circular or parabolic cylinder."""
+        if local_f is not None:
+            return
+        if self.crossSection.startswith('circ'):  # 'circular'
+            coeffs = 0, 1, 1, 0, 0, -2*self.Rm, 0
+        else:  # 'parabolic'
+            coeffs = 0, 0.5/self.Rm, 0, 0, 0, -1, 0
+        return self.intersect_quadric(coeffs, x, y, z, a, b, c)
+
     def local_n_cylinder(self, x, y, R, alpha):
         """The main part of :meth:`local_n`. It introduces two new arguments
         to simplify the implementation of :meth:`local_n` in the derived class
@@ -345,6 +361,14 @@ class JohannToroid(OE):
         bla, z = raycing.rotate_y(0, z, cosangle, sinangle)
         return z + self.Rs
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Intersections with the osculating paraboloid, to be refined by
+        Newton steps."""
+        if local_f is not None:
+            return
+        coeffs = 0.5/self.Rs, 0.5/self.Rm, 0, 0, 0, -1, 0
+        return self.intersect_quadric(coeffs, x, y, z, a, b, c)
+
     def local_n(self, x, y):
         """Determines the normal vectors of OE at (*x*, *y*) position: of the
         atomic planes and of the surface."""
@@ -509,6 +533,16 @@ class BentLaueCylinder(OE):
         else:  # 'parabolic'
             return y**2 / 2.0 / self.R
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Intersections with the circular or parabolic cylinder."""
+        if local_f is not None:
+            return
+        if self.crossSection.startswith('circ'):  # 'circular'
+            coeffs = 0, 1, 1, 0, 0, -2*self.R, 0
+        else:  # 'parabolic'
+            coeffs = 0, 0.5/self.R, 0, 0, 0, -1, 0
+        return self.intersect_quadric(coeffs, x, y, z, a, b, c)
+
     def local_n_cylinder(self, x, y, R, alpha):
         """The main part of :meth:`local_n`. It introduces two new arguments
         to simplify the implementation of :meth:`local_n` in the derived class
@@ -579,6 +613,16 @@ class BentLaueSphere(BentLaueCylinder):
         else:  # 'parabolic'
             return (x**2+y**2) / 2.0 / self.R
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Intersections with the sphere or paraboloid."""
+        if local_f is not None:
+            return
+        if self.crossSection.startswith('circ'):  # 'circular'
+            coeffs = 1, 1, 1, 0, 0, -2*self.R, 0
+        else:  # 'parabolic'
+            coeffs = 0.5/self.R, 0.5/self.R, 0, 0, 0, -1, 0
+        return self.intersect_quadric(coeffs, x, y, z, a, b, c)
+
     def local_n(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         if self.crossSection.startswith('circ'):  # 'circular'
@@ -738,6 +782,14 @@ class ToroidMirror(OE):
         rx[rx < 0] = 0.
         return y**2/2.0/self.R + self.r - rx**0.5
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Intersections with the osculating paraboloid, to be refined by
+        Newton steps."""
+        if local_f is not None:
+            return
+        coeffs = 0.5/self.r, 0.5/self.R, 0, 0, 0, -1, 0
+        return self.intersect_quadric(coeffs, x, y, z, a, b, c)
+
     def local_n(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         a = -x * (self.r**2-x**2)**(-0.5)  # -dz/dx
@@ -972,6 +1024,17 @@ class EllipticalMirror(OE):
         delta_z = -self.p * np.sin(self.alpha)
         return -self.be * np.sqrt(1 - ((y+delta_y)/self.ae)**2) - delta_z
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Intersections with the elliptical cylinder, both branches."""
+        if local_f is not None:
+            return
+        delta_y = self.p * np.cos(self.alpha) - self.ce
+        delta_z = -self.p * np.sin(self.alpha)
+        ae2, be2 = self.ae**2, self.be**2
+        coeffs = (0, 1/ae2, 1/be2, 0, 2*delta_y/ae2, 2*delta_z/be2,
+                  delta_y**2/ae2 + delta_z**2/be2 - 1)
+        return self.intersect_quadric(coeffs, x, y, z, a, b, c)
+
     def local_n(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         delta_y = self.p * np.cos(self.alpha) - self.ce
@@ -1034,6 +1097,14 @@ class ParabolicMirror(OE):
     def local_z(self, x, y):
         return -np.sqrt(2 * self.pp * (y+self.delta_y)) - self.delta_z
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Intersections with the parabolic cylinder, both branches."""
+        if local_f is not None:
+            return
+        coeffs = (0, 0, 1, 0, -2*self.pp, 2*self.delta_z,
+                  self.delta_z**2 - 2*self.pp*self.delta_y)
+        return self.intersect_quadric(coeffs, x, y, z, a, b, c)
+
     def local_n(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         # delta_y = 0.5*self.p*(1+np.cos(self.alpha))
@@ -1451,6 +1522,19 @@ class ParaboloidFlatLens(Plate):
         """Determines the surface of OE at (x, y) position."""
         return 0  # just flat
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Intersections with the paraboloid, with the flat top at *zmax* and
+        with the flat side."""
+        if local_f is None:
+            return
+        if local_f.__name__ == 'local_z2':
+            return [-z / c]
+        coeffs = 0.25/self.focus, 0.25/self.focus, 0, 0, 0, -1, 0
+        candidates = list(self.intersect_quadric(coeffs, x, y, z, a, b, c))
+        if self.zmax is not None:
+            candidates.append((self.zmax - z) / c)
+        return candidates
+
     def local_n1(self, x, y):
         """Determines the normal vector of OE at (x, y) position. If OE is an
         asymmetric crystal, *local_n* must return 2 normals: the 1st one of the
@@ -3,11 +3,15 @@ __author__ = "Konstantin Klementiev, Roman Chernikov"
 __date__ = "03 Jul 2016"
 import os
 import time
+from collections import deque
 import numpy as np
 
 import matplotlib as mpl
 from .. import raycing
 from . import sources as rs
+from .sources_beams import rayFields
+from .distortions import DistortionMap
+from .materials import ResponseTable
 from . import myopencl as mcl
 from .physconsts import CH, CHBAR
 try:
@@ -29,6 +33,35 @@ def flatten(x):
         return [x]
 
 
+# the arrays that OE._reflect_local_rays creates anew for all rays and the
+# arrays they are initialized from (None for zeros):
+_newRayFields = (('theta', None), ('order', None),
+                 ('s', 'x'), ('phi', 'y'), ('r', 'z'))
+
+
+def _gather_rays(beam, ind):
+    """Returns a dense beam that holds the rays of *beam* indexed by *ind*."""
+    dense = rs.Beam(nrays=0, xyzOnly=True, packed=False)
+    newFields = [name for name, fromName in _newRayFields]
+    for name in rayFields:
+        if hasattr(beam, name) and name not in newFields:
+            setattr(dense, name, getattr(beam, name)[ind])
+    return dense
+
+
+def _scatter_rays(beam, dense, ind, sel=slice(None), renew=True):
+    """Puts the rays *sel* of the *dense* beam back to *beam* at the indices
+    *ind*. The arrays created in *dense* anew are created in *beam* too, if
+    *renew* is True or *beam* does not have them yet."""
+    for name, fromName in _newRayFields:
+        if hasattr(dense, name) and (renew or not hasattr(beam, name)):
+            setattr(beam, name, np.zeros_like(beam.x) if fromName is None
+                    else np.copy(getattr(beam, fromName)))
+    for name in rayFields:
+        if hasattr(dense, name):
+            getattr(beam, name)[ind] = getattr(dense, name)[sel]
+
+
 class OE(object):
     """The main base class for an optical element. It implements a generic flat
     mirror, crystal, multilayer or grating."""
@@ -67,7 +100,8 @@ class OE(object):
         limPhysY=[-raycing.maxHalfSizeOfOE, raycing.maxHalfSizeOfOE],
         limOptY=None, isParametric=False, shape='rect', order=None,
         shouldCheckCenter=False,
-            targetOpenCL=None, precisionOpenCL='float64'):
+            targetOpenCL=None, precisionOpenCL='float64', compactRays=0.5,
+            heightGrid=None, distortionMap=None, responseTable=None):
         u"""
         *bl*: instance of :class:`~xrt.backends.raycing.BeamLine`
             Container for beamline elements. Optical elements are added to its
@@ -190,6 +224,45 @@ class OE(object):
             with double precision are much slower. Double precision may be
             unavailable on your system.
 
+        *compactRays*: float
+            If the fraction of the incoming rays that hit the OE is below this
+            value, the rays are gathered into a dense beam before the search
+            for the intersections, the normals, the reflectivity and the
+            coherency matrix, and are scattered back to the full beam once at
+            the end. This saves the repeated masking of full length arrays,
+            e.g. when a slit or a narrow band crystal upstream leaves a small
+            fraction of rays alive. 0 disables the compaction, 1 (or larger)
+            always uses it. The results do not depend on this parameter.
+
+        *heightGrid*: None, int or 2-sequence of int
+            If given, the surface height (together with the distortion of
+            :meth:`local_z_distorted`) is tabulated on a coarse grid of this
+            many nodes in x and y over the physical limits, at the first
+            search for the intersections. The bracket [tMin, tMax] of every
+            ray is then bisected on the interpolated grid down to about one
+            grid cell before the iterative search, which saves iterations on
+            strongly curved or warped surfaces with a costly
+            :meth:`local_z`. A bracket is used only if it is confirmed by the
+            exact surface, so the grid affects the speed, not the result. Call
+            :meth:`clear_height_grids` after changing the surface. Ignored
+            for parametric surfaces.
+
+        *distortionMap*: None, str or instance of
+            :class:`~xrt.backends.raycing.distortions.DistortionMap`
+            A figure error map added to the ideal surface (a str is the name
+            of the map file), see :ref:`distorted`. It is used by the default
+            :meth:`local_z_distorted` and :meth:`local_n_distorted`. Not for
+            parametric surfaces.
+
+        *responseTable*: None, float or instance of
+            :class:`~xrt.backends.raycing.materials.ResponseTable`
+            If given, the complex amplitudes of the material (a mirror, plate
+            or lens :class:`~xrt.backends.raycing.materials.Material`, a
+            :class:`~xrt.backends.raycing.materials.Multilayer` or a
+            :class:`~xrt.backends.raycing.materials.Crystal`) are interpolated
+            in a table over energy and incidence angle instead of being
+            calculated per ray. A float is the accuracy of the amplitudes of a
+            new table. An instance can be shared by several OEs.
 
         """
         self.bl = bl
@@ -213,6 +286,17 @@ class OE(object):
         self.extraYaw = extraYaw
         self.extraRotationSequence = extraRotationSequence
         self.alarmLevel = alarmLevel
+        self.compactRays = compactRays
+        self._localTransforms = {}
+        self.intersectionStats = deque(maxlen=100)
+        self.heightGrid = heightGrid
+        self._heightGrids = {}
+        if isinstance(distortionMap, raycing.basestring):
+            distortionMap = DistortionMap(distortionMap)
+        self.distortionMap = distortionMap
+        if isinstance(responseTable, (int, float)):
+            responseTable = ResponseTable(responseTable)
+        self.responseTable = responseTable
 
         self.surface = surface
         self.material = material
@@ -314,7 +398,10 @@ class OE(object):
         return np.zeros_like(y)  # just flat
 
     def local_z_distorted(self, x, y):
-        return
+        """The figure error added to :meth:`local_z` at (*x*, *y*). By default
+        is taken from *distortionMap*, if any."""
+        if self.distortionMap is not None:
+            return self.distortionMap.get_height(x, y)
 
     def local_g(self, x, y, rho=-100.):
         """For a grating, gives the local reciprocal groove vector (without
@@ -350,8 +437,10 @@ class OE(object):
             return [a, b, c]
 
     def local_n_distorted(self, x, y):
-        """Angles d_pitch and d_roll."""
-        return
+        """Angles d_pitch and d_roll. By default are taken from
+        *distortionMap*, if any."""
+        if self.distortionMap is not None:
+            return self.distortionMap.get_angles(x, y)
 
     _h = 20.
 
@@ -417,6 +506,130 @@ class OE(object):
             dz = (a*surf[-3] + b*surf[-2] + c*surf[-1]) * invertNormal
         return dz, x, y, z
 
+    def intersect_analytic(self, local_f, x, y, z, a, b, c):
+        """Returns a sequence of arrays of candidate ray parameters *t* of the
+        intersections of the rays (*x*, *y*, *z*) + *t* (*a*, *b*, *c*) with
+        the surface *local_f* (None for :meth:`local_z`), or None if the
+        surface has no closed form solution. The candidates may lie on
+        either sheet of a quadric or approximate the surface; they are checked
+        and refined by :meth:`find_intersection`, NaN or out of bracket
+        candidates are discarded. Can be overridden in the derived classes
+        together with :meth:`local_z`; the base class solves for the flat
+        surface."""
+        if local_f is None:
+            return [-z / c]
+
+    def intersect_quadric(self, coeffs, x, y, z, a, b, c):
+        """A helper for :meth:`intersect_analytic`. Returns the two roots
+        (NaN if complex, the smaller one first) of the intersection of the
+        rays with the quadric surface
+        Axx*x² + Ayy*y² + Azz*z² + Bx*x + By*y + Bz*z + C = 0 given by
+        *coeffs* = (Axx, Ayy, Azz, Bx, By, Bz, C)."""
+        Axx, Ayy, Azz, Bx, By, Bz, C = coeffs
+        qa = Axx*a**2 + Ayy*b**2 + Azz*c**2
+        qb = 2*(Axx*x*a + Ayy*y*b + Azz*z*c) + Bx*a + By*b + Bz*c
+        qc = Axx*x**2 + Ayy*y**2 + Azz*z**2 + Bx*x + By*y + Bz*z + C
+        with np.errstate(divide='ignore', invalid='ignore'):
+            q = -0.5 * (qb + np.where(qb < 0, -1, 1) *
+                        np.sqrt(qb**2 - 4*qa*qc))
+            t1, t2 = q / qa, qc / q
+        return np.minimum(t1, t2), np.maximum(t1, t2)
+
+    def _is_analytic(self, local_f):
+        """Tells whether :meth:`intersect_analytic` is valid for the surface
+        *local_f*, i.e. that the surface function is not overridden below the
+        class that implements :meth:`intersect_analytic` and that the surface
+        is distorted neither by an overridden :meth:`local_z_distorted` nor by
+        *distortionMap*."""
+        if self.isParametric:
+            return False
+        cls = type(self)
+        if cls.local_z_distorted != OE.local_z_distorted or\
+                self.distortionMap is not None:
+            return False
+        name = 'local_z' if local_f is None else local_f.__name__
+        for owner in cls.__mro__:
+            if 'intersect_analytic' in owner.__dict__:
+                break
+        return getattr(cls, name, None) == getattr(owner, name, 0)
+
+    def _find_intersection_analytic(self, local_f, t1, t2, x, y, z, a, b, c,
+                                    invertNormal):
+        """Finds the intersections by :meth:`intersect_analytic`. As in the
+        iterative search, the rays below the surface at *t1* get *t1* and the
+        rays above it at *t2* get *t2*. For the others, the candidates are
+        refined by Newton steps with the surface normal and accepted if they
+        are within the bracketing [*t1*, *t2*], are at the surface within
+        raycing.zEps and cross it from above, i.e. the height of the ray over
+        the surface decreases there as it does from *t1* to *t2*; this
+        rejects the crossings with the other sheets of the closed form
+        surface. The rays left without an accepted candidate go to the
+        iterative search."""
+        dz1, x1, y1, z1 = self.find_dz(
+            local_f, t1, x, y, z, a, b, c, invertNormal)
+        dz2, x2, y2, z2 = self.find_dz(
+            local_f, t2, x, y, z, a, b, c, invertNormal)
+        t, xt, yt, zt = np.copy(t1), x1, y1, z1
+        over = (dz1 > 0) & (dz2 >= 0)  # for them the solution is t2
+        t[over], xt[over], yt[over], zt[over] = \
+            t2[over], x2[over], y2[over], z2[over]
+        rays = np.flatnonzero((dz1 > 0) & (dz2 < 0))
+        if len(rays) == 0:
+            self.intersectionStats.append(dict(
+                method='analytic', nrays=len(t), searched=0, iterations=0,
+                remaining=[0], unconverged=0))
+            return t, xt, yt, zt
+        with np.errstate(divide='ignore', invalid='ignore'):
+            candidates = self.intersect_analytic(
+                local_f, x[rays], y[rays], z[rays],
+                a[rays], b[rays], c[rays])
+        if candidates is None:
+            candidates = []
+        else:  # the nearest intersections are tried first, NaNs go last
+            candidates = np.sort([np.array(tc, dtype=float) * np.ones(
+                len(rays)) for tc in candidates], axis=0)
+        local_n = self.local_n if local_f is None else\
+            getattr(self, local_f.__name__.replace('_z', '_n'))
+        todo = np.ones(len(rays), dtype=bool)
+        remaining = [len(rays)]
+        numit = 0
+        for tc in candidates:
+            j = np.flatnonzero(todo & (tc >= t1[rays]) & (tc <= t2[rays]))
+            ind, tc = rays[j], tc[j]
+            for iNewton in range(raycing.maxNewtonIteration + 1):
+                dz, xc, yc, zc = self.find_dz(
+                    local_f, tc, x[ind], y[ind], z[ind], a[ind], b[ind],
+                    c[ind], invertNormal)
+                far = abs(dz) > raycing.zEps
+                if not far.any() or iNewton == raycing.maxNewtonIteration:
+                    break
+                n = local_n(xc[far], yc[far])
+                ddz = (a[ind[far]]*n[-3] + b[ind[far]]*n[-2] +
+                       c[ind[far]]*n[-1]) / n[-1] * invertNormal
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    tc[far] -= dz[far] / ddz
+            numit = max(numit, iNewton)
+            n = local_n(xc, yc)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ddz = (a[ind]*n[-3] + b[ind]*n[-2] + c[ind]*n[-1]) / n[-1] *\
+                    invertNormal
+            good = ~far & (tc >= t1[ind]) & (tc <= t2[ind]) & (ddz < 0)
+            ind = ind[good]
+            t[ind], xt[ind], yt[ind], zt[ind] = \
+                tc[good], xc[good], yc[good], zc[good]
+            todo[j[good]] = False
+            remaining.append(int(todo.sum()))
+        rest = rays[todo]
+        self.intersectionStats.append(dict(
+            method='analytic', nrays=len(t), searched=len(rays),
+            iterations=numit, remaining=remaining, unconverged=len(rest)))
+        if len(rest) > 0:
+            t[rest], xt[rest], yt[rest], zt[rest] = \
+                self._find_intersection_iterative(
+                    local_f, t1[rest], t2[rest], x[rest], y[rest], z[rest],
+                    a[rest], b[rest], c[rest], invertNormal)
+        return t, xt, yt, zt
+
     def find_intersection(self, local_f, t1, t2, x, y, z, a, b, c,
                           invertNormal, derivOrder=0):
         """Finds the ray parameter *t* at the intersection point with the
@@ -424,7 +637,27 @@ class OE(object):
         determined by its origin point (*x*, *y*, *z*) and its normalized
         direction (*a*, *b*, *c*). *t* is then the distance between the origin
         point and the intersection point. *derivOrder* tells if minimized is
-        the z-difference (=0) or its derivative (=1)."""
+        the z-difference (=0) or its derivative (=1). The intersections with
+        the surfaces that have :meth:`intersect_analytic` are found in
+        closed form, the others iteratively.
+
+        Every search appends a dict to *self.intersectionStats* (a deque of
+        the recent searches) with the keys: *method* ('analytic', 'secant' or
+        'Brent'), *nrays*, *searched* (the number of rays that needed a
+        search), *iterations* (Newton steps for 'analytic'), *remaining* (the
+        number of not converged rays before the 1st and after every iteration,
+        after every candidate for 'analytic') and *unconverged* (the rays
+        left at maxIteration or passed from 'analytic' to the iterative
+        search). It helps to tune raycing.zEps and raycing.maxIteration."""
+        if derivOrder == 0 and self._is_analytic(local_f):
+            return self._find_intersection_analytic(
+                local_f, t1, t2, x, y, z, a, b, c, invertNormal)
+        return self._find_intersection_iterative(
+            local_f, t1, t2, x, y, z, a, b, c, invertNormal, derivOrder)
+
+    def _find_intersection_iterative(self, local_f, t1, t2, x, y, z, a, b, c,
+                                     invertNormal, derivOrder=0):
+        """The iterative search of :meth:`find_intersection`."""
         dz1, x1, y1, z1 = self.find_dz(
             local_f, t1, x, y, z, a, b, c, invertNormal, derivOrder)
         dz2, x2, y2, z2 = self.find_dz(
@@ -440,22 +673,142 @@ class OE(object):
         y2[ind1] = y1[ind1]
         z2[ind1] = z1[ind1]
         ind = ~(ind1 | ind2)  # good rays
+        if self.heightGrid is not None and derivOrder == 0 and\
+                not self.isParametric and ind.sum() > 0:
+            self._bracket_on_height_grid(
+                local_f, t1, t2, x, y, z, a, b, c, invertNormal,
+                dz1, dz2, x2, y2, z2, ind)
         if abs(dz2).max() > abs(dz1).max()*20:
-            t2, x2, y2, z2, numit = self._use_Brent_method(
+            method = 'Brent'
+            t2, x2, y2, z2, numit, remaining = self._use_Brent_method(
                 local_f, t1, t2, x, y, z, a, b, c, invertNormal, derivOrder,
                 dz1, dz2, tMin, tMax, x2, y2, z2, ind)
         else:
-            t2, x2, y2, z2, numit = self._use_my_method(
+            method = 'secant'
+            t2, x2, y2, z2, numit, remaining = self._use_my_method(
                 local_f, t1, t2, x, y, z, a, b, c, invertNormal, derivOrder,
                 dz1, dz2, tMin, tMax, x2, y2, z2, ind)
+        self.intersectionStats.append(dict(
+            method=method, nrays=len(t2), searched=int(ind.sum()),
+            iterations=numit, remaining=remaining,
+            unconverged=remaining[-1]))
         if numit == raycing.maxIteration and _DEBUG:
-            nn = ind.sum()
+            nn = remaining[-1]
             print('maxIteration is reached for {0} ray{1}!!!'.format(
                   nn, 's' if nn > 1 else ''))
         if _DEBUG:
             print('numit=', numit)
         return t2, x2, y2, z2
 
+    def get_height_grid(self, local_f=None):
+        """Returns the coarse height grid of the surface *local_f* (None for
+        :meth:`local_z`) as a tuple (x0, dx, y0, dy, heights, heightError),
+        where *heights* is a 2D array of shape (len(x), len(y)) that includes
+        the distortion of :meth:`local_z_distorted` and *heightError* is the
+        max deviation of the bilinear interpolation from the surface at the
+        cell centers. The grid is calculated once
+        and cached, see *heightGrid* in the constructor."""
+        name = 'local_z' if local_f is None else local_f.__name__
+        if name in self._heightGrids:
+            return self._heightGrids[name]
+        if local_f is None:
+            local_f = self.local_z
+        if raycing.is_sequence(self.heightGrid):
+            nx, ny = self.heightGrid
+        else:
+            nx = ny = self.heightGrid
+        if name.endswith('2') and hasattr(self, 'surfPhysX2'):
+            limX, limY = self.surfPhysX2, self.surfPhysY2
+        else:
+            self.get_surface_limits()
+            limX, limY = self.surfPhysX, self.surfPhysY
+        limX = [np.clip(lim, -raycing.maxHalfSizeOfOE, raycing.maxHalfSizeOfOE)
+                for lim in limX]
+        limY = [np.clip(lim, -raycing.maxHalfSizeOfOE, raycing.maxHalfSizeOfOE)
+                for lim in limY]
+        xg = np.linspace(limX[0], limX[1], max(nx, 2))
+        yg = np.linspace(limY[0], limY[1], max(ny, 2))
+        xm, ym = [m.ravel() for m in np.meshgrid(xg, yg, indexing='ij')]
+        heights = np.zeros_like(xm) + local_f(xm, ym)
+        z_distorted = self.local_z_distorted(xm, ym)
+        if z_distorted is not None:
+            heights += z_distorted
+        heights[np.isnan(heights)] = 0
+        heights = heights.reshape(len(xg), len(yg))
+# the interpolation error is estimated at the cell centers:
+        xm, ym = [m.ravel() for m in np.meshgrid(
+            (xg[1:]+xg[:-1])*0.5, (yg[1:]+yg[:-1])*0.5, indexing='ij')]
+        centers = np.zeros_like(xm) + local_f(xm, ym)
+        z_distorted = self.local_z_distorted(xm, ym)
+        if z_distorted is not None:
+            centers += z_distorted
+        centers -= 0.25 * (heights[:-1, :-1] + heights[1:, :-1] +
+                           heights[:-1, 1:] + heights[1:, 1:]).ravel()
+        heightError = np.nanmax(abs(centers))
+        grid = (xg[0], xg[1]-xg[0], yg[0], yg[1]-yg[0], heights, heightError)
+        self._heightGrids[name] = grid
+        return grid
+
+    def clear_height_grids(self):
+        """Forgets the cached height grids, to be called after the surface
+        has been changed."""
+        self._heightGrids.clear()
+
+    def _bracket_on_height_grid(
+            self, local_f, t1, t2, x, y, z, a, b, c, invertNormal,
+            dz1, dz2, x2, y2, z2, ind):
+        """Narrows the brackets [*t1*, *t2*] of the rays *ind* in place by
+        bisecting them on the bilinearly interpolated height grid down to
+        about one grid cell. The narrowed bracket, widened on both sides, is
+        taken if the exact surface confirms the sign change of
+        dz at its ends. The margin is widened further by the interpolation
+        error of the grid."""
+        x0, dx, y0, dy, heights, heightError = self.get_height_grid(local_f)
+        nx, ny = heights.shape
+        rays = np.flatnonzero(ind)
+        ta, tb = t1[rays], t2[rays]
+        xr, yr, zr, ar, br, cr = \
+            x[rays], y[rays], z[rays], a[rays], b[rays], c[rays]
+
+        flat = heights.ravel()
+
+        def grid_dz(t):
+            fx = np.clip((xr + ar*t - x0) / dx, 0, nx-1.000001)
+            fy = np.clip((yr + br*t - y0) / dy, 0, ny-1.000001)
+            ix, iy = fx.astype(int), fy.astype(int)
+            fx -= ix
+            fy -= iy
+            k = ix*ny + iy
+            h0 = flat[k]
+            h0 += (flat[k+ny] - h0) * fx
+            h1 = flat[k+1]
+            h1 += (flat[k+ny+1] - h1) * fx
+            h0 += (h1 - h0) * fy
+            return (zr + cr*t - h0) * invertNormal
+
+        with np.errstate(divide='ignore'):  # a = b = 0 or c = 0
+# the ray advances by < 1 grid cell over the bracket of width cellT:
+            cellT = 1. / np.maximum(abs(ar/dx), abs(br/dy))
+            margin = cellT + 2*heightError/abs(cr)
+        nBisect = int(np.ceil(np.log2(max(((tb-ta)/cellT).max(), 1))))
+        newA, newB = np.copy(ta), np.copy(tb)
+        for i in range(nBisect):
+            tm = (newA + newB) * 0.5
+            above = grid_dz(tm) > 0
+            newA[above] = tm[above]
+            newB[~above] = tm[~above]
+        newA = np.maximum(newA - margin, ta)
+        newB = np.minimum(newB + margin, tb)
+        dzA, xA, yA, zA = self.find_dz(
+            local_f, newA, xr, yr, zr, ar, br, cr, invertNormal)
+        dzB, xB, yB, zB = self.find_dz(
+            local_f, newB, xr, yr, zr, ar, br, cr, invertNormal)
+        ok = (dzA > 0) & (dzB < 0)
+        rok = rays[ok]
+        t1[rok], dz1[rok] = newA[ok], dzA[ok]
+        t2[rok], dz2[rok] = newB[ok], dzB[ok]
+        x2[rok], y2[rok], z2[rok] = xB[ok], yB[ok], zB[ok]
+
     def find_intersection_CL(self, local_f, t1, t2, x, y, z, a, b, c,
                              invertNormal, derivOrder=0):
         """Finds the ray parameter *t* at the intersection point with the
@@ -505,28 +858,41 @@ class OE(object):
     def _use_my_method(
         self, local_f, t1, t2, x, y, z, a, b, c, invertNormal, derivOrder,
             dz1, dz2, tMin, tMax, x2, y2, z2, ind):
+        """The secant method with bracketing. Works on the compacted arrays
+        of the rays that have not converged yet; the converged rays are
+        written back to *t2*, *x2*, *y2*, *z2* once. Returns also the number
+        of iterations and the list of the numbers of not converged rays."""
         numit = 2
-        while (ind.sum() > 0) and (numit < raycing.maxIteration):
-            t = t1[ind]
-            dz = dz1[ind]
-            t1[ind] = t2[ind]
-            dz1[ind] = dz2[ind]
-            t2[ind] = t - (t1[ind]-t) * dz / (dz1[ind]-dz)
-            swap = t2[ind] < tMin
-            t2[np.where(ind)[0][swap]] = tMin
-            swap = t2[ind] > tMax
-            t2[np.where(ind)[0][swap]] = tMax
-            dz2[ind], x2[ind], y2[ind], z2[ind] = self.find_dz(
-                local_f, t2[ind], x[ind], y[ind], z[ind],
-                a[ind], b[ind], c[ind], invertNormal, derivOrder)
-            # swapping using duble slicing:
-            swap = np.sign(dz2[ind]) == np.sign(dz1[ind])
-            t1[np.where(ind)[0][swap]] = t[swap]
-            dz1[np.where(ind)[0][swap]] = dz[swap]
-            ind = ind & (abs(dz2) > raycing.zEps)
+        act = np.flatnonzero(ind)
+        t1a, t2a, dz1a, dz2a = t1[act], t2[act], dz1[act], dz2[act]
+        xa, ya, za, aa, ba, ca = x[act], y[act], z[act], a[act], b[act], c[act]
+        remaining = [len(act)]
+        while (len(act) > 0) and (numit < raycing.maxIteration):
+            t = t1a
+            dz = dz1a
+            t1a = t2a
+            dz1a = dz2a
+            t2a = t - (t1a-t) * dz / (dz1a-dz)
+            t2a[t2a < tMin] = tMin
+            t2a[t2a > tMax] = tMax
+            dz2a, x2a, y2a, z2a = self.find_dz(
+                local_f, t2a, xa, ya, za, aa, ba, ca, invertNormal, derivOrder)
+            swap = np.sign(dz2a) == np.sign(dz1a)
+            t1a[swap] = t[swap]
+            dz1a[swap] = dz[swap]
             numit += 1
+            left = abs(dz2a) > raycing.zEps
+            done = act[~left] if numit < raycing.maxIteration else act
+            done_a = ~left if numit < raycing.maxIteration else slice(None)
+            t2[done], x2[done], y2[done], z2[done] = \
+                t2a[done_a], x2a[done_a], y2a[done_a], z2a[done_a]
+            act, t1a, t2a, dz1a, dz2a = \
+                act[left], t1a[left], t2a[left], dz1a[left], dz2a[left]
+            xa, ya, za, aa, ba, ca = \
+                xa[left], ya[left], za[left], aa[left], ba[left], ca[left]
+            remaining.append(len(act))
 # t2 holds the ray parameter at the intersection point
-        return t2, x2, y2, z2, numit
+        return t2, x2, y2, z2, numit, remaining
 
     def _use_Brent_method(self, local_f, t1, t2, x, y, z, a, b, c,
                           invertNormal, derivOrder, dz1, dz2, tMin, tMax,
@@ -545,23 +911,29 @@ class OE(object):
 
         A description of the Brent's method can be found at
         http://en.wikipedia.org/wiki/Brent%27s_method.
+
+        As in :meth:`_use_my_method`, the iterations run on the compacted
+        arrays of the not converged rays.
         """
-        swap = abs(dz1[ind]) < abs(dz2[ind])
+        act = np.flatnonzero(ind)
+        xa, xb, fa, fb = t1[act], t2[act], dz1[act], dz2[act]
+        swap = abs(fa) < abs(fb)
         if swap.sum() > 0:
-            t1[np.where(ind)[0][swap]], t2[np.where(ind)[0][swap]] =\
-                t2[np.where(ind)[0][swap]], t1[np.where(ind)[0][swap]]
-            dz1[np.where(ind)[0][swap]], dz2[np.where(ind)[0][swap]] =\
-                dz2[np.where(ind)[0][swap]], dz1[np.where(ind)[0][swap]]
-        t3 = np.copy(t1)  # c:=a
-        dz3 = np.copy(dz1)  # f(c)
-        t4 = np.zeros_like(t1)  # d
-        mflag = np.ones_like(t1, dtype='bool')
+            xa[swap], xb[swap] = xb[swap], xa[swap]
+            fa[swap], fb[swap] = fb[swap], fa[swap]
+            t2[act] = xb
+        xc = np.copy(xa)  # c:=a
+        fc = np.copy(fa)  # f(c)
+        xd = np.zeros_like(xa)  # d
+        mf = np.ones_like(xa, dtype='bool')
         numit = 2
-        ind = ind & (abs(dz2) > raycing.zEps)
-        while (ind.sum() > 0) and (numit < raycing.maxIteration):
-            xa, xb, xc, xd = t1[ind], t2[ind], t3[ind], t4[ind]
-            fa, fb, fc = dz1[ind], dz2[ind], dz3[ind]
-            mf = mflag[ind]
+        left = abs(fb) > raycing.zEps
+        act, xa, xb, xc, xd, fa, fb, fc, mf = act[left], xa[left], \
+            xb[left], xc[left], xd[left], fa[left], fb[left], fc[left], \
+            mf[left]
+        rx, ry, rz, ra, rb, rc = x[act], y[act], z[act], a[act], b[act], c[act]
+        remaining = [len(act)]
+        while (len(act) > 0) and (numit < raycing.maxIteration):
             xs = np.empty_like(xa)
             inq = (fa != fc) & (fb != fc)
             if inq.sum() > 0:
@@ -593,12 +965,11 @@ class OE(object):
             xs[conds] = (xa[conds] + xb[conds]) / 2.
             mf = conds
 
-            fs, x2[ind], y2[ind], z2[ind] = self.find_dz(
-                local_f, xs, x[ind], y[ind], z[ind], a[ind], b[ind], c[ind],
-                invertNormal, derivOrder)
-            xd[:] = xc[:]
-            xc[:] = xb[:]
-            fc[:] = fb[:]
+            fs, xsx, xsy, xsz = self.find_dz(
+                local_f, xs, rx, ry, rz, ra, rb, rc, invertNormal, derivOrder)
+            xd = xc
+            xc = np.copy(xb)
+            fc = np.copy(fb)
             fafsNeg = ((fa < 0) & (fs > 0)) | ((fa > 0) & (fs < 0))
             xb[fafsNeg] = xs[fafsNeg]
             fb[fafsNeg] = fs[fafsNeg]
@@ -608,14 +979,21 @@ class OE(object):
             swap = abs(fa) < abs(fb)
             xa[swap], xb[swap] = xb[swap], xa[swap]
             fa[swap], fb[swap] = fb[swap], fa[swap]
-            t1[ind], t2[ind], t3[ind], t4[ind] = xa, xb, xc, xd
-            dz1[ind], dz2[ind], dz3[ind] = fa, fb, fc
-            mflag[ind] = mf
 
-            ind = ind & (abs(dz2) > raycing.zEps)
             numit += 1
+            left = abs(fb) > raycing.zEps
+            done = act[~left] if numit < raycing.maxIteration else act
+            done_a = ~left if numit < raycing.maxIteration else slice(None)
+            t2[done], x2[done], y2[done], z2[done] = \
+                xb[done_a], xsx[done_a], xsy[done_a], xsz[done_a]
+            act, xa, xb, xc, xd, fa, fb, fc, mf = act[left], xa[left], \
+                xb[left], xc[left], xd[left], fa[left], fb[left], fc[left], \
+                mf[left]
+            rx, ry, rz, ra, rb, rc = \
+                rx[left], ry[left], rz[left], ra[left], rb[left], rc[left]
+            remaining.append(len(act))
 # t2 holds the ray parameter at the intersection point
-        return t2, x2, y2, z2, numit
+        return t2, x2, y2, z2, numit, remaining
 
     def get_surface_limits(self):
         """Returns surface_limits."""
@@ -762,6 +1140,7 @@ class OE(object):
         .. .. Returned values: beamGlobal, beamLocal
         """
         self.get_orientation()
+        beam = rs.double_precision(beam)
         # output beam in global coordinates
         gb = rs.Beam(copyFrom=beam)
         if needLocal:
@@ -771,7 +1150,7 @@ class OE(object):
             lb = gb
         good = beam.state > 0
         if good.sum() == 0:
-            return gb, lb
+            return rs.apply_precision(gb, lb)
 # coordinates in local virgin system:
         pitch = self.pitch
         if hasattr(self, 'bragg'):
@@ -791,10 +1170,12 @@ class OE(object):
         if notGood.sum() > 0:
             rs.copy_beam(gb, beam, notGood)
 
-        return gb, lb  # in global(gb) and local(lb) coordinates
+        # in global(gb) and local(lb) coordinates:
+        return rs.apply_precision(gb, lb)
 
     def multiple_reflect(
-            self, beam=None, maxReflections=1000, needElevationMap=False):
+            self, beam=None, maxReflections=1000, needElevationMap=False,
+            footprintHistogram=None):
         """
         Does the same as :meth:`reflect` but with up to *maxReflections*
         reflection on the same surface. *way* gives the sequence of rotations
@@ -807,57 +1188,107 @@ class OE(object):
         points, *elevationX*, *elevationY*, *elevationZ* for the coordinates
         of the maximum elevation points.
 
+        After the 1st reflection, only the rays that are still bouncing are
+        traced, in a dense beam that shrinks with every reflection. The local
+        beam holds the footprints of all the reflections: all the incoming
+        rays at the 1st reflection and the rays that still bounce at the
+        following ones. Its attribute *nReflRays* is the list of the numbers
+        of rays per reflection, which gives the offsets of the reflections in
+        its arrays.
+
+        *footprintHistogram*: None or dict
+            If given, the footprints are not stored. Instead, 2D histograms of
+            the impact points of the good rays (states 1 and 2) over all the
+            reflections are accumulated, as with ``numpy.histogram2d``
+            of the dict items *bins* (default 100) and *range* (default: the
+            physical limits of the surface). The returned local beam is then
+            the beam at the last reflection of every ray with the attributes
+            *footprintCounts* and *footprintIntensity* (the histograms of the
+            impact numbers and of Jss+Jpp), *footprintEdges* (the bin edges
+            in x and y) and *nReflRays*.
+
         .. Returned values: beamGlobal, beamLocal
         """
         self.get_orientation()
+        beam = rs.double_precision(beam)
 # output beam in global coordinates
         gb = rs.Beam(copyFrom=beam)
         lb = gb
         good = beam.state > 0
         if good.sum() == 0:
-            return gb, lb
+            return rs.apply_precision(gb, lb)
 # coordinates in local virgin system:
         raycing.global_to_virgin_local(self.bl, beam, lb, self.center, good)
-        iRefl = 0
-        isMulti = False
-        while iRefl <= maxReflections:
-            tmpX, tmpY, tmpZ =\
-                np.copy(lb.x[good]), np.copy(lb.y[good]), np.copy(lb.z[good])
+        if needElevationMap:
+            lb.elevationD = -np.ones_like(lb.x)
+            lb.elevationX = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
+            lb.elevationY = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
+            lb.elevationZ = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
+        if footprintHistogram is None:
+            lbN = rs.BeamBuffer(len(beam.x))
+        else:
+            hist = self._start_footprint_histogram(footprintHistogram)
+        nReflRays = []
+
+        def add_footprints(b):
+            nReflRays.append(len(b.x))
+            if footprintHistogram is None:
+                lbN.append(b)
+            else:
+                self._add_footprint_histogram(hist, b)
+
+# the 1st reflection is done on the whole beam:
+        tmpX, tmpY, tmpZ =\
+            np.copy(lb.x[good]), np.copy(lb.y[good]), np.copy(lb.z[good])
+        self._reflect_local(good, lb, gb, self.pitch,
+                            self.roll+self.positionRoll, self.yaw,
+                            self.dx, material=self.material,
+                            needElevationMap=needElevationMap)
+        lb.nRefl = np.zeros_like(lb.state)
+        ov = lb.state[good] == 3
+        lb.x[np.where(good)[0][ov]] = tmpX[ov]
+        lb.y[np.where(good)[0][ov]] = tmpY[ov]
+        lb.z[np.where(good)[0][ov]] = tmpZ[ov]
+        good = (lb.state == 1) | (lb.state == 2)
+        lb.nRefl[good] += 1
+        add_footprints(lb)
+        iRefl = 1
+# the following reflections are done on the dense beam of the bouncing rays,
+# the rays that stop bouncing are put back to lb once:
+        active = np.flatnonzero(good)
+        db = _gather_rays(lb, active)
+        while iRefl <= maxReflections and len(active) > 0:
             if _DEBUG:
                 print('reflection No {0}'.format(iRefl + 1))
-            if iRefl == 0:
-                if needElevationMap:
-                    lb.elevationD = -np.ones_like(lb.x)
-                    lb.elevationX = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
-                    lb.elevationY = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
-                    lb.elevationZ = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
-            self._reflect_local(good, lb, gb, self.pitch,
-                                self.roll+self.positionRoll, self.yaw,
-                                self.dx, material=self.material,
+            tmpX, tmpY, tmpZ = np.copy(db.x), np.copy(db.y), np.copy(db.z)
+            self._reflect_local(np.ones(len(active), dtype=bool), db, db,
+                                self.pitch, self.roll+self.positionRoll,
+                                self.yaw, self.dx, material=self.material,
                                 needElevationMap=needElevationMap,
-                                isMulti=isMulti)
-            if iRefl == 0:
-                isMulti = True
-                lb.nRefl = np.zeros_like(lb.state)
-            ov = lb.state[good] == 3
-            lb.x[np.where(good)[0][ov]] = tmpX[ov]
-            lb.y[np.where(good)[0][ov]] = tmpY[ov]
-            lb.z[np.where(good)[0][ov]] = tmpZ[ov]
-            good = (lb.state == 1) | (lb.state == 2)
-            lb.nRefl[good] += 1
-            if iRefl == 0:
-                # all local footprints:
-                lbN = rs.Beam(copyFrom=lb, withNumberOfReflections=True)
-            else:
-                lbN.concatenate(lb)
+                                isMulti=True)
+            ov = db.state == 3
+            db.x[ov], db.y[ov], db.z[ov] = tmpX[ov], tmpY[ov], tmpZ[ov]
+            still = (db.state == 1) | (db.state == 2)
+            db.nRefl[still] += 1
+            add_footprints(db)
             iRefl += 1
             if _DEBUG:
-                print('iRefl=', iRefl, 'remains=', good.sum())
-#                if good.sum() > 0:
-#                    print('y min max ', lb.y[good].min(), lb.y[good].max())
-            if good.sum() == 0:
-                break
-#            gc.collect()
+                print('iRefl=', iRefl, 'remains=', still.sum())
+            stop = ~still
+            if stop.any():
+                _scatter_rays(lb, db, active[stop], stop, renew=False)
+                active = active[still]
+                db = _gather_rays(db, still) if len(active) > 0 else None
+        if len(active) > 0:
+            _scatter_rays(lb, db, active, renew=False)
+
+        if footprintHistogram is None:
+            lbN = lbN.get_beam()
+        else:
+            lbN = rs.Beam(copyFrom=lb)
+            (lbN.footprintCounts, lbN.footprintIntensity,
+             lbN.footprintEdges) = hist
+        lbN.nReflRays = nReflRays
 # in global coordinate system:
         goodAfter = gb.nRefl > 0
         gb.state[goodAfter] = 1
@@ -868,7 +1299,55 @@ class OE(object):
         if notGood.sum() > 0:
             rs.copy_beam(gb, beam, notGood)
 # in global(gb) and local(lbN) coordinates. lbN holds all the reflection spots.
-        return gb, lbN
+        return rs.apply_precision(gb, lbN)
+
+    def _start_footprint_histogram(self, footprintHistogram):
+        """Returns the empty histograms and the bin edges for the
+        *footprintHistogram* of :meth:`multiple_reflect`."""
+        bins = footprintHistogram.get('bins', 100)
+        hRange = footprintHistogram.get('range')
+        if hRange is None:
+            self.get_surface_limits()
+            hRange = [np.clip(lim, -raycing.maxHalfSizeOfOE,
+                              raycing.maxHalfSizeOfOE)
+                      for lim in (self.surfPhysX, self.surfPhysY)]
+        counts, xEdges, yEdges = np.histogram2d([], [], bins, hRange)
+        return counts, np.zeros_like(counts), (xEdges, yEdges)
+
+    def _add_footprint_histogram(self, hist, beam):
+        """Adds the good impact points of *beam* to the histograms *hist*."""
+        counts, intensity, edges = hist
+        good = (beam.state == 1) | (beam.state == 2)
+        x, y = beam.x[good], beam.y[good]
+        counts += np.histogram2d(x, y, edges)[0]
+        intensity += np.histogram2d(
+            x, y, edges, weights=beam.Jss[good]+beam.Jpp[good])[0]
+
+    def get_local_transform(self, pitch, roll, yaw, dx=None, dy=None,
+                            dz=None):
+        """Returns the matrix and shift of the transformation from the virgin
+        local to the true local system (see :func:`raycing.rotate_vectors`):
+        the rotations by -*pitch*, -*roll*, -*yaw* and by the negative extra
+        angles followed by the translation by -(*dx*, *dy*, *dz*). The
+        transformations are cached by the orientation of the OE."""
+        key = (self.rotationSequence, pitch, roll, yaw, dx, dy, dz,
+               self.extraRotationSequence, self.extraPitch, self.extraRoll,
+               self.extraYaw)
+        try:
+            return self._localTransforms[key]
+        except KeyError:
+            pass
+        matrix = raycing.rotation_matrix(
+            self.rotationSequence, -pitch, -roll, -yaw)
+        if self.extraPitch or self.extraRoll or self.extraYaw:
+            matrix = np.dot(raycing.rotation_matrix(
+                self.extraRotationSequence, -self.extraPitch,
+                -self.extraRoll, -self.extraYaw), matrix)
+        shift = -np.array([dx or 0, dy or 0, dz or 0], dtype=float)
+        if len(self._localTransforms) > 64:
+            self._localTransforms.clear()
+        self._localTransforms[key] = matrix, shift
+        return matrix, shift
 
     def local_to_global(self, lb, **kwargs):
         if self.extraPitch or self.extraRoll or self.extraYaw:
@@ -914,7 +1393,7 @@ class OE(object):
         from . import waves as rw
 
         lb = rs.Beam(nrays=nrays, forceState=1, withAmplitudes=True)
-        xy = np.random.rand(nrays, 2)
+        xy = raycing.get_rng().random((nrays, 2))
         if shape.startswith('ro'):  # round
             dR = (self.limPhysX[1] - self.limPhysX[0]) / 2
             r = xy[:, 0]**0.5 * dR
@@ -1028,8 +1507,8 @@ class OE(object):
         if isinstance(order, int):
             locOrder = order
         else:
-            locOrder = np.array(order)[np.random.randint(len(order),
-                                       size=goodN.sum())]
+            locOrder = np.array(order)[raycing.get_rng().integers(
+                len(order), size=goodN.sum())]
         lb.order = np.zeros(len(lb.a))
         lb.order[goodN] = locOrder
         orderLambda = locOrder * CH / lb.E[goodN] * 1e-7
@@ -1054,13 +1533,14 @@ class OE(object):
                   nanSum, strName, self.name))
 
     def local_n_random(self, bLength, chi):
+        rng = raycing.get_rng()
         a = np.zeros(bLength)
         b = np.zeros(bLength)
         c = np.ones(bLength)
 
-        cos_range = np.random.rand(bLength)  # * 2**-0.5
+        cos_range = rng.random(bLength)  # * 2**-0.5
         y_angle = np.arccos(cos_range)
-        z_angle = (chi[1]-chi[0]) * np.random.rand(bLength) + chi[0]
+        z_angle = (chi[1]-chi[0]) * rng.random(bLength) + chi[0]
 
         a, c = raycing.rotate_y(a, c, np.cos(y_angle), np.sin(y_angle))
         a, b = raycing.rotate_z(a, b, np.cos(z_angle), np.sin(z_angle))
@@ -1164,25 +1644,46 @@ class OE(object):
         interface. *material* is an instance of :class:`Material` or
         :class:`Crystal` or its derivatives. Depending on the geometry used, it
         must have either the method :meth:`get_refractive_index` or the
-        :meth:`get_amplitude`."""
+        :meth:`get_amplitude`.
+
+        If the fraction of *good* rays is below *compactRays*, the good rays
+        are gathered into dense beams, processed by
+        :meth:`_reflect_local_rays` with all rays good and scattered back."""
+        kw = dict(local_z=local_z, local_n=local_n, local_g=local_g,
+                  fromVacuum=fromVacuum, material=material,
+                  is2ndXtal=is2ndXtal, needElevationMap=needElevationMap,
+                  noIntersectionSearch=noIntersectionSearch, isMulti=isMulti)
+        ind = np.flatnonzero(good)
+        if len(ind) >= self.compactRays * len(lb.x):
+            self._reflect_local_rays(
+                good, lb, vlb, pitch, roll, yaw, dx, dy, dz, **kw)
+        else:
+            clb = _gather_rays(lb, ind)
+            cvlb = clb if vlb is lb else _gather_rays(vlb, ind)
+            self._reflect_local_rays(
+                np.ones(len(ind), dtype=bool), clb, cvlb, pitch, roll, yaw,
+                dx, dy, dz, **kw)
+            _scatter_rays(lb, clb, ind)
+            if vlb is not lb:
+                _scatter_rays(vlb, cvlb, ind)
+
+        if self.alarmLevel is not None:
+            raycing.check_alarm(self, good, vlb)
+
+    def _reflect_local_rays(
+        self, good, lb, vlb, pitch, roll, yaw, dx=None, dy=None, dz=None,
+        local_z=None, local_n=None, local_g=None, fromVacuum=True,
+        material=None, is2ndXtal=False, needElevationMap=False,
+            noIntersectionSearch=False, isMulti=False):
+        """The body of :meth:`_reflect_local` that works on the rays of *lb*
+        and *vlb* indexed by *good*."""
 # rotate the world around the mirror.
 # lb is truly local coordinates whereas vlb is in virgin local coordinates:
         if local_n is None:
             local_n = self.local_n
-        raycing.rotate_beam(
-            lb, good, rotationSequence=self.rotationSequence,
-            pitch=-pitch, roll=-roll, yaw=-yaw)
-        if self.extraPitch or self.extraRoll or self.extraYaw:
-            raycing.rotate_beam(
-                lb, good, rotationSequence=self.extraRotationSequence,
-                pitch=-self.extraPitch, roll=-self.extraRoll,
-                yaw=-self.extraYaw)
-        if dx:
-            lb.x[good] -= dx
-        if dy:
-            lb.y[good] -= dy
-        if dz:
-            lb.z[good] -= dz
+        matrix, shift = self.get_local_transform(pitch, roll, yaw, dx, dy, dz)
+        raycing.rotate_vectors(matrix, (lb.x, lb.y, lb.z), good, shift)
+        raycing.rotate_vectors(matrix, (lb.a, lb.b, lb.c), good)
 
 # x, y, z:
         if fromVacuum:
@@ -1274,7 +1775,7 @@ class OE(object):
 #                n = matSur.get_refractive_index(lb.E[goodN])
 #                mu = abs(n.imag) * lb.E[goodN] / CHBAR * 2e8  # 1/cm
 #                att = np.exp(-mu * tMax[goodN] * 0.1)
-                depth = np.random.rand(len(lb.a[goodN])) * matSur.t
+                depth = raycing.get_rng().random(len(lb.a[goodN])) * matSur.t
                 lb.x[goodN] += lb.a[goodN] * depth
                 lb.y[goodN] += lb.b[goodN] * depth
                 lb.z[goodN] += lb.c[goodN] * depth
@@ -1343,8 +1844,9 @@ class OE(object):
                         if isinstance(self.order, int):
                             locOrder = self.order
                         else:
-                            locOrder = np.array(self.order)[np.random.randint(
-                                len(self.order), size=goodN.sum())]
+                            locOrder = np.array(self.order)[
+                                raycing.get_rng().integers(
+                                    len(self.order), size=goodN.sum())]
                         if gNormal is None:
                             gNormal = local_g(lb.x[goodN], lb.y[goodN])
                         gNormal = np.asarray(gNormal, order='F') * locOrder
@@ -1414,14 +1916,27 @@ class OE(object):
                     lb.Es[goodN], lb.Ep[goodN], cosY, -sinY)
 
             if findReflectivity:
+                responseTable = self.responseTable
+                if responseTable is not None and\
+                        not responseTable.can_tabulate(matSur):
+                    responseTable = None
                 if toWhere in [5, 6, 7]:  # powder,
                     refl = rasP, rapP
                 elif matSur.kind == 'crystal':
                     beamOutDotSurfaceNormal = a_out * oeNormal[-3] + \
                         b_out * oeNormal[-2] + c_out * oeNormal[-1]
-                    refl = matSur.get_amplitude(
-                        lb.E[goodN], beamInDotSurfaceNormal,
-                        beamOutDotSurfaceNormal, beamInDotNormal)
+                    if responseTable is not None:
+                        refl = responseTable.get_amplitude(
+                            matSur, lb.E[goodN], beamInDotSurfaceNormal,
+                            beamOutDotSurfaceNormal, beamInDotNormal)
+                    else:
+                        refl = matSur.get_amplitude(
+                            lb.E[goodN], beamInDotSurfaceNormal,
+                            beamOutDotSurfaceNormal, beamInDotNormal)
+                elif matSur.kind == 'multilayer' and\
+                        responseTable is not None:
+                    refl = responseTable.get_amplitude(
+                        matSur, lb.E[goodN], beamInDotSurfaceNormal)
                 elif matSur.kind == 'multilayer':
                     if (isOpenCL) and (self.cl_ctx is not None):
                         ucl = self.ucl
@@ -1439,6 +1954,10 @@ class OE(object):
                             hasEfficiency = True
                     if hasEfficiency:
                         refl = matSur.get_grating_efficiency(lb, goodN)
+                    elif responseTable is not None:
+                        refl = responseTable.get_amplitude(
+                            matSur, lb.E[goodN], beamInDotNormal,
+                            fromVacuum=fromVacuum)
                     else:
                         refl = matSur.get_amplitude(
                             lb.E[goodN], beamInDotNormal, fromVacuum)
@@ -1497,23 +2016,10 @@ class OE(object):
             # already:
             rs.copy_beam(vlb, lb, good, includeState=True, includeJspEsp=False)
 # rotate the world back for the virgin local beam:
-        if dx:
-            vlb.x[good] += dx
-        if dy:
-            vlb.y[good] += dy
-        if dz:
-            vlb.z[good] += dz
-        if self.extraPitch or self.extraRoll or self.extraYaw:
-            raycing.rotate_beam(
-                vlb, good, rotationSequence='-'+self.extraRotationSequence,
-                pitch=self.extraPitch, roll=self.extraRoll,
-                yaw=self.extraYaw)
-        raycing.rotate_beam(vlb, good,
-                            rotationSequence='-'+self.rotationSequence,
-                            pitch=pitch, roll=roll, yaw=yaw)
-
-        if self.alarmLevel is not None:
-            raycing.check_alarm(self, good, vlb)
+        raycing.rotate_vectors(matrix, (vlb.x, vlb.y, vlb.z), good, shift,
+                               inverse=True)
+        raycing.rotate_vectors(matrix, (vlb.a, vlb.b, vlb.c), good,
+                               inverse=True)
 
 
 class DCM(OE):
@@ -1616,6 +2122,7 @@ class DCM(OE):
         .. Returned values: beamGlobal, beamLocal1, beamLocal2
         """
         self.get_orientation()
+        beam = rs.double_precision(beam)
         gb = rs.Beam(copyFrom=beam)  # output beam in global coordinates
         if needLocal:
             lo1 = rs.Beam(copyFrom=beam)  # output beam in local coordinates
@@ -1624,7 +2131,7 @@ class DCM(OE):
 
         good1 = beam.state > 0
         if good1.sum() == 0:
-            return gb, lo1, lo1
+            return rs.apply_precision(gb, lo1, lo1)
         raycing.global_to_virgin_local(self.bl, beam, lo1, self.center, good1)
         self._reflect_local(
             good1, lo1, gb, self.pitch + self.bragg,
@@ -1644,7 +2151,7 @@ class DCM(OE):
             lo2 = gb2
         good2 = gb.state > 0
         if good2.sum() == 0:
-            return gb2, lo1, lo2
+            return rs.apply_precision(gb2, lo1, lo2)
         self._reflect_local(
             good2, lo2, gb2,
             -self.pitch - self.bragg + self.cryst2pitch + self.cryst2finePitch,
@@ -1659,4 +2166,5 @@ class DCM(OE):
         notGood = ~goodAfter2
         if notGood.sum() > 0:
             rs.copy_beam(gb2, beam, notGood)
-        return gb2, lo1, lo2  # in global and local(lo1 and lo2) coordinates
+        # in global and local(lo1 and lo2) coordinates:
+        return rs.apply_precision(gb2, lo1, lo2)
@@ -485,8 +485,9 @@ __date__ = "03 Jul 2016"
 __all__ = ('GeometricSource', 'MeshSource', 'BendingMagnet', 'Wiggler',
            'Undulator')
 
-from .sources_beams import Beam, copy_beam, rotate_coherency_matrix,\
-    defaultEnergy
+from .sources_beams import Beam, BeamBuffer, copy_beam,\
+    rotate_coherency_matrix, defaultEnergy, set_beam_precision,\
+    double_precision, apply_precision
 from .sources_geoms import GeometricSource, MeshSource, NESWSource,\
     CollimatedMeshSource, shrink_source, make_energy, make_polarization,\
     GaussianBeam, LaguerreGaussianBeam
@@ -1,12 +1,95 @@
 # -*- coding: utf-8 -*-
 __author__ = "Konstantin Klementiev", "Roman Chernikov"
 __date__ = "12 Apr 2016"
+import copy
 import numpy as np
 from .. import raycing
 
 defaultEnergy = 9.0e3
 
 
+# the per-ray arrays of Beam:
+rayFields = ('state', 'x', 'y', 'z', 'a', 'b', 'c', 'path', 'E', 'Jss', 'Jpp',
+             'Jsp', 'Es', 'Ep', 'nRefl', 'elevationD', 'elevationX',
+             'elevationY', 'elevationZ', 's', 'phi', 'r', 'theta', 'order')
+defaultPacked = False  # the default of *packed* in Beam
+
+# named dtype policies of the Beam fields, see set_beam_precision():
+precisionPolicies = {
+    'float64': {},
+    'float32': dict((name, np.float32) for name in
+                    ('x', 'y', 'z', 'a', 'b', 'c'))}
+beamDtypes = {}  # the active policy: {field name: dtype}, float64 otherwise
+
+
+def set_beam_precision(policy='float64'):
+    """Sets the dtypes of the newly created beams. *policy* is either a key of
+    ``precisionPolicies`` or a dictionary {field name: dtype}. The policy
+    'float32' keeps the positions *x, y, z* and the directions *a, b, c* in
+    single precision and *path*, *E* and the coherency matrix in double
+    precision, which halves the memory traffic of the geometric ray tracing.
+    The sources and the screens write into the arrays of the beams in place
+    and thus keep their dtypes. The optical elements calculate in double
+    precision, see :func:`double_precision`, and convert the output beams by
+    :func:`apply_precision`. See
+    ``tests/raycing/test_precision.py`` for a comparison with float64."""
+    global beamDtypes
+    if isinstance(policy, dict):
+        beamDtypes = dict(policy)
+    else:
+        beamDtypes = dict(precisionPolicies[policy])
+
+
+def field_dtype(name, default=np.float64):
+    """Returns the dtype of the Beam field *name* by the active policy."""
+    return beamDtypes.get(name, default)
+
+
+def double_precision(beam):
+    """Returns *beam* if all its fields are in double precision, otherwise its
+    shallow copy with the single precision fields converted to double
+    precision. The optical elements search for the intersections and
+    transform the beams in double precision."""
+    names = [name for name in rayFields if hasattr(beam, name) and
+             getattr(beam, name).dtype in (np.float32, np.complex64)]
+    if not names:
+        return beam
+    promoted = copy.copy(beam)
+    if promoted.store is not None:
+        promoted.unpack()
+    for name in names:
+        array = getattr(promoted, name)
+        setattr(promoted, name, array.astype(
+            np.complex128 if array.dtype == np.complex64 else np.float64))
+    return promoted
+
+
+def apply_precision(*beams):
+    """Converts the fields of *beams* in place to the dtypes of the active
+    policy. A packed beam gets its *store* rebuilt with these dtypes.
+    Returns the beams as a tuple or a single beam."""
+    for beam in beams:
+        names = [name for name, dtype in beamDtypes.items() if
+                 hasattr(beam, name) and getattr(beam, name).dtype != dtype]
+        if not names:
+            continue
+        packed = beam.store is not None
+        if packed:  # the columns of the store cannot change their dtypes
+            beam.unpack()
+        for name in names:
+            setattr(beam, name, getattr(beam, name).astype(beamDtypes[name]))
+        if packed:
+            beam.pack()
+    return beams if len(beams) > 1 else beams[0]
+
+
+def _raw(records):
+    """Views the records as opaque items of the same size, for which numpy
+    copies and fancy-indexes whole records as memory blocks; this is faster
+    than the field-wise copying of structured arrays."""
+    return records.view(np.dtype((np.void, records.dtype.itemsize)))
+
+
 class Beam(object):
     """Container for the beam arrays. *x, y, z* give the starting points.
     *a, b, c* give normalized vectors of ray directions (the source must take
@@ -22,15 +105,32 @@ class Beam(object):
     highest elevation points. If an OE uses a parametric representation,
     *s*, *phi*, *r* arrays store the impact points in the parametric
     coordinates.
+
+    If *packed* is True (the default is given by the module variable
+    ``defaultPacked``), the per-ray arrays are kept in one contiguous record
+    array *store* (a numpy structured array, one record per ray) and the beam
+    attributes are its named column views, see :meth:`pack`. Then copying,
+    concatenating, filtering and replacing rays are single operations on
+    *store*, and *store* can be given to shared memory or to a file as one
+    buffer, see also :meth:`from_records`. Assigning an array of the same
+    length to a field writes it into its column; assigning an array of a
+    different length or an incompatible type unpacks the beam. The arithmetic
+    on the strided column views is somewhat slower than on separate arrays.
     """
+    store = None
+    storeFields = ()
+
     def __init__(self, nrays=raycing.nrays, copyFrom=None, forceState=False,
                  withNumberOfReflections=False, withAmplitudes=False,
-                 xyzOnly=False):
+                 xyzOnly=False, packed=None):
+        if packed is None:
+            packed = defaultPacked if copyFrom is None else\
+                copyFrom.store is not None
         if copyFrom is None:
             # coordinates of starting points
-            self.x = np.zeros(nrays)
-            self.y = np.zeros(nrays)
-            self.z = np.zeros(nrays)
+            self.x = np.zeros(nrays, dtype=field_dtype('x'))
+            self.y = np.zeros(nrays, dtype=field_dtype('y'))
+            self.z = np.zeros(nrays, dtype=field_dtype('z'))
             if not xyzOnly:
                 self.sourceSIGMAx = 0.
                 self.sourceSIGMAz = 0.
@@ -40,107 +140,142 @@ class Beam(object):
                 self.filamentDZ = 0.
                 self.state = np.zeros(nrays, dtype=np.int)
                 # components of direction
-                self.a = np.zeros(nrays)
-                self.b = np.ones(nrays)
-                self.c = np.zeros(nrays)
+                self.a = np.zeros(nrays, dtype=field_dtype('a'))
+                self.b = np.ones(nrays, dtype=field_dtype('b'))
+                self.c = np.zeros(nrays, dtype=field_dtype('c'))
                 # total ray path
-                self.path = np.zeros(nrays)
+                self.path = np.zeros(nrays, dtype=field_dtype('path'))
                 # energy
-                self.E = np.ones(nrays) * defaultEnergy
+                self.E = np.full(nrays, defaultEnergy, dtype=field_dtype('E'))
                 # components of coherency matrix
-                self.Jss = np.ones(nrays)
-                self.Jpp = np.zeros(nrays)
-                self.Jsp = np.zeros(nrays, dtype=complex)
+                self.Jss = np.ones(nrays, dtype=field_dtype('Jss'))
+                self.Jpp = np.zeros(nrays, dtype=field_dtype('Jpp'))
+                self.Jsp = np.zeros(nrays, dtype=field_dtype('Jsp', complex))
                 if withAmplitudes:
-                    self.Es = np.zeros(nrays, dtype=complex)
-                    self.Ep = np.zeros(nrays, dtype=complex)
+                    self.Es = np.zeros(nrays, dtype=field_dtype('Es', complex))
+                    self.Ep = np.zeros(nrays, dtype=field_dtype('Ep', complex))
         else:
-            self.x = np.copy(copyFrom.x)
-            self.y = np.copy(copyFrom.y)
-            self.z = np.copy(copyFrom.z)
+            if packed and (copyFrom.store is not None):  # a single memcpy
+                self._bind(_raw(copyFrom.store).copy().view(
+                    copyFrom.store.dtype),
+                           [name for name in copyFrom.storeFields if
+                            withNumberOfReflections or name != 'nRefl'])
+            for name in rayFields:
+                if name in self.storeFields:
+                    continue
+                if name == 'nRefl' and not withNumberOfReflections:
+                    continue
+                if hasattr(copyFrom, name):
+                    setattr(self, name, np.copy(getattr(copyFrom, name)))
             self.sourceSIGMAx = copyFrom.sourceSIGMAx
             self.sourceSIGMAz = copyFrom.sourceSIGMAz
             self.filamentDX = copyFrom.filamentDX
             self.filamentDZ = copyFrom.filamentDZ
             self.filamentDtheta = copyFrom.filamentDtheta
             self.filamentDpsi = copyFrom.filamentDpsi
-            self.state = np.copy(copyFrom.state)
-            self.a = np.copy(copyFrom.a)
-            self.b = np.copy(copyFrom.b)
-            self.c = np.copy(copyFrom.c)
-            self.path = np.copy(copyFrom.path)
-            self.E = np.copy(copyFrom.E)
-            self.Jss = np.copy(copyFrom.Jss)
-            self.Jpp = np.copy(copyFrom.Jpp)
-            self.Jsp = np.copy(copyFrom.Jsp)
-            if withNumberOfReflections and hasattr(copyFrom, 'nRefl'):
-#            if hasattr(copyFrom, 'nRefl'):
-                self.nRefl = np.copy(copyFrom.nRefl)
-            if hasattr(copyFrom, 'elevationD'):
-                self.elevationD = np.copy(copyFrom.elevationD)
-                self.elevationX = np.copy(copyFrom.elevationX)
-                self.elevationY = np.copy(copyFrom.elevationY)
-                self.elevationZ = np.copy(copyFrom.elevationZ)
-            if hasattr(copyFrom, 's'):
-                self.s = np.copy(copyFrom.s)
-            if hasattr(copyFrom, 'phi'):
-                self.phi = np.copy(copyFrom.phi)
-            if hasattr(copyFrom, 'r'):
-                self.r = np.copy(copyFrom.r)
-            if hasattr(copyFrom, 'theta'):
-                self.theta = np.copy(copyFrom.theta)
-            if hasattr(copyFrom, 'order'):
-                self.order = np.copy(copyFrom.order)
             if hasattr(copyFrom, 'accepted'):  # for calculating flux
                 self.accepted = copyFrom.accepted
                 self.acceptedE = copyFrom.acceptedE
                 self.seeded = copyFrom.seeded
                 self.seededI = copyFrom.seededI
-            if hasattr(copyFrom, 'Es'):
-                self.Es = np.copy(copyFrom.Es)
-                self.Ep = np.copy(copyFrom.Ep)
             if hasattr(copyFrom, 'area'):
                 self.area = copyFrom.area
 
         if type(forceState) == int:
             self.state[:] = forceState
+        if packed:
+            self.pack()
+
+    def __setattr__(self, name, value):
+        if name in self.storeFields:
+            column = self.store[name]
+            if np.shape(value) == column.shape and np.can_cast(
+                    np.asarray(value).dtype, column.dtype, 'same_kind'):
+                column[...] = value
+                return
+            self.unpack()
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.storeFields:  # the views are rebuilt on unpickling
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.store is not None:
+            self._bind(self.store, self.storeFields)
+
+    def _bind(self, store, names):
+        self.__dict__['store'] = store
+        self.__dict__['storeFields'] = tuple(names)
+        for name in names:
+            self.__dict__[name] = store[name]
+
+    def pack(self):
+        """Moves the per-ray arrays (see ``rayFields``) into one contiguous
+        record array *store* and replaces them by its named column views. A
+        packed beam is repacked if it has got new per-ray arrays. Returns
+        self."""
+        names = [name for name in rayFields if
+                 isinstance(self.__dict__.get(name), np.ndarray) and
+                 self.__dict__[name].shape == self.x.shape]
+        if tuple(names) == self.storeFields:
+            return self
+        store = np.empty(self.x.shape,
+                         dtype=[(name, self.__dict__[name].dtype)
+                                for name in names])
+        for name in names:
+            store[name] = self.__dict__[name]
+        self._bind(store, names)
+        return self
+
+    def unpack(self):
+        """Replaces the column views of *store* by separate contiguous arrays
+        and drops *store*. Returns self."""
+        for name in self.storeFields:
+            self.__dict__[name] = np.array(self.store[name])
+        self.__dict__['store'] = None
+        self.__dict__['storeFields'] = ()
+        return self
+
+    @classmethod
+    def from_records(cls, records):
+        """Creates a packed beam over the structured array *records* without
+        copying it, e.g. over a *store* of another beam read from a file by
+        ``numpy.load`` or placed in shared memory. The field names of
+        *records* must be those of ``rayFields``."""
+        beam = cls(nrays=0)
+        for name in rayFields:
+            beam.__dict__.pop(name, None)
+        beam._bind(records, [name for name in rayFields
+                             if name in records.dtype.names])
+        return beam
+
+    def _same_store(self, beam):
+        return (self.store is not None) and (beam.store is not None) and\
+            (self.store.dtype == beam.store.dtype) and\
+            (self.storeFields == beam.storeFields)
 
     def concatenate(self, beam):
         """Adds *beam* to *self*. Useful when more than one source is
-        presented."""
-        self.state = np.concatenate((self.state, beam.state))
-        self.x = np.concatenate((self.x, beam.x))
-        self.y = np.concatenate((self.y, beam.y))
-        self.z = np.concatenate((self.z, beam.z))
-        self.a = np.concatenate((self.a, beam.a))
-        self.b = np.concatenate((self.b, beam.b))
-        self.c = np.concatenate((self.c, beam.c))
-        self.path = np.concatenate((self.path, beam.path))
-        self.E = np.concatenate((self.E, beam.E))
-        self.Jss = np.concatenate((self.Jss, beam.Jss))
-        self.Jpp = np.concatenate((self.Jpp, beam.Jpp))
-        self.Jsp = np.concatenate((self.Jsp, beam.Jsp))
-        if hasattr(self, 'nRefl') and hasattr(beam, 'nRefl'):
-            self.nRefl = np.concatenate((self.nRefl, beam.nRefl))
-        if hasattr(self, 'elevationD') and hasattr(beam, 'elevationD'):
-            self.elevationD = np.concatenate(
-                (self.elevationD, beam.elevationD))
-            self.elevationX = np.concatenate(
-                (self.elevationX, beam.elevationX))
-            self.elevationY = np.concatenate(
-                (self.elevationY, beam.elevationY))
-            self.elevationZ = np.concatenate(
-                (self.elevationZ, beam.elevationZ))
-        if hasattr(self, 's') and hasattr(beam, 's'):
-            self.s = np.concatenate((self.s, beam.s))
-        if hasattr(self, 'phi') and hasattr(beam, 'phi'):
-            self.phi = np.concatenate((self.phi, beam.phi))
-        if hasattr(self, 'r') and hasattr(beam, 'r'):
-            self.r = np.concatenate((self.r, beam.r))
-        if hasattr(self, 'theta') and hasattr(beam, 'theta'):
-            self.theta = np.concatenate((self.theta, beam.theta))
-        if hasattr(self, 'order') and hasattr(beam, 'order'):
-            self.order = np.concatenate((self.order, beam.order))
+        presented. If the beams are packed with different fields or dtypes or
+        only *self* is packed, the fields are concatenated one by one and
+        *self* is repacked."""
+        sameStore = self._same_store(beam)
+        repack = (self.store is not None) and not sameStore
+        if sameStore:
+            self._bind(np.concatenate((_raw(self.store), _raw(beam.store)))
+                       .view(self.store.dtype), self.storeFields)
+        elif repack:
+            self.unpack()
+        for name in rayFields:
+            if name in self.storeFields:
+                continue
+            if hasattr(self, name) and hasattr(beam, name):
+                setattr(self, name, np.concatenate(
+                    (getattr(self, name), getattr(beam, name))))
         if hasattr(self, 'accepted') and hasattr(beam, 'accepted'):
             seeded = self.seeded + beam.seeded
             self.accepted = (self.accepted / self.seeded +
@@ -149,79 +284,28 @@ class Beam(object):
                               beam.acceptedE / beam.seeded) * seeded
             self.seeded = seeded
             self.seededI = self.seededI + beam.seededI
-        if hasattr(self, 'Es') and hasattr(beam, 'Es'):
-            self.Es = np.concatenate((self.Es, beam.Es))
-            self.Ep = np.concatenate((self.Ep, beam.Ep))
+        if repack:
+            self.pack()
 
     def filter_by_index(self, indarr):
-        self.state = self.state[indarr]
-        self.x = self.x[indarr]
-        self.y = self.y[indarr]
-        self.z = self.z[indarr]
-        self.a = self.a[indarr]
-        self.b = self.b[indarr]
-        self.c = self.c[indarr]
-        self.path = self.path[indarr]
-        self.E = self.E[indarr]
-        self.Jss = self.Jss[indarr]
-        self.Jpp = self.Jpp[indarr]
-        self.Jsp = self.Jsp[indarr]
-        if hasattr(self, 'nRefl'):
-            self.nRefl = self.nRefl[indarr]
-        if hasattr(self, 'elevationD'):
-            self.elevationD = self.elevationD[indarr]
-            self.elevationX = self.elevationX[indarr]
-            self.elevationY = self.elevationY[indarr]
-            self.elevationZ = self.elevationZ[indarr]
-        if hasattr(self, 's'):
-            self.s = self.s[indarr]
-        if hasattr(self, 'phi'):
-            self.phi = self.phi[indarr]
-        if hasattr(self, 'r'):
-            self.r = self.r[indarr]
-        if hasattr(self, 'theta'):
-            self.theta = self.theta[indarr]
-        if hasattr(self, 'order'):
-            self.order = self.order[indarr]
-        if hasattr(self, 'Es'):
-            self.Es = self.Es[indarr]
-            self.Ep = self.Ep[indarr]
+        if self.store is not None:  # a single fancy-index
+            self._bind(_raw(self.store)[indarr].view(self.store.dtype),
+                       self.storeFields)
+        for name in rayFields:
+            if name in self.storeFields:
+                continue
+            if hasattr(self, name):
+                setattr(self, name, getattr(self, name)[indarr])
         return self
 
     def replace_by_index(self, indarr, beam):
-        self.state[indarr] = beam.state[indarr]
-        self.x[indarr] = beam.x[indarr]
-        self.y[indarr] = beam.y[indarr]
-        self.z[indarr] = beam.z[indarr]
-        self.a[indarr] = beam.a[indarr]
-        self.b[indarr] = beam.b[indarr]
-        self.c[indarr] = beam.c[indarr]
-        self.path[indarr] = beam.path[indarr]
-        self.E[indarr] = beam.E[indarr]
-        self.Jss[indarr] = beam.Jss[indarr]
-        self.Jpp[indarr] = beam.Jpp[indarr]
-        self.Jsp[indarr] = beam.Jsp[indarr]
-        if hasattr(self, 'nRefl') and hasattr(beam, 'nRefl'):
-            self.nRefl[indarr] = beam.nRefl[indarr]
-        if hasattr(self, 'elevationD') and hasattr(beam, 'elevationD'):
-            self.elevationD[indarr] = beam.elevationD[indarr]
-            self.elevationX[indarr] = beam.elevationX[indarr]
-            self.elevationY[indarr] = beam.elevationY[indarr]
-            self.elevationZ[indarr] = beam.elevationZ[indarr]
-        if hasattr(self, 's') and hasattr(beam, 's'):
-            self.s[indarr] = beam.s[indarr]
-        if hasattr(self, 'phi') and hasattr(beam, 'phi'):
-            self.phi[indarr] = beam.phi[indarr]
-        if hasattr(self, 'r') and hasattr(beam, 'r'):
-            self.r[indarr] = beam.r[indarr]
-        if hasattr(self, 'theta') and hasattr(beam, 'theta'):
-            self.theta[indarr] = beam.theta[indarr]
-        if hasattr(self, 'order') and hasattr(beam, 'order'):
-            self.order[indarr] = beam.order[indarr]
-        if hasattr(self, 'Es') and hasattr(beam, 'Es'):
-            self.Es[indarr] = beam.Es[indarr]
-        if hasattr(self, 'Ep') and hasattr(beam, 'Ep'):
-            self.Ep[indarr] = beam.Ep[indarr]
+        if self._same_store(beam):
+            _raw(self.store)[indarr] = _raw(beam.store)[indarr]
+        for name in rayFields:
+            if (name in self.storeFields) and self._same_store(beam):
+                continue
+            if hasattr(self, name) and hasattr(beam, name):
+                getattr(self, name)[indarr] = getattr(beam, name)[indarr]
         return self
 
     def filter_good(self):
@@ -257,36 +341,103 @@ class Beam(object):
         simultaneous ray tracing of white beam and monochromatic beam parts of
         a beamline.
         """
-        self.E[:] = np.random.uniform(EnewMin, EnewMax, len(self.E))
+        self.E[:] = raycing.get_rng().uniform(EnewMin, EnewMax, len(self.E))
 
     def diffract(self, wave):
         from . import waves as rw
         return rw.diffract(self, wave)
 
 
+class BeamBuffer(object):
+    """
+    A growable container of rays for the loops that add up beams of a priori
+    unknown sizes, like the rejection sampling of the synchrotron sources and
+    the multiple reflections. The per-ray arrays are allocated with a spare
+    capacity that grows geometrically by the factor *growth*, so that the total
+    cost of appending is linear in the number of rays, whereas a repeated
+    :meth:`Beam.concatenate` reallocates all the arrays every time. The beam
+    attributes other than the per-ray arrays are taken from the 1st appended
+    beam. A field is dropped if an appended beam does not have it, as in
+    :meth:`Beam.concatenate`.
+    """
+    def __init__(self, capacity=0, growth=2.):
+        self.capacity = int(capacity)
+        self.growth = growth
+        self.length = 0
+        self.beam = None
+
+    def __len__(self):
+        return self.length
+
+    def append(self, beam):
+        """Copies the rays of *beam* to the end of the buffer."""
+        n = len(beam.x)
+        if self.beam is None:
+            self.beam = Beam(nrays=0, xyzOnly=True, packed=False)
+            for key, value in beam.__dict__.items():
+                if key not in rayFields and\
+                        key not in ('store', 'storeFields'):
+                    setattr(self.beam, key, value)
+            self.capacity = max(self.capacity, n)
+            for name in rayFields:
+                if hasattr(beam, name):
+                    setattr(self.beam, name, np.empty(
+                        self.capacity, dtype=getattr(beam, name).dtype))
+        self.fields = [name for name in rayFields if
+                       hasattr(self.beam, name) and hasattr(beam, name)]
+        for name in rayFields:
+            if hasattr(self.beam, name) and name not in self.fields:
+                delattr(self.beam, name)
+        if self.length + n > self.capacity:
+            self.capacity = max(int(self.capacity*self.growth),
+                                self.length + n)
+            for name in self.fields:
+                array = np.empty(self.capacity,
+                                 dtype=getattr(self.beam, name).dtype)
+                array[:self.length] = getattr(self.beam, name)[:self.length]
+                setattr(self.beam, name, array)
+        for name in self.fields:
+            getattr(self.beam, name)[self.length:self.length+n] = \
+                getattr(beam, name)
+        self.length += n
+
+    def get_beam(self, trim=True):
+        """Returns the accumulated beam. If *trim* is True, the arrays are
+        copied to their actual length and the spare capacity is released,
+        otherwise the arrays are views of the buffer arrays."""
+        if self.beam is None:
+            return None
+        for name in self.fields:
+            array = getattr(self.beam, name)[:self.length]
+            setattr(self.beam, name, np.array(array) if trim else array)
+        self.capacity = self.length
+        return self.beam
+
+
 def copy_beam(
         beamTo, beamFrom, indarr, includeState=False, includeJspEsp=True):
     """Copies arrays of *beamFrom* to arrays of *beamTo*. The slicing of the
-    arrays is given by *indarr*."""
-    beamTo.x[indarr] = beamFrom.x[indarr]
-    beamTo.y[indarr] = beamFrom.y[indarr]
-    beamTo.z[indarr] = beamFrom.z[indarr]
-    beamTo.a[indarr] = beamFrom.a[indarr]
-    beamTo.b[indarr] = beamFrom.b[indarr]
-    beamTo.c[indarr] = beamFrom.c[indarr]
-    beamTo.path[indarr] = beamFrom.path[indarr]
-    beamTo.E[indarr] = beamFrom.E[indarr]
+    arrays is given by *indarr*. The arrays kept in the *store* of both beams
+    are copied by a single fancy-index."""
+    names = ['x', 'y', 'z', 'a', 'b', 'c', 'path', 'E', 'nRefl',
+             'elevationD', 'elevationX', 'elevationY', 'elevationZ']
     if includeState:
-        beamTo.state[indarr] = beamFrom.state[indarr]
-    if hasattr(beamFrom, 'nRefl') and hasattr(beamTo, 'nRefl'):
-        beamTo.nRefl[indarr] = beamFrom.nRefl[indarr]
+        names.append('state')
+    if includeJspEsp:
+        names.extend(['Jss', 'Jpp', 'Jsp', 'Es', 'Ep'])
+    packedNames = [name for name in names if
+                   (name in beamTo.storeFields) and
+                   (name in beamFrom.storeFields) and
+                   (beamTo.store.dtype[name] == beamFrom.store.dtype[name])]
+    if packedNames:
+        beamTo.store[packedNames][indarr] = beamFrom.store[packedNames][indarr]
+    for name in names:
+        if name in packedNames:
+            continue
+        if hasattr(beamFrom, name) and hasattr(beamTo, name):
+            getattr(beamTo, name)[indarr] = getattr(beamFrom, name)[indarr]
     if hasattr(beamFrom, 'order'):
         beamTo.order = beamFrom.order
-    if hasattr(beamFrom, 'elevationD') and hasattr(beamTo, 'elevationD'):
-        beamTo.elevationD[indarr] = beamFrom.elevationD[indarr]
-        beamTo.elevationX[indarr] = beamFrom.elevationX[indarr]
-        beamTo.elevationY[indarr] = beamFrom.elevationY[indarr]
-        beamTo.elevationZ[indarr] = beamFrom.elevationZ[indarr]
     if hasattr(beamFrom, 'accepted'):
         beamTo.accepted = beamFrom.accepted
         beamTo.acceptedE = beamFrom.acceptedE
@@ -294,13 +445,6 @@ def copy_beam(
         beamTo.seededI = beamFrom.seededI
     if hasattr(beamTo, 'area'):
         beamTo.area = beamFrom.area
-    if includeJspEsp:
-        beamTo.Jss[indarr] = beamFrom.Jss[indarr]
-        beamTo.Jpp[indarr] = beamFrom.Jpp[indarr]
-        beamTo.Jsp[indarr] = beamFrom.Jsp[indarr]
-        if hasattr(beamFrom, 'Es') and hasattr(beamTo, 'Es'):
-            beamTo.Es[indarr] = beamFrom.Es[indarr]
-            beamTo.Ep[indarr] = beamFrom.Ep[indarr]
 
 
 def rotate_coherency_matrix(beam, indarr, roll):
@@ -17,16 +17,17 @@ def make_energy(distE, energies, nrays, filamentBeam=False):
     *energies* either determine the limits or is a sequence of discrete
     energies.
     """
+    rng = raycing.get_rng()
     locnrays = 1 if filamentBeam else nrays
     if distE == 'normal':
         try:
-            E = np.random.normal(energies[0], energies[1], locnrays)
+            E = rng.normal(energies[0], energies[1], locnrays)
         except ValueError:
             E = np.zeros(locnrays)
     elif distE == 'flat':
-        E = np.random.uniform(energies[0], energies[1], locnrays)
+        E = rng.uniform(energies[0], energies[1], locnrays)
     elif distE == 'lines':
-        E = np.array(energies)[np.random.randint(len(energies), size=locnrays)]
+        E = np.array(energies)[rng.integers(len(energies), size=locnrays)]
     return E
 
 
@@ -99,7 +100,7 @@ def make_polarization(polarization, bo, nrays=raycing.nrays):
         if hasattr(bo, 'Es'):
             bo.Es.fill(Es)
             if isinstance(Ep, str):
-                bo.Ep[:] = np.random.uniform(size=nrays) * 2**(-0.5)
+                bo.Ep[:] = raycing.get_rng().uniform(size=nrays) * 2**(-0.5)
             else:
                 bo.Ep.fill(Ep)
 
@@ -221,11 +222,12 @@ class GeometricSource(object):
         self.yaw = yaw
 
     def _apply_distribution(self, axis, distaxis, daxis, bo=None):
+        rng = raycing.get_rng()
         if distaxis == 'normal':
             if self.uniformRayDensity:
                 if not isinstance(daxis, (list, tuple)):
                     raise ValueError("Wrong distribution size!")
-                axis[:] = np.random.uniform(-daxis[1], daxis[1], self.nrays)
+                axis[:] = rng.uniform(-daxis[1], daxis[1], self.nrays)
                 amp = np.exp(-axis**2 / daxis[0]**2 / 2) /\
                     PI2**0.5 / daxis[0] * 2 * daxis[1]
                 bo.Jss *= amp
@@ -237,7 +239,7 @@ class GeometricSource(object):
             else:
                 sigma = daxis[0] if isinstance(daxis, (list, tuple)) else daxis
                 try:
-                    axis[:] = np.random.normal(0, sigma, self.nrays)
+                    axis[:] = rng.normal(0, sigma, self.nrays)
                 except ValueError:
                     axis[:] = np.zeros(self.nrays)
         elif (distaxis == 'flat'):
@@ -247,17 +249,18 @@ class GeometricSource(object):
                 if daxis <= 0:
                     return
                 aMin, aMax = -daxis*0.5, daxis*0.5
-            axis[:] = np.random.uniform(aMin, aMax, self.nrays)
+            axis[:] = rng.uniform(aMin, aMax, self.nrays)
 #        else:
 #            axis[:] = 0
 
     def _set_annulus(self, axis1, axis2, rMin, rMax, phiMin, phiMax):
+        rng = raycing.get_rng()
         if rMax > rMin:
             A = 2. / (rMax**2 - rMin**2)
-            r = np.sqrt(2*np.random.uniform(0, 1, self.nrays)/A + rMin**2)
+            r = np.sqrt(2*rng.uniform(0, 1, self.nrays)/A + rMin**2)
         else:
             r = rMax
-        phi = np.random.uniform(phiMin, phiMax, self.nrays)
+        phi = rng.uniform(phiMin, phiMax, self.nrays)
         axis1[:] = r * np.cos(phi)
         axis2[:] = r * np.sin(phi)
 
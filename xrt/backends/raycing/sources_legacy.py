@@ -18,7 +18,7 @@ else:
 #    import string
 import gzip
 from .. import raycing
-from .sources_beams import Beam
+from .sources_beams import Beam, BeamBuffer
 from .physconsts import M0C2, K2B, SIE0, SIC, PI, PI2, CHeVcm
 
 _DEBUG = 20  # if non-zero, some diagnostics is printed out
@@ -606,7 +606,7 @@ class UndulatorUrgent(object):
         u"""
         Returns the source beam. If *toGlobal* is True, the output is in the
         global system."""
-        bo = None
+        bos = BeamBuffer(self.nrays)
         length = 0
         seeded = np.long(0)
         seededI = 0.
@@ -692,11 +692,9 @@ class UndulatorUrgent(object):
             bot.x[:] += np.random.normal(0, bot.sourceSIGMAx, npassed)
             bot.z[:] += np.random.normal(0, bot.sourceSIGMAz, npassed)
 
-            if bo is None:
-                bo = bot
-            else:
-                bo.concatenate(bot)
-            length = len(bo.a)
+            bos.append(bot)
+            length = len(bos)
+        bo = bos.get_beam()
         if length >= self.nrays:
             bo.accepted = length * self.fluxConst
             bo.acceptedE = bo.E.sum() * self.fluxConst * SIE0
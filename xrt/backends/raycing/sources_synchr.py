@@ -10,7 +10,7 @@ from scipy import special
 
 from .. import raycing
 from . import myopencl as mcl
-from .sources_beams import Beam
+from .sources_beams import Beam, BeamBuffer
 from .physconsts import E0, C, M0, EV2ERG, K2B, SIE0,\
     SIM0, FINE_STR, PI, PI2, SQ3, E2W, CHeVcm, CHBAR
 
@@ -211,9 +211,10 @@ class BendingMagnet(object):
         precalc = True
         rMax = int(self.nrays)
         if precalc:
-            rE = np.random.uniform(self.E_min, self.E_max, rMax)
-            rTheta = np.random.uniform(0., self.Theta_max, rMax)
-            rPsi = np.random.uniform(0., self.Psi_max, rMax)
+            rng = raycing.get_rng()
+            rE = rng.uniform(self.E_min, self.E_max, rMax)
+            rTheta = rng.uniform(0., self.Theta_max, rMax)
+            rPsi = rng.uniform(0., self.Psi_max, rMax)
             DistI = self.build_I_map(rE, rTheta, rPsi)[0]
             f_max = np.amax(DistI)
             a_max = np.argmax(DistI)
@@ -255,7 +256,7 @@ class BendingMagnet(object):
 
         if self.filamentBeam:
             self.nrepmax = np.floor(rMax / len(np.where(
-                self.Imax * np.random.rand(rMax) < DistI)[0]))
+                self.Imax * raycing.get_rng().random(rMax) < DistI)[0]))
 
         """Preparing to calculate the total flux integral"""
         self.xzE = 4 * (self.E_max-self.E_min) * self.Theta_max * self.Psi_max
@@ -271,8 +272,8 @@ class BendingMagnet(object):
         if self.eEspread > 0:
             if np.array(dde).shape:
                 if dde.shape[0] > 1:
-                    gamma += np.random.normal(0, gamma*self.eEspread,
-                                              dde.shape)
+                    gamma += raycing.get_rng().normal(
+                        0, gamma*self.eEspread, dde.shape)
             gamma2 = gamma**2
         else:
             gamma2 = self.gamma2
@@ -333,10 +334,11 @@ class BendingMagnet(object):
 
         .. Returned values: beamGlobal
         """
+        rng = raycing.get_rng()
         if self.uniformRayDensity:
             withAmplitudes = True
 
-        bo = None
+        bos = BeamBuffer(self.nrays)
         length = 0
         seeded = np.long(0)
         seededI = 0.
@@ -345,35 +347,35 @@ class BendingMagnet(object):
         mcRays = self.nrays * 1.2 if not self.uniformRayDensity else self.nrays
         if self.filamentBeam:
             if accuBeam is None:
-                rE = np.random.random_sample() *\
+                rE = rng.random() *\
                     float(self.E_max - self.E_min) + self.E_min
                 if self.isMPW:
                     sigma_r2 = 2 * (CHeVcm/rE*10*self.L0*self.Np) / PI2**2
                     sourceSIGMAx = self.dx
                     sourceSIGMAz = self.dz
-                    rTheta0 = np.random.random_sample() *\
+                    rTheta0 = rng.random() *\
                         (self.Theta_max - self.Theta_min) + self.Theta_min
                     ryNp = 0.5 * self.L0 *\
                         (np.arccos(rTheta0 * self.gamma / self.K) / PI) +\
                         0.5 * self.L0 *\
-                        np.random.random_integers(0, int(2*self.Np - 1))
+                        rng.integers(0, int(2*self.Np - 1), endpoint=True)
                     rY = ryNp - 0.5*self.L0*self.Np
                     if (ryNp - 0.25*self.L0 <= 0):
                         rY += self.L0*self.Np
                     rX = self.X0 * np.sin(PI2 * rY / self.L0) +\
-                        sourceSIGMAx * np.random.standard_normal()
+                        sourceSIGMAx * rng.standard_normal()
                     rY -= 0.25 * self.L0
-                    rZ = sourceSIGMAz * np.random.standard_normal()
+                    rZ = sourceSIGMAz * rng.standard_normal()
                 else:
-                    rZ = self.dz * np.random.standard_normal()
-                    rTheta0 = np.random.random_sample() *\
+                    rZ = self.dz * rng.standard_normal()
+                    rTheta0 = rng.random() *\
                         (self.Theta_max - self.Theta_min) + self.Theta_min
-                    R1 = self.dx * np.random.standard_normal() +\
+                    R1 = self.dx * rng.standard_normal() +\
                         self.ro * 1000.
                     rX = -R1 * np.cos(rTheta0) + self.ro*1000.
                     rY = R1 * np.sin(rTheta0)
-                dtheta = self.dxprime * np.random.standard_normal()
-                dpsi = self.dzprime * np.random.standard_normal()
+                dtheta = self.dxprime * rng.standard_normal()
+                dpsi = self.dzprime * rng.standard_normal()
             else:
                 rE = accuBeam.E[0]
                 rX = accuBeam.x[0]
@@ -393,7 +395,7 @@ class BendingMagnet(object):
             1: Theta / horizontal
             2: Psi / vertical
             3: Monte-Carlo discriminator"""
-            rnd_r = np.random.rand(mcRays, 4)
+            rnd_r = rng.random((mcRays, 4))
             seeded += mcRays
             if self.filamentBeam:
                 rThetaMin = np.max(self.Theta_min, rTheta0 - 1 / self.gamma)
@@ -438,14 +440,14 @@ class BendingMagnet(object):
 
             if not self.filamentBeam:
                 if self.dxprime > 0:
-                    dtheta = np.random.normal(0, self.dxprime, npassed)
+                    dtheta = rng.normal(0, self.dxprime, npassed)
                 else:
                     dtheta = 0
                 if not self.isMPW:
-                    dtheta += np.random.normal(0, 1/self.gamma, npassed)
+                    dtheta += rng.normal(0, 1/self.gamma, npassed)
 
                 if self.dzprime > 0:
-                    dpsi = np.random.normal(0, self.dzprime, npassed)
+                    dpsi = rng.normal(0, self.dzprime, npassed)
                 else:
                     dpsi = 0
 
@@ -473,16 +475,15 @@ class BendingMagnet(object):
                     yNp = 0.5 * self.L0 *\
                         (np.arccos(Theta0 * self.gamma / self.K) / PI) +\
                         0.5 * self.L0 *\
-                        np.random.random_integers(0,
-                                                  int(2*self.Np - 1),
-                                                  npassed)
+                        rng.integers(0, int(2*self.Np - 1), npassed,
+                                     endpoint=True)
                     bot.y[:] = np.where(
                         yNp - 0.25*self.L0 > 0,
                         yNp, self.L0*self.Np + yNp) - 0.5*self.L0*self.Np
                     bot.x[:] = self.X0 * np.sin(PI2 * bot.y / self.L0) +\
-                        np.random.normal(0., bot.sourceSIGMAx, npassed)
+                        rng.normal(0., bot.sourceSIGMAx, npassed)
                     bot.y[:] -= 0.25 * self.L0
-                    bot.z[:] = np.random.normal(0., bot.sourceSIGMAz, npassed)
+                    bot.z[:] = rng.normal(0., bot.sourceSIGMAz, npassed)
                 bot.Jsp[:] = np.zeros(npassed)
             else:
                 if self.filamentBeam:
@@ -491,9 +492,9 @@ class BendingMagnet(object):
                     bot.y[:] = rY
                 else:
                     if self.dz > 0:
-                        bot.z[:] = np.random.normal(0., self.dz, npassed)
+                        bot.z[:] = rng.normal(0., self.dz, npassed)
                     if self.dx > 0:
-                        R1 = np.random.normal(self.ro*1e3, self.dx, npassed)
+                        R1 = rng.normal(self.ro*1e3, self.dx, npassed)
                     else:
                         R1 = self.ro * 1e3
                     bot.x[:] = -R1 * np.cos(Theta0) + self.ro*1000.
@@ -511,11 +512,8 @@ class BendingMagnet(object):
                 bot.Es[:] = mJss[I_pass]
                 bot.Ep[:] = mJpp[I_pass]
 
-            if bo is None:
-                bo = bot
-            else:
-                bo.concatenate(bot)
-            length = len(bo.a)
+            bos.append(bot)
+            length = len(bos)
             if _DEBUG > 20:
                 print("{0} rays of {1}".format(length, self.nrays))
             if self.filamentBeam:
@@ -528,6 +526,7 @@ class BendingMagnet(object):
             if _DEBUG:
                 sys.stdout.flush()
 
+        bo = bos.get_beam()
         if length >= self.nrays:
             bo.accepted = length * self.fluxConst
             bo.acceptedE = bo.E.sum() * self.fluxConst * SIE0
@@ -1095,16 +1094,17 @@ class Undulator(object):
                       's' if self.gIntervals > 1 else ''))
 
         if self.filamentBeam:
+            rng = raycing.get_rng()
             rMax = self.nrays
-            rE = np.random.uniform(self.E_min, self.E_max, rMax)
-            rTheta = np.random.uniform(self.Theta_min, self.Theta_max, rMax)
-            rPsi = np.random.uniform(self.Psi_min, self.Psi_max, rMax)
+            rE = rng.uniform(self.E_min, self.E_max, rMax)
+            rTheta = rng.uniform(self.Theta_min, self.Theta_max, rMax)
+            rPsi = rng.uniform(self.Psi_min, self.Psi_max, rMax)
             tmpEspread = self.eEspread
             self.eEspread = 0
             DistI = self.build_I_map(rE, rTheta, rPsi)[0]
             self.Imax = np.max(DistI) * 1.2
             self.nrepmax = np.floor(rMax / len(np.where(
-                self.Imax * np.random.rand(rMax) < DistI)[0]))
+                self.Imax * rng.random(rMax) < DistI)[0]))
             self.eEspread = tmpEspread
         else:
             self.Imax = 0.
@@ -1351,7 +1351,7 @@ class Undulator(object):
                 if w.shape[0] > 1:
                     if self.filamentBeam:
                         gamma += gamma * self.eEspread * np.ones_like(w) *\
-                            np.random.standard_normal()
+                            raycing.get_rng().standard_normal()
                     else:
                         gamma += dgamma * np.ones_like(w)
             gamma2 = gamma**2
@@ -1410,7 +1410,7 @@ class Undulator(object):
                     if self.filamentBeam:
                         gamma += gamma * self.eEspread * \
                             np.ones_like(w, dtype=self.cl_precisionF) *\
-                            np.random.standard_normal()
+                            raycing.get_rng().standard_normal()
                     else:
                         gamma += dgamma * \
                             np.ones_like(w, dtype=self.cl_precisionF)
@@ -1571,7 +1571,7 @@ class Undulator(object):
                     if self.filamentBeam:
                         gamma += gamma * self.eEspread * \
                             np.ones_like(w, dtype=self.cl_precisionF) *\
-                            np.random.standard_normal()
+                            raycing.get_rng().standard_normal()
                     else:
                         gamma += dgamma * \
                             np.ones_like(w, dtype=self.cl_precisionF)
@@ -1694,6 +1694,7 @@ class Undulator(object):
 
         .. Returned values: beamGlobal
         """
+        rng = raycing.get_rng()
         if wave is not None:
             if not hasattr(wave, 'rDiffr'):
                 raise ValueError("If you want to use a `wave`, run a" +
@@ -1708,7 +1709,7 @@ class Undulator(object):
         if not self.uniformRayDensity:
             if _DEBUG > 10:
                 print("Rays generation")
-        bo = None
+        bos = BeamBuffer(self.nrays)
         length = 0
         seeded = np.long(0)
         seededI = 0.
@@ -1716,12 +1717,12 @@ class Undulator(object):
         np.seterr(divide='warn')
         if self.filamentBeam:
             if accuBeam is None:
-                rsE = np.random.random_sample() * \
+                rsE = rng.random() * \
                     float(self.E_max - self.E_min) + self.E_min
-                rX = self.dx * np.random.standard_normal()
-                rZ = self.dz * np.random.standard_normal()
-                dtheta = self.dxprime * np.random.standard_normal()
-                dpsi = self.dzprime * np.random.standard_normal()
+                rX = self.dx * rng.standard_normal()
+                rZ = self.dz * rng.standard_normal()
+                dtheta = self.dxprime * rng.standard_normal()
+                dpsi = self.dzprime * rng.standard_normal()
             else:
                 rsE = accuBeam.E[0]
                 rX = accuBeam.filamentDX
@@ -1735,8 +1736,8 @@ class Undulator(object):
                 self.theta0 = dtheta
                 self.psi0 = dpsi
             else:
-                self.theta0 = np.random.normal(0, self.dxprime, mcRays)
-                self.psi0 = np.random.normal(0, self.dzprime, mcRays)
+                self.theta0 = rng.normal(0, self.dxprime, mcRays)
+                self.psi0 = rng.normal(0, self.dzprime, mcRays)
 
         if fixedEnergy:
             rsE = fixedEnergy
@@ -1749,7 +1750,7 @@ class Undulator(object):
             if self.filamentBeam or fixedEnergy:
                 rE = rsE * np.ones(mcRays)
             else:
-                rndg = np.random.rand(mcRays)
+                rndg = rng.random(mcRays)
                 rE = rndg * float(self.E_max - self.E_min) + self.E_min
 
             if wave is not None:
@@ -1758,9 +1759,9 @@ class Undulator(object):
                     shiftX = rX
                     shiftZ = rZ
                 else:
-                    shiftX = np.random.normal(
+                    shiftX = rng.normal(
                         0, self.dx, mcRays) if self.dx > 0 else 0
-                    shiftZ = np.random.normal(
+                    shiftZ = rng.normal(
                         0, self.dz, mcRays) if self.dz > 0 else 0
                 x = wave.xDiffr + shiftX
                 y = wave.yDiffr
@@ -1773,14 +1774,14 @@ class Undulator(object):
                     rPsi += dpsi
                 else:
                     if self.dxprime > 0:
-                        rTheta += np.random.normal(0, self.dxprime, mcRays)
+                        rTheta += rng.normal(0, self.dxprime, mcRays)
                     if self.dzprime > 0:
-                        rPsi += np.random.normal(0, self.dzprime, mcRays)
+                        rPsi += rng.normal(0, self.dzprime, mcRays)
             else:
-                rndg = np.random.rand(mcRays)
+                rndg = rng.random(mcRays)
                 rTheta = rndg * (self.Theta_max - self.Theta_min) +\
                     self.Theta_min
-                rndg = np.random.rand(mcRays)
+                rndg = rng.random(mcRays)
                 rPsi = rndg * (self.Psi_max - self.Psi_min) + self.Psi_min
 
             Intensity, mJs, mJp = self.build_I_map(rE, rTheta, rPsi)
@@ -1800,7 +1801,7 @@ class Undulator(object):
                 I_pass = slice(None)
                 npassed = mcRays
             else:
-                rndg = np.random.rand(mcRays)
+                rndg = rng.random(mcRays)
                 I_pass = np.where(self.Imax * rndg < Intensity)[0]
                 npassed = len(I_pass)
             if npassed == 0:
@@ -1829,13 +1830,13 @@ class Undulator(object):
                 if self.full:
                     bot.sourceSIGMAx = self.dx
                     bot.sourceSIGMAz = self.dz
-                    dxR = np.random.normal(0, bot.sourceSIGMAx, npassed)
-                    dzR = np.random.normal(0, bot.sourceSIGMAz, npassed)
+                    dxR = rng.normal(0, bot.sourceSIGMAx, npassed)
+                    dzR = rng.normal(0, bot.sourceSIGMAz, npassed)
                 else:
                     bot.sourceSIGMAx = (self.dx**2 + sigma_r2)**0.5
                     bot.sourceSIGMAz = (self.dz**2 + sigma_r2)**0.5
-                    dxR = np.random.normal(0, bot.sourceSIGMAx, npassed)
-                    dzR = np.random.normal(0, bot.sourceSIGMAz, npassed)
+                    dxR = rng.normal(0, bot.sourceSIGMAx, npassed)
+                    dzR = rng.normal(0, bot.sourceSIGMAz, npassed)
 
             if wave is not None:
                 wave.rDiffr = ((wave.xDiffr - dxR)**2 + wave.yDiffr**2 +
@@ -1856,10 +1857,10 @@ class Undulator(object):
                         bot.c[:] += dpsi
                     else:
                         if self.dxprime > 0:
-                            bot.a[:] += np.random.normal(
+                            bot.a[:] += rng.normal(
                                 0, self.dxprime, npassed)
                         if self.dzprime > 0:
-                            bot.c[:] += np.random.normal(
+                            bot.c[:] += rng.normal(
                                 0, self.dzprime, npassed)
 
             mJs = mJs[I_pass]
@@ -1884,11 +1885,8 @@ class Undulator(object):
                 bot.Es[:] = mJs
                 bot.Ep[:] = mJp
 
-            if bo is None:
-                bo = bot
-            else:
-                bo.concatenate(bot)
-            length = len(bo.a)
+            bos.append(bot)
+            length = len(bos)
             if not self.uniformRayDensity:
                 if _DEBUG > 10:
                     print("{0} rays of {1}".format(length, self.nrays))
@@ -1899,14 +1897,14 @@ class Undulator(object):
                 rep_condition = length < self.nrays
             if self.uniformRayDensity:
                 rep_condition = False
-
-            bo.accepted = length * self.fluxConst
-            bo.acceptedE = bo.E.sum() * self.fluxConst * SIE0
-            bo.seeded = seeded
-            bo.seededI = seededI
             if _DEBUG:
                 sys.stdout.flush()
 
+        bo = bos.get_beam()
+        bo.accepted = length * self.fluxConst
+        bo.acceptedE = bo.E.sum() * self.fluxConst * SIE0
+        bo.seeded = seeded
+        bo.seededI = seededI
         if length > self.nrays and not self.filamentBeam and wave is None:
             bo.filter_by_index(slice(0, self.nrays))
         if self.filamentBeam:
@@ -6,6 +6,26 @@ deriving from :mod:`multiprocessing` or :mod:`threading` by selecting the
 corresponding parameter in :func:`~xrt.runner.run_ray_tracing`. The
 multiprocessing is normally faster than multithreading but has an inconvenience
 when the user aborts the execution: the processes have to be killed manually.
+
+If *persistentWorkers* is set in :func:`~xrt.runner.run_ray_tracing`, the
+processes or threads are not respawned at every repeat but are kept in a
+:class:`WorkerPool` for the whole run, including the generator scan steps.
+Persistent worker processes accumulate their histograms in per-worker
+:class:`SharedHistograms` slabs; only the counters travel over the queues and
+the slabs are summed up by the job server.
+
+The 1D and 2D histograms of a plot are calculated in one pass: the bin indices
+of x, y and color data are found only once per iteration and all the weights
+(intensity, the three RGB components and, for the 'E' flux kinds, the real and
+imaginary parts of the field) are scattered into the bins by a single
+``numpy.bincount`` per histogram, see :func:`bin_indices` and
+:func:`scatter_to_bins`. Set the module variable ``_FUSED_HISTOGRAMS`` to False
+to return to the separate ``numpy.histogram`` calls.
+
+If the plot has *deferColor* set (see :mod:`~xrt.plotter`), the rays are not
+converted from HSV to RGB. Instead, the hue moments (see
+:func:`hue_segments`) are histogrammed and converted to RGB per bin by
+:func:`hue_moments_to_rgb` only when the plot is rendered.
 """
 __author__ = "Konstantin Klementiev, Roman Chernikov"
 __date__ = "26 Mar 2016"
@@ -13,6 +33,7 @@ __date__ = "26 Mar 2016"
 import os
 import time
 from multiprocessing import Process
+from multiprocessing.sharedctypes import RawArray
 from threading import Thread
 import numpy as np
 from . import kde
@@ -26,6 +47,298 @@ __dir__ = os.path.dirname(__file__)
 
 
 _DEBUG = 1
+_FUSED_HISTOGRAMS = True
+nHueMoments = 12  # 6 hue segments times 2 moments
+
+# the histogram items of outList that can be passed via shared memory:
+sharedOutFields = {0: 'xtotal1D', 1: 'xtotal1D_RGB',
+                   3: 'ytotal1D', 4: 'ytotal1D_RGB',
+                   6: 'etotal1D', 7: 'etotal1D_RGB',
+                   9: 'total2D', 10: 'total2D_RGB', 11: 'total4D'}
+
+
+def bin_indices(x, limits, bins):
+    """
+    Returns the bin indices of *x* for *bins* equal bins within *limits* and
+    the bin edges. The binning is exactly as in ``numpy.histogram``: the bins
+    are half-open, except the last one, which includes the right edge. The
+    values outside of *limits* get the index -1.
+    """
+    lo, hi = float(limits[0]), float(limits[1])
+    binEdges = np.linspace(lo, hi, bins+1)
+    x = np.asarray(x)
+    indices = np.full(x.shape, -1, dtype=np.intp)
+    inside = (x >= lo) & (x <= hi)
+    xIn = x[inside]
+    ind = ((xIn - lo) * (bins / (hi - lo))).astype(np.intp)
+    ind[ind == bins] -= 1
+# correct for the round-off errors as numpy.histogram does:
+    ind[xIn < binEdges[ind]] -= 1
+    ind[(xIn >= binEdges[ind+1]) & (ind != bins-1)] += 1
+    indices[inside] = ind
+    return indices, binEdges
+
+
+def scatter_to_bins(indices, weights, bins, columns=None, k=None):
+    """
+    Sums up the columns of *weights*, shape(NumberOfRays, m), into *bins* bins
+    given by *indices* (all must be valid). All m columns are scattered by one
+    ``numpy.bincount`` call. Returns an array of shape(*bins*, *k*).
+
+    If *columns* is None, *k* = m and the column j of *weights* goes to the
+    column j of the result. Otherwise *columns*, of the same shape as
+    *weights*, gives the result column for every weight and every ray.
+    """
+    if columns is None:
+        k = weights.shape[1]
+        columns = np.arange(k)
+    flatIndices = (indices[:, np.newaxis]*k + columns).ravel()
+    return np.bincount(flatIndices, weights=weights.ravel(),
+                       minlength=bins*k).reshape(bins, k)
+
+
+def hue_segments(hue):
+    """
+    Splits *hue* (0 to 1) into the 6 segments of the HSV color cone where
+    the RGB components are linear in value and hue. Returns the segment index
+    and the fractional hue within the segment, exactly as in
+    ``matplotlib.colors.hsv_to_rgb``. For a ray of value (intensity) v, the
+    hue moments are v and v*fraction, accumulated in the columns 2*segment and
+    2*segment+1 of the *nHueMoments* moments.
+    """
+    h6 = np.asarray(hue).ravel() * 6.
+    segment = h6.astype(int)
+    fraction = h6 - segment
+    return segment % 6, fraction
+
+
+def hue_moments_to_rgb(moments, saturation):
+    """
+    Converts the accumulated hue moments, shape(..., *nHueMoments*), into RGB
+    colors, shape(..., 3). The result equals the sum of
+    ``matplotlib.colors.hsv_to_rgb`` of the individual rays with constant
+    *saturation*.
+    """
+    moments = np.asarray(moments)
+    m = moments.reshape(moments.shape[:-1] + (6, 2))
+    v, vf = m[..., 0], m[..., 1]
+    p = v * (1-saturation)
+    q = v - saturation*vf
+    t = p + saturation*vf
+    comps = np.stack((v, p, q, t), axis=-1)
+# the components (v, p, q, t) in (R, G, B) within each of the 6 segments:
+    table = ((0, 3, 1), (2, 0, 1), (1, 0, 3), (1, 2, 0), (3, 1, 0), (0, 1, 2))
+    rgb = np.zeros(moments.shape[:-1] + (3,))
+    for segment, comp in enumerate(table):
+        rgb += comps[..., segment, comp]
+    return rgb
+
+
+def data_range(x):
+    """Returns (min, max, size) of *x*; min and max are None for fewer than 2
+    values. Used for finding the automatic limits of the plot axes."""
+    if len(x) > 1:
+        return np.min(x), np.max(x), len(x)
+    else:
+        return None, None, len(x)
+
+
+def merge_data_ranges(ranges):
+    """Merges the data ranges found by :func:`data_range` for several samples
+    (e.g. by several workers) into one."""
+    mins = [r[0] for r in ranges if r[0] is not None]
+    maxs = [r[1] for r in ranges if r[1] is not None]
+    size = sum(r[2] for r in ranges)
+    if mins:
+        return min(mins), max(maxs), size
+    else:
+        return None, None, size
+
+
+def update_axis_limits(axis, dataRange):
+    """
+    Updates the *axis* limits, if they are not given, from *dataRange* found
+    by :func:`data_range` or :func:`merge_data_ranges`, with the extra margin
+    of *axis.extraMargin* bins. Returns the limits.
+    """
+    if (axis.limits is None) or isinstance(axis.limits, str):
+        if dataRange[0] is not None:
+            xmin, xmax = dataRange[0], dataRange[1]
+            dx = axis.extraMargin * (xmax-xmin) / axis.bins
+            xmin -= dx
+            xmax += dx
+            if xmin == xmax:
+                xmin -= 1.
+                xmax += 1.
+        else:
+            xmin, xmax = 1., 10.
+        if isinstance(axis.limits, str):
+            xmm = max(abs(xmin), abs(xmax))
+            xmin, xmax = -xmm, xmm
+        axis.limits = [xmin, xmax]
+    else:
+        xmin, xmax = axis.limits[0], axis.limits[1]
+    return xmin, xmax
+
+
+def equalize_xy(plot, leadingLimits):
+    """
+    Updates the limits of *xaxis* and *yaxis* according to the given
+    *aspect*.
+    """
+    if plot.aspect == 'equal':
+        plot.aspect = 1.0
+    if not isinstance(plot.aspect, float):
+        return
+    xaxis = plot.xaxis
+    yaxis = plot.yaxis
+    aspect = plot.aspect * xaxis.pixels / float(yaxis.pixels)
+    dx = xaxis.limits[1] - xaxis.limits[0]
+    dy = yaxis.limits[1] - yaxis.limits[0]
+    if aspect == 1.0 and dx == dy:
+        return
+
+    if leadingLimits is None:
+        if dx > (dy * aspect):
+            leadingLimits = 'x'
+        else:
+            leadingLimits = 'y'
+    if leadingLimits == 'x':
+        yMid = (yaxis.limits[1]+yaxis.limits[0]) / 2.
+        dy2 = dx / aspect / 2
+        yaxis.limits = [yMid-dy2, yMid+dy2]
+    else:
+        xMid = (xaxis.limits[1]+xaxis.limits[0]) / 2.
+        dx2 = dy * aspect / 2
+        xaxis.limits = [xMid-dx2, xMid+dx2]
+    return xaxis.limits[0], xaxis.limits[1], yaxis.limits[0],\
+        yaxis.limits[1]
+
+
+def update_plot_limits(plot, xRange, yRange, cRange):
+    """
+    Sets the missing limits of the three axes of *plot* from the data ranges
+    and equalizes x and y limits according to *plot.aspect*. Returns
+    (xmin, xmax, ymin, ymax, emin, emax). Used at the 1st iteration or by the
+    pilot run, see *pilotRays* in :func:`~xrt.runner.run_ray_tracing`.
+    """
+    leadingLimits = None
+    xLimitsDefined = (plot.xaxis.limits is not None) and \
+        (not isinstance(plot.xaxis.limits, str))
+    yLimitsDefined = (plot.yaxis.limits is not None) and \
+        (not isinstance(plot.yaxis.limits, str))
+    if xLimitsDefined and (not yLimitsDefined):
+        leadingLimits = 'x'
+    elif yLimitsDefined and (not xLimitsDefined):
+        leadingLimits = 'y'
+    xmin, xmax = update_axis_limits(plot.xaxis, xRange)
+    ymin, ymax = update_axis_limits(plot.yaxis, yRange)
+    emin, emax = update_axis_limits(plot.caxis, cRange)
+    if plot.aspect == 'equal' or isinstance(plot.aspect, (int, float)):
+        xyeq = equalize_xy(plot, leadingLimits)
+        if xyeq is not None:
+            xmin, xmax, ymin, ymax = xyeq
+    return xmin, xmax, ymin, ymax, emin, emax
+
+
+def reduce_source_rays(beamLine, nrays):
+    """
+    Limits the number of rays of the sources of *beamLine* to *nrays* for a
+    pilot run. The mesh sources are not touched. Returns a list of (source,
+    previous nrays) for :func:`restore_source_rays`.
+    """
+    saved = []
+    for source in beamLine.sources:
+        if hasattr(source, 'nrays') and not hasattr(source, 'nx'):
+            saved.append((source, source.nrays))
+            source.nrays = min(source.nrays, nrays)
+    return saved
+
+
+def restore_source_rays(saved):
+    """Restores the number of rays changed by :func:`reduce_source_rays`."""
+    for source, nrays in saved:
+        source.nrays = nrays
+
+
+class SharedHistograms(object):
+    """
+    A slab of histogram arrays of one plot allocated in shared memory. The
+    field names follow those of :class:`~xrt.plotter.SaveResults`. The slab
+    must be created before the worker process is started as the shared memory
+    can only be inherited by the child processes. Every worker process has
+    its own slab per plot, so that the workers add to them without locking;
+    the shared memory is thus the number of processes times the size of the
+    histograms of all plots, see *persistentWorkers* in
+    :func:`~xrt.runner.run_ray_tracing`.
+    """
+    def __init__(self, plot, idN):
+        self.idN = idN
+        self.fields = []
+        nColors = nHueMoments if getattr(plot, 'deferColor', False) else 3
+        for prefix, axis in zip('xye', (plot.xaxis, plot.yaxis, plot.caxis)):
+            self.fields.append((prefix+'total1D', (axis.bins,), np.float64))
+            self.fields.append(
+                (prefix+'total1D_RGB', (axis.bins, nColors), np.float64))
+        if plot.fluxKind.startswith('E'):
+            dtype = np.complex128
+        else:
+            dtype = np.float64
+        xybins = plot.yaxis.bins, plot.xaxis.bins
+        self.fields.append(('total2D', xybins, dtype))
+        self.fields.append(('total2D_RGB', xybins + (nColors,), np.float64))
+        if (plot.fluxKind.lower().endswith('4d') or
+                plot.fluxKind.lower().endswith('pca')):
+            size2D = xybins[0] * xybins[1]
+            self.fields.append(('total4D', (size2D, size2D), dtype))
+        nbytes = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize
+                     for name, shape, dtype in self.fields)
+        self.raw = RawArray('b', nbytes)
+        self._arrays = None
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        odict['_arrays'] = None  # numpy views are rebuilt in the new process
+        return odict
+
+    def arrays(self):
+        """Returns a dictionary of numpy views into the shared slab."""
+        if self._arrays is None:
+            self._arrays = {}
+            offset = 0
+            for name, shape, dtype in self.fields:
+                count = int(np.prod(shape))
+                self._arrays[name] = np.frombuffer(
+                    self.raw, dtype=dtype, count=count,
+                    offset=offset).reshape(shape)
+                offset += count * np.dtype(dtype).itemsize
+        return self._arrays
+
+    def put(self, outList):
+        """Adds the histograms of *outList* to the slab and replaces them in
+        *outList* by the worker id, as the outLists of different workers
+        arrive in an arbitrary order. The histograms of unexpected shape, e.g.
+        after a change of bins in a generator, stay in *outList*."""
+        arrays = self.arrays()
+        for ind, name in sharedOutFields.items():
+            hist = outList[ind]
+            if (hist is None) or (name not in arrays):
+                continue
+            if arrays[name].shape != np.shape(hist):
+                continue
+            arrays[name] += hist
+            outList[ind] = self.idN
+
+    def take(self, ind, total):
+        """Adds the slab array corresponding to the *ind* item of outList to
+        *total* and zeros the slab array."""
+        arr = self.arrays()[sharedOutFields[ind]]
+        total += arr
+        arr[:] = 0
+
+    def clear(self):
+        for arr in self.arrays().values():
+            arr[:] = 0
 
 
 class GenericProcessOrThread(object):
@@ -40,11 +353,15 @@ class GenericProcessOrThread(object):
         if locCard.backend.startswith('shadow'):
             self.runDir = locCard.cwd + os.sep + 'tmp' + str(idLoc)
         self.idN = idLoc
+        self.ppid = idLoc
+        self.iteration = locCard.iteration
         self.status = 0
         self.plots = plots
         self.outPlotQueues = outPlotQueues
         self.alarmQueue = alarmQueue
         self.card = locCard
+        self.slabs = None
+        self.pilot = False
 
     def do_hist1d(self, x, intensity, cDataRGB, axis):
         """
@@ -152,23 +469,8 @@ class GenericProcessOrThread(object):
                 y, x, bins=xybins, range=xyrange, weights=intensity.real)
             hist2di, t1, t2 = histogram2d(
                 y, x, bins=xybins, range=xyrange, weights=intensity.imag)
-            hist2d = hist2dr + 1j*hist2di
-
-            size2D = plot.yaxis.bins * plot.xaxis.bins
-            if plot.fluxKind.lower().endswith('4d'):
-                hist4d = np.outer(hist2d, hist2d.conjugate())
-            elif plot.fluxKind.lower().endswith('pca'):
-                hist4d = np.zeros((size2D, size2D), dtype=np.complex128)
-                if self.ppid < size2D:
-                    hist4d[:, self.ppid] = hist2d.flatten()
-                else:
-                    print('Warning: too many images (repeats) to save for PCA!'
-                          'The next repeats will be ignored.')
-
-# equivalent to np.outer(hist2d.flatten(), hist2d.flatten().conjugate())
-            fl = hist2d.flatten()
-            central = fl[len(fl)//2]
-            hist2d *= central.conjugate()
+            hist2d, hist4d = self.do_mutual_intensity(
+                hist2dr + 1j*hist2di, plot)
         else:
             hist2d, yedges, xedges = histogram2d(
                 y, x, bins=xybins, range=xyrange, weights=intensity)
@@ -180,75 +482,194 @@ class GenericProcessOrThread(object):
                     y, x, bins=xybins, range=xyrange, weights=cDataRGB[:, i])
         return hist2d, hist2dRGB, hist4d
 
+    def do_mutual_intensity(self, hist2d, plot):
+        """
+        Calculates the mutual intensity from the 2D histogram of the complex
+        field *hist2d*. Returns the mutual intensity relative to the central
+        point and, for the '4D' and 'PCA' flux kinds, the complete mutual
+        intensity (or one column of it for PCA), otherwise None.
+        """
+        hist4d = None
+        size2D = plot.yaxis.bins * plot.xaxis.bins
+        if plot.fluxKind.lower().endswith('4d'):
+            hist4d = np.outer(hist2d, hist2d.conjugate())
+        elif plot.fluxKind.lower().endswith('pca'):
+            hist4d = np.zeros((size2D, size2D), dtype=np.complex128)
+            if self.ppid < size2D:
+                hist4d[:, self.ppid] = hist2d.flatten()
+            else:
+                print('Warning: too many images (repeats) to save for PCA!'
+                      'The next repeats will be ignored.')
+
+# equivalent to np.outer(hist2d.flatten(), hist2d.flatten().conjugate())
+        fl = hist2d.flatten()
+        central = fl[len(fl)//2]
+        hist2d *= central.conjugate()
+        return hist2d, hist4d
+
+    def can_fuse_histograms(self, plot):
+        """
+        Tells whether the histograms of *plot* can be calculated by
+        :meth:`do_fused_hists`. The kde density and the 'xx' and 'zz' mutual
+        intensity cuts go the old way. The plots with deferred coloring are
+        always histogrammed here.
+        """
+        if getattr(plot, 'deferColor', False):
+            return True
+        if not _FUSED_HISTOGRAMS:
+            return False
+        for axis in (plot.xaxis, plot.yaxis, plot.caxis):
+            if axis.density.lower() == 'kde':
+                return False
+            if not raycing.is_sequence(axis.limits):
+                return False
+        fluxKind = plot.fluxKind.lower()
+        if plot.fluxKind.startswith('E') and (
+                fluxKind.endswith('xx') or fluxKind.endswith('yy') or
+                fluxKind.endswith('zz')):
+            return False
+        return True
+
+    def do_fused_hists(self, x, y, cData, intensity, flux, cDataRGB, plot,
+                       hue=None):
+        """
+        Calculates all the 1D and 2D histograms of *plot* in one pass. The
+        bin indices of *x*, *y* and *cData* are calculated once and the
+        intensity *flux* and the color weights *cDataRGB* are scattered into
+        the bins together. For the 'E' flux kinds the 2D histogram is made of
+        the complex *intensity*. Returns the same histograms as
+        :meth:`do_hist1d` for x, y and c and :meth:`do_hist2d`.
+
+        If *hue* is given, *cDataRGB* is ignored and the color histograms
+        are those of the hue moments, see :func:`hue_segments`.
+        """
+        xaxis, yaxis, caxis = plot.xaxis, plot.yaxis, plot.caxis
+        flux = np.asarray(flux, dtype=np.float64)
+        ix, xbe = bin_indices(x, xaxis.limits, xaxis.bins)
+        iy, ybe = bin_indices(y, yaxis.limits, yaxis.bins)
+        if hue is None:
+            colorWeights = cDataRGB
+            colorColumns = None
+            nColors = 3
+        else:
+            segment, fraction = hue_segments(hue)
+            colorWeights = np.column_stack((flux, flux*fraction))
+            colorColumns = np.column_stack((2*segment, 2*segment + 1))
+            nColors = nHueMoments
+        weights = np.column_stack((flux, colorWeights))
+        if colorColumns is None:
+            columns = None
+        else:
+            columns = np.column_stack((np.zeros_like(segment), 1+colorColumns))
+
+        def hist1d(ind, bins):
+            good = ind >= 0
+            h = scatter_to_bins(
+                ind[good], weights[good], bins,
+                None if columns is None else columns[good], 1+nColors)
+            return h[:, 0], h[:, 1:]
+
+        xh, xhRGB = hist1d(ix, xaxis.bins)
+        yh, yhRGB = hist1d(iy, yaxis.bins)
+        if plot.ePos:
+            ie, ebe = bin_indices(cData, caxis.limits, caxis.bins)
+            eh, ehRGB = hist1d(ie, caxis.bins)
+        else:
+            eh, ehRGB, ebe = None, None, None
+
+        good = (ix >= 0) & (iy >= 0)
+        ixy = iy[good]*xaxis.bins + ix[good]
+        size2D = yaxis.bins * xaxis.bins
+        xybins = yaxis.bins, xaxis.bins
+        isE = plot.fluxKind.startswith('E')
+        if isE:
+            weights2D = np.column_stack(
+                (intensity.real, intensity.imag, colorWeights))[good]
+            if columns is not None:
+                columns = np.column_stack(
+                    (np.zeros_like(segment), np.ones_like(segment),
+                     2+colorColumns))
+            nOther = 2
+        else:
+            weights2D = weights[good]
+            nOther = 1
+        h = scatter_to_bins(
+            ixy, weights2D, size2D,
+            None if columns is None else columns[good], nOther+nColors)
+        hist2dRGB = h[:, nOther:].reshape(xybins + (nColors,))
+        hist4d = None
+        if isE:
+            hist2d, hist4d = self.do_mutual_intensity(
+                (h[:, 0] + 1j*h[:, 1]).reshape(xybins), plot)
+        else:
+            hist2d = h[:, 0].reshape(xybins)
+        return (xh, xhRGB, xbe, yh, yhRGB, ybe, eh, ehRGB, ebe,
+                hist2d, hist2dRGB, hist4d)
+
     def update_limits(self, axis, x):
         """
         Updates the *axis* limits given the data in *x*. Used at the 1st
         iteration."""
-        if (axis.limits is None) or isinstance(axis.limits, str):
-            if len(x) > 1:
-                xmin, xmax = np.min(x), np.max(x)
-                dx = axis.extraMargin * (xmax-xmin) / axis.bins
-                xmin -= dx
-                xmax += dx
-                if xmin == xmax:
-                    xmin -= 1.
-                    xmax += 1.
-            else:
-                xmin, xmax = 1., 10.
-            if isinstance(axis.limits, str):
-                xmm = max(abs(xmin), abs(xmax))
-                xmin, xmax = -xmm, xmm
-            axis.limits = [xmin, xmax]
-        else:
-            xmin, xmax = axis.limits[0], axis.limits[1]
-        return xmin, xmax
+        return update_axis_limits(axis, data_range(x))
 
     def equalize_xy(self, plot, leadingLimits):
         """
         Updates the limits of *xaxis* and *yaxis* according to the given
         *aspect*.
         """
-        if plot.aspect == 'equal':
-            plot.aspect = 1.0
-        if not isinstance(plot.aspect, float):
-            return
-        xaxis = plot.xaxis
-        yaxis = plot.yaxis
-        aspect = plot.aspect * xaxis.pixels / float(yaxis.pixels)
-        dx = xaxis.limits[1] - xaxis.limits[0]
-        dy = yaxis.limits[1] - yaxis.limits[0]
-        if aspect == 1.0 and dx == dy:
-            return
-
-        if leadingLimits is None:
-            if dx > (dy * aspect):
-                leadingLimits = 'x'
-            else:
-                leadingLimits = 'y'
-        if leadingLimits == 'x':
-            yMid = (yaxis.limits[1]+yaxis.limits[0]) / 2.
-            dy2 = dx / aspect / 2
-            yaxis.limits = [yMid-dy2, yMid+dy2]
-        else:
-            xMid = (xaxis.limits[1]+xaxis.limits[0]) / 2.
-            dx2 = dy * aspect / 2
-            xaxis.limits = [xMid-dx2, xMid+dx2]
-        return xaxis.limits[0], xaxis.limits[1], yaxis.limits[0],\
-            yaxis.limits[1]
+        return equalize_xy(plot, leadingLimits)
 
-    def run(self):
-        """
-        Starts the chosen ray-tracing backend, invokes the 1D and 2D
-        histogramming routines and puts them into the output queue.
+    def seed_random(self, pilot=False):
         """
-        seed = int(time.time()) ^ (os.getpid()+self.idN)
+        Seeds the random generator of the process or thread for the current
+        iteration with an independent stream of the run seed, see
+        :func:`~xrt.backends.raycing.seed_rng`. The legacy global
+        ``np.random`` is seeded from the same stream."""
+        key = (getattr(self.card, 'scanStep', 0), int(self.iteration),
+               self.idN, int(pilot))
+        raycing.seed_rng(getattr(self.card, 'randomSeed', None), key)
+        seed = int(raycing.get_rng().integers(2**31))
 #        random.seed(seed) - has no effect!
         np.random.seed(seed)
         if _DEBUG > 2:
-            print(seed)
+            print(key, seed)
         if _DEBUG > 2:
             print('parent process id:{0}, process id{1}'.format(
                   os.getppid(), os.getpid()))
+
+    def run(self):
+        """
+        Starts the chosen ray-tracing backend, invokes the 1D and 2D
+        histogramming routines and puts them into the output queue.
+        """
+        if self.pilot:
+            self.do_pilot()
+        else:
+            self.do_iteration()
+
+    def do_pilot(self):
+        """
+        A short ray-tracing run that only finds the ranges of the plot data
+        for the automatic limits, see :func:`update_plot_limits`. The number
+        of rays is reduced by the caller, see :func:`reduce_source_rays`. Each
+        plot queue receives a list of the x, y and c data ranges. Only for
+        raycing backend.
+        """
+        self.seed_random(pilot=True)
+        raycing_output = raycing.run.run_process(self.card.beamLine)
+        self.alarmQueue.put(self.card.beamLine.alarms)
+        outputCache = {}
+        for plot, queue in zip(self.plots, self.outPlotQueues):
+            x, y, intensity, cData = raycing.get_output(
+                plot, raycing_output, outputCache)[:4]
+            queue.put([data_range(x), data_range(y), data_range(cData)])
+
+    def do_iteration(self):
+        """
+        The body of :meth:`run`: one ray-tracing run followed by
+        histogramming of all the plots.
+        """
+        self.seed_random()
         if self.card.backend.startswith('shadow'):
             self.alarmQueue.put([])
             ret = shadow.run_process(
@@ -274,8 +695,10 @@ class GenericProcessOrThread(object):
         elif self.card.backend.startswith('raycing'):
             raycing_output = raycing.run.run_process(self.card.beamLine)
             self.alarmQueue.put(self.card.beamLine.alarms)
+            outputCache = {}  # shared by the plots of this iteration
 
-        for plot, queue in zip(self.plots, self.outPlotQueues):
+        for iplot, (plot, queue) in enumerate(
+                zip(self.plots, self.outPlotQueues)):
             displayAsAbsorbedPower = False
             if self.card.backend.startswith('shadow'):
                 x, y, intensity, cData, locNrays, locNraysNeeded = \
@@ -285,30 +708,16 @@ class GenericProcessOrThread(object):
             elif self.card.backend.startswith('raycing'):
                 x, y, intensity, cData, locNrays, locAlive, locGood, locOut,\
                     locOver, locDead, locAccepted, locAcceptedE, locSeeded,\
-                    locSeededI = raycing.get_output(plot, raycing_output)
+                    locSeededI = raycing.get_output(
+                        plot, raycing_output, outputCache)
                 if hasattr(plot, 'displayAsAbsorbedPower'):
                     displayAsAbsorbedPower = True
             elif self.card.backend.startswith('dummy'):
                 x, y, intensity, cData, locNrays = dummy_output
 
-            if self.card.iteration == 0:
-                leadingLimits = None
-                xLimitsDefined = (plot.xaxis.limits is not None) and \
-                    (not isinstance(plot.xaxis.limits, str))
-                yLimitsDefined = (plot.yaxis.limits is not None) and \
-                    (not isinstance(plot.yaxis.limits, str))
-                if xLimitsDefined and (not yLimitsDefined):
-                    leadingLimits = 'x'
-                elif yLimitsDefined and (not xLimitsDefined):
-                    leadingLimits = 'y'
-                xmin, xmax = self.update_limits(plot.xaxis, x)
-                ymin, ymax = self.update_limits(plot.yaxis, y)
-                emin, emax = self.update_limits(plot.caxis, cData)
-                if plot.aspect == 'equal' or isinstance(plot.aspect,
-                                                        (int, float)):
-                    xyeq = self.equalize_xy(plot, leadingLimits)
-                    if xyeq is not None:
-                        xmin, xmax, ymin, ymax = xyeq
+            if self.iteration == 0:
+                xmin, xmax, ymin, ymax, emin, emax = update_plot_limits(
+                    plot, data_range(x), data_range(y), data_range(cData))
 
             limits = plot.caxis.limits
             cData01 = ((cData - limits[0]) * plot.colorFactor /
@@ -323,24 +732,35 @@ class GenericProcessOrThread(object):
                 flux = intensity.real**2 + intensity.imag**2
             else:
                 flux = intensity
-            cDataHSV = np.dstack(
-                (cData01, np.ones_like(cData01) * plot.colorSaturation,
-                 flux.reshape(-1, 1)))
-            cDataRGB = (mpl.colors.hsv_to_rgb(cDataHSV)).reshape(-1, 3)
-# 1D x, y and cData histograms
-            xh, xhRGB, xbe = self.do_hist1d(x, flux, cDataRGB, plot.xaxis)
-            yh, yhRGB, ybe = self.do_hist1d(y, flux, cDataRGB, plot.yaxis)
-            if plot.ePos:
-                eh, ehRGB, ebe = self.do_hist1d(
-                    cData, flux, cDataRGB, plot.caxis)
+            if getattr(plot, 'deferColor', False):
+                cDataRGB, hue = None, cData01
             else:
-                eh, ehRGB, ebe = None, None, None
-# 2D histogram
-            res = self.do_hist2d(x, y, intensity, cDataRGB, plot)
-            xyh, xyhRGB = res[0], res[1]
+                cDataHSV = np.dstack(
+                    (cData01, np.ones_like(cData01) * plot.colorSaturation,
+                     flux.reshape(-1, 1)))
+                cDataRGB = (mpl.colors.hsv_to_rgb(cDataHSV)).reshape(-1, 3)
+                hue = None
             is4d = (plot.fluxKind.lower().endswith('4d') or
                     plot.fluxKind.lower().endswith('pca'))
-            xyh4 = res[2] if is4d else None
+            if self.can_fuse_histograms(plot):
+                xh, xhRGB, xbe, yh, yhRGB, ybe, eh, ehRGB, ebe, xyh, xyhRGB,\
+                    xyh4 = self.do_fused_hists(
+                        x, y, cData, intensity, flux, cDataRGB, plot, hue)
+                if not is4d:
+                    xyh4 = None
+            else:
+# 1D x, y and cData histograms
+                xh, xhRGB, xbe = self.do_hist1d(x, flux, cDataRGB, plot.xaxis)
+                yh, yhRGB, ybe = self.do_hist1d(y, flux, cDataRGB, plot.yaxis)
+                if plot.ePos:
+                    eh, ehRGB, ebe = self.do_hist1d(
+                        cData, flux, cDataRGB, plot.caxis)
+                else:
+                    eh, ehRGB, ebe = None, None, None
+# 2D histogram
+                res = self.do_hist2d(x, y, intensity, cDataRGB, plot)
+                xyh, xyhRGB = res[0], res[1]
+                xyh4 = res[2] if is4d else None
 
             if plot.fluxKind.endswith('log'):
                 xh = np.log10(xh)
@@ -370,11 +790,171 @@ class GenericProcessOrThread(object):
                                 locAccepted, locAcceptedE, locSeeded,
                                 locSeededI))
             outList.append(displayAsAbsorbedPower)
-            if self.card.iteration == 0:  # needed for multiprocessing
+            if self.iteration == 0:  # needed for multiprocessing
                 outList.append((xmin, xmax, ymin, ymax, emin, emax))
+            if self.slabs is not None:
+                self.slabs[iplot].put(outList)
             queue.put(outList)
 
 
+class PersistentWorker(GenericProcessOrThread):
+    """
+    A long-lived ray tracing process or thread. It is started once per
+    :func:`~xrt.runner.run_ray_tracing` call and then waits for commands in
+    its *commandQueue*. A command is a 2-tuple (*what*, *value*):
+
+    ('card', *locCard*): replaces the run card, e.g. with a beamline modified
+        by the generator at the next scan step.
+
+    ('plots', *plots*): replaces the plot cards, e.g. with the axis limits
+        found in the 1st iteration.
+
+    ('run', (*iteration*, *ppid*)): runs one iteration.
+
+    ('pilot', *nrays*): runs a pilot run with the sources reduced to *nrays*
+    rays, or, if *nrays* is None, with the sources as they are.
+
+    None stops the worker.
+
+    If *slabs* (a list of :class:`SharedHistograms`, one per plot) is given,
+    the histograms are accumulated there instead of being sent to the queues.
+    """
+    def __init__(self, locCard, plots, outPlotQueues, alarmQueue, idLoc,
+                 commandQueue, slabs=None):
+        GenericProcessOrThread.__init__(self, locCard, plots, outPlotQueues,
+                                        alarmQueue, idLoc)
+        self.commandQueue = commandQueue
+        self.slabs = slabs
+
+    def run(self):
+        while True:
+            command = self.commandQueue.get()
+            if command is None:
+                break
+            what, value = command
+            if what == 'card':
+                self.card = value
+            elif what == 'plots':
+                self.plots = value
+            elif what == 'run':
+                self.iteration, self.ppid = value
+                self.do_iteration()
+            elif what == 'pilot':
+                if value is None:  # the rays are reduced by the job server
+                    self.do_pilot()
+                else:
+                    saved = reduce_source_rays(self.card.beamLine, value)
+                    try:
+                        self.do_pilot()
+                    finally:
+                        restore_source_rays(saved)
+
+
+class WorkerCard(object):
+    """
+    The pickleable sub-set of :class:`~xrt.runner.RunCardVals` needed by a
+    persistent worker process. The events and the queue classes of the run
+    card can only be inherited by the child processes and are therefore left
+    out.
+    """
+    def __init__(self, card):
+        for attr in ('backend', 'cwd', 'beamLine', 'fWiggler', 'fPolar',
+                     'blockNRays', 'randomSeed', 'scanStep'):
+            if hasattr(card, attr):
+                setattr(self, attr, getattr(card, attr))
+        self.iteration = card.iteration
+
+
+class WorkerPool(object):
+    """
+    A pool of :class:`PersistentWorker` processes or threads reused over the
+    repeats and over the generator scan steps. The beamline is sent to each
+    worker only once per scan step, after that a worker only receives short
+    commands for running the next iteration. The resulting histograms are
+    returned via the same per-plot queues as for the non-persistent workers,
+    or, for processes, via per-worker :class:`SharedHistograms` slabs.
+    """
+    def __init__(self, runCardVals, plots, cpus):
+        self.useProcesses = runCardVals.threads < runCardVals.processes
+        self.outPlotQueues = [runCardVals.Queue() for plot in plots]
+        self.alarmQueue = runCardVals.Queue()
+        self.commandQueues = [runCardVals.Queue() for icpu in range(cpus)]
+        if self.useProcesses:
+            Worker = PersistentProcess
+            self.slabs = [[SharedHistograms(plot, icpu) for plot in plots]
+                          for icpu in range(cpus)]
+        else:  # threads pass the histograms by reference, no need of slabs
+            Worker = PersistentThread
+            self.slabs = [None for icpu in range(cpus)]
+        locCard = self.worker_card(runCardVals)
+        self.workers = [Worker(locCard, plots, self.outPlotQueues,
+                               self.alarmQueue, icpu, commandQueue, slabs)
+                        for icpu, (commandQueue, slabs) in
+                        enumerate(zip(self.commandQueues, self.slabs))]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def worker_card(self, runCardVals):
+        if self.useProcesses:
+            return WorkerCard(runCardVals)
+        else:  # threads share the run card
+            return runCardVals
+
+    def load(self, runCardVals=None, plots=None):
+        """Sends the new run card and/or the plot cards to all the workers."""
+        for commandQueue in self.commandQueues:
+            if runCardVals is not None:
+                commandQueue.put(('card', self.worker_card(runCardVals)))
+            if plots is not None:
+                commandQueue.put(('plots', plots))
+
+    def run_iteration(self, iteration, cpus):
+        """Starts one iteration in *cpus* workers and returns the list of the
+        engaged workers."""
+        workers = self.workers[:cpus]
+        for pid, (worker, commandQueue) in enumerate(
+                zip(workers, self.commandQueues)):
+            commandQueue.put(('run', (iteration, pid + iteration)))
+        return workers
+
+    def run_pilot(self, cpus, nrays):
+        """Starts a pilot run (see :meth:`GenericProcessOrThread.do_pilot`) on
+        the first *cpus* workers. The worker processes reduce the rays of
+        their beamline copies to *nrays*. The threads share the beamline of
+        the job server, which must reduce the rays itself, and *nrays* is
+        then ignored."""
+        workers = self.workers[:cpus]
+        for commandQueue in self.commandQueues[:cpus]:
+            commandQueue.put(('pilot', nrays if self.useProcesses else None))
+        return workers
+
+    def add_histogram(self, total, outList, ind, iplot):
+        """Adds the histogram of the *ind* item of *outList* of plot *iplot* to
+        *total*. If the histogram was accumulated in a shared slab, the item
+        holds the worker id and the histogram is taken from the slab."""
+        hist = outList[ind]
+        if isinstance(hist, int):
+            self.slabs[hist][iplot].take(ind, total)
+        else:
+            total += hist
+
+    def discard_histograms(self, outList, iplot):
+        """Zeros the shared histograms of plot *iplot* referred to by
+        *outList*."""
+        for ind in sharedOutFields:
+            if isinstance(outList[ind], int):
+                self.slabs[outList[ind]][iplot].clear()
+                break
+
+    def close(self):
+        """Stops the workers."""
+        for commandQueue in self.commandQueues:
+            commandQueue.put(None)
+        for worker in self.workers:
+            worker.join(60.)
+
+
 class BackendProcess(GenericProcessOrThread, Process):
     def __init__(self, locCard, plots, outPlotQueues, alarmQueue, idLoc):
         Process.__init__(self)
@@ -387,3 +967,19 @@ class BackendThread(GenericProcessOrThread, Thread):
         Thread.__init__(self)
         GenericProcessOrThread.__init__(self, locCard, plots, outPlotQueues,
                                         alarmQueue, idLoc)
+
+
+class PersistentProcess(PersistentWorker, Process):
+    def __init__(self, locCard, plots, outPlotQueues, alarmQueue, idLoc,
+                 commandQueue, slabs=None):
+        Process.__init__(self)
+        PersistentWorker.__init__(self, locCard, plots, outPlotQueues,
+                                  alarmQueue, idLoc, commandQueue, slabs)
+
+
+class PersistentThread(PersistentWorker, Thread):
+    def __init__(self, locCard, plots, outPlotQueues, alarmQueue, idLoc,
+                 commandQueue, slabs=None):
+        Thread.__init__(self)
+        PersistentWorker.__init__(self, locCard, plots, outPlotQueues,
+                                  alarmQueue, idLoc, commandQueue, slabs)
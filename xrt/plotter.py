@@ -37,9 +37,9 @@ import pickle
 import numpy as np
 import scipy as sp
 import matplotlib as mpl
-import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from . import runner
+from . import multipro
 # from runner import runCardVals, runCardProcs
 from .backends import raycing
 
@@ -113,9 +113,52 @@ defaultFwhmFormatStrForCAxis = '%.2f'
 # [Development]
 colorFactor = 0.85  # 2./3 for red-to-blue
 colorSaturation = 0.85
+# If True, the rays are not colored one by one. Instead, the hue moments are
+# histogrammed and converted to RGB per bin at the time of plotting. Not
+# applied to 'log' and 'xx'/'zz' flux kinds and to 'kde' density.
+deferColor = False
 # # end of rc-file ##
 
 
+# [Convergence]
+minConvergenceRepeats = 4  # the convergence is not tested before
+convergenceMetrics = 'flux', 'cx', 'dx', 'cy', 'dy', 'cE', 'dE', 'bins'
+binsConvergenceLevel = 0.1  # of the max bin, for the 'bins' metric
+
+
+def center_and_fwhm(hist, binEdges, interpolate=False):
+    """
+    Returns the center of mass and the FWHM of the 1D histogram *hist*, as
+    displayed by :meth:`XYCPlot.plot_hist1d`, i.e. in whole bins. If
+    *interpolate* is True, the FWHM is measured between the half maximum
+    crossings linearly interpolated between the bin centers, so that it
+    changes continuously with the histogram, as needed for its scatter over
+    the iterations.
+    """
+    hist = np.abs(hist)
+    histMax = float(np.max(hist)) if len(hist) > 0 else 0.
+    if histMax <= 0:
+        return 0., 0.
+    args = np.argwhere(hist >= histMax * 0.5)
+    binCenters = (binEdges[:-1]+binEdges[1:]) * 0.5
+    center = (hist * binCenters).sum() / hist.sum()
+    if not interpolate:
+        return center, binEdges[np.max(args) + 1] - binEdges[np.min(args)]
+    i0, i1 = np.min(args), np.max(args)
+    half = histMax * 0.5
+    if i0 > 0:
+        x0 = binCenters[i0-1] + (half - hist[i0-1]) / (
+            hist[i0] - hist[i0-1]) * (binCenters[i0] - binCenters[i0-1])
+    else:
+        x0 = binEdges[0]
+    if i1 < len(hist) - 1:
+        x1 = binCenters[i1+1] - (half - hist[i1+1]) / (
+            hist[i1] - hist[i1+1]) * (binCenters[i1+1] - binCenters[i1])
+    else:
+        x1 = binEdges[-1]
+    return center, x1 - x0
+
+
 class XYCAxis(object):
     u"""
     Contains a generic record structure describing each of the 3 axes:
@@ -408,6 +451,8 @@ class XYCPlot(object):
     images, this class provides with useful fields like *dx*, *dy*, *dE*
     (FWHM), *cx*, *cy*, *cE* (centers) and *intensity* which can be used in
     scripts for producing scan-like results."""
+    headless = False
+
     def __init__(
         self, beam=None, rayFlag=(1,), xaxis=None, yaxis=None, caxis=None,
         aspect='equal', xPos=1, yPos=1, ePos=1, title='',
@@ -637,48 +682,12 @@ class XYCPlot(object):
 
 
         """
+        import matplotlib.pyplot as plt  # not needed by XYCAccumulator
         plt.ion()
         self.colorSaturation = colorSaturation
-
-        self.beam = beam  # binary shadow image: star, mirr or screen
-        if '.' in beam:
-            self.backend = 'shadow'
-        elif ('dummy' in beam) or (beam == ''):
-            self.backend = 'dummy'
-        elif isinstance(rayFlag, tuple):
-            self.backend = 'raycing'
-        else:
-            self.backend = 'dummy'
-        self.beamState = beamState
-        self.beamC = beamC
-        self.rayFlag = rayFlag
-        self.fluxKind = fluxKind
         self.fluxUnit = fluxUnit
-        if xaxis is None:
-            self.xaxis = XYCAxis(defaultXTitle, defaultXUnit)
-        else:
-            self.xaxis = xaxis
-        if yaxis is None:
-            self.yaxis = XYCAxis(defaultYTitle, defaultYUnit)
-        else:
-            self.yaxis = yaxis
-        if (caxis is None) or isinstance(caxis, basestring):
-            self.caxis = XYCAxis(defaultCTitle, defaultCUnit, factor=1.,)
-            self.caxis.fwhmFormatStr = defaultFwhmFormatStrForCAxis
-            if isinstance(caxis, basestring):
-                self.caxis.useCategory = True
-                ePos = 0
-        else:
-            self.caxis = caxis
-
-        if self.backend != 'dummy':
-            for axis in self.xaxis, self.yaxis, self.caxis:
-                if axis.data == 'auto':
-                    axis.auto_assign_data(self.backend)
-                if axis.factor is None:
-                    axis.auto_assign_factor(self.backend)
-
-        self.reset_bins2D()
+        ePos = self.set_beam_and_axes(beam, rayFlag, xaxis, yaxis, caxis,
+                                      ePos, fluxKind, beamState, beamC)
 
         if isinstance(aspect, (int, float)):
             if aspect <= 0:
@@ -701,6 +710,8 @@ class XYCPlot(object):
         self.cx, self.dx = 0, 0
         self.cy, self.dy = 0, 0
         self.cE, self.dE = 0, 0
+        self.fomSamples = dict((m, []) for m in convergenceMetrics[:-1])
+        self.convergenceErrors = {}
 
         xFigSize = float(xOrigin2d + self.xaxis.pixels + space2dto1d +
                          height1d + xSpaceExtra)
@@ -970,6 +981,70 @@ class XYCPlot(object):
         plt.ioff()
         self.fig.canvas.draw()
 
+    def set_beam_and_axes(self, beam, rayFlag, xaxis, yaxis, caxis, ePos,
+                          fluxKind, beamState, beamC):
+        """
+        Sets the beam, the backend and the axes and allocates the histograms.
+        Returns *ePos*, which is set to 0 for the category coloring.
+        """
+        self.beam = beam  # binary shadow image: star, mirr or screen
+        if '.' in beam:
+            self.backend = 'shadow'
+        elif ('dummy' in beam) or (beam == ''):
+            self.backend = 'dummy'
+        elif isinstance(rayFlag, tuple):
+            self.backend = 'raycing'
+        else:
+            self.backend = 'dummy'
+        self.beamState = beamState
+        self.beamC = beamC
+        self.rayFlag = rayFlag
+        self.fluxKind = fluxKind
+        if xaxis is None:
+            self.xaxis = XYCAxis(defaultXTitle, defaultXUnit)
+        else:
+            self.xaxis = xaxis
+        if yaxis is None:
+            self.yaxis = XYCAxis(defaultYTitle, defaultYUnit)
+        else:
+            self.yaxis = yaxis
+        if (caxis is None) or isinstance(caxis, basestring):
+            self.caxis = XYCAxis(defaultCTitle, defaultCUnit, factor=1.,)
+            self.caxis.fwhmFormatStr = defaultFwhmFormatStrForCAxis
+            if isinstance(caxis, basestring):
+                self.caxis.useCategory = True
+                ePos = 0
+        else:
+            self.caxis = caxis
+
+        if self.backend != 'dummy':
+            for axis in self.xaxis, self.yaxis, self.caxis:
+                if axis.data == 'auto':
+                    axis.auto_assign_data(self.backend)
+                if axis.factor is None:
+                    axis.auto_assign_factor(self.backend)
+
+        self.deferColor = deferColor and self.can_defer_color()
+        self.reset_bins2D()
+        return ePos
+
+    def can_defer_color(self):
+        """
+        Tells whether the coloring of this plot can be done per bin, see
+        *deferColor* at the module level.
+        """
+        fluxKind = self.fluxKind.lower()
+        if fluxKind.endswith('log'):
+            return False
+        if self.fluxKind.startswith('E') and (
+                fluxKind.endswith('xx') or fluxKind.endswith('yy') or
+                fluxKind.endswith('zz')):
+            return False
+        for axis in [self.xaxis, self.yaxis, self.caxis]:
+            if axis.density.lower() == 'kde':
+                return False
+        return True
+
     def reset_bins2D(self):
         if self.fluxKind.startswith('E'):
             dtype = np.complex128
@@ -978,6 +1053,10 @@ class XYCPlot(object):
         self.total2D = np.zeros((self.yaxis.bins, self.xaxis.bins),
                                 dtype=dtype)
         self.total2D_RGB = np.zeros((self.yaxis.bins, self.xaxis.bins, 3))
+        self.total2Dsq = np.zeros((self.yaxis.bins, self.xaxis.bins))
+        if self.deferColor:
+            self.total2D_HM = np.zeros(
+                (self.yaxis.bins, self.xaxis.bins, multipro.nHueMoments))
         self.max2D_RGB = 0
         self.globalMax2D_RGB = 0
         self.size2D = self.yaxis.bins * self.xaxis.bins
@@ -994,6 +1073,9 @@ class XYCPlot(object):
                 ax.binEdges = np.zeros(ax.bins + 1)
                 ax.total1D = np.zeros(ax.bins)
                 ax.total1D_RGB = np.zeros((ax.bins, 3))
+                ax.total1Dsq = np.zeros(ax.bins)
+                if self.deferColor:
+                    ax.total1D_HM = np.zeros((ax.bins, multipro.nHueMoments))
 
     def update_user_elements(self):
         return  # 'user message'
@@ -1183,6 +1265,9 @@ class XYCPlot(object):
         else:
             xxMaxHalf = 0.5
 
+        if self.deferColor:
+            axis.total1D_RGB[:] = multipro.hue_moments_to_rgb(
+                axis.total1D_HM, self.colorSaturation)
         t1D_RGB = axis.total1D_RGB
         axis.max1D_RGB = float(np.max(t1D_RGB))
         if axis.max1D_RGB > 0:
@@ -1309,6 +1394,9 @@ class XYCPlot(object):
         """
         Plots the 2D histogram as imshow.
         """
+        if self.deferColor:
+            self.total2D_RGB[:] = multipro.hue_moments_to_rgb(
+                self.total2D_HM, self.colorSaturation)
         tRGB = self.total2D_RGB
         self.max2D_RGB = float(np.max(tRGB))
         if self.max2D_RGB > 0:
@@ -1549,6 +1637,16 @@ class XYCPlot(object):
             axis.total1D_RGB[:] = np.zeros((axis.bins, 3))
         self.total2D[:] = np.zeros((self.yaxis.bins, self.xaxis.bins))
         self.total2D_RGB[:] = np.zeros((self.yaxis.bins, self.xaxis.bins, 3))
+        if self.deferColor:
+            for axis in [self.xaxis, self.yaxis, self.caxis]:
+                axis.total1D_HM[:] = 0
+            self.total2D_HM[:] = 0
+        for axis in [self.xaxis, self.yaxis, self.caxis]:
+            axis.total1Dsq[:] = 0
+        self.total2Dsq[:] = 0
+        for samples in self.fomSamples.values():
+            del samples[:]
+        self.convergenceErrors = {}
 
         try:
             self.fig.canvas.window().setWindowTitle(self.title)
@@ -1597,6 +1695,107 @@ class XYCPlot(object):
 
         self.plot_plots()
 
+    def add_sample(self, xHist, yHist, eHist, xyHist, flux):
+        """
+        Adds the histograms of one iteration (one worker) to the sums of
+        squares and stores the figures of merit of this iteration. Used by
+        :mod:`runner` when *convergence* is requested.
+        """
+        for axis, hist, c, d in [(self.xaxis, xHist, 'cx', 'dx'),
+                                 (self.yaxis, yHist, 'cy', 'dy'),
+                                 (self.caxis, eHist, 'cE', 'dE')]:
+            if hist is None:
+                continue
+            axis.total1Dsq += np.abs(hist)**2
+            center, fwhm = center_and_fwhm(hist, axis.binEdges, True)
+            self.fomSamples[c].append(center)
+            self.fomSamples[d].append(fwhm)
+        self.total2Dsq += np.abs(xyHist)**2
+        self.fomSamples['flux'].append(flux)
+
+    def get_convergence_errors(self):
+        """
+        Returns a dictionary {metric: (value, error, relative error)} for the
+        metrics in *convergenceMetrics*. The error of the flux and of the bins
+        is the standard deviation of the accumulated sum estimated from the
+        scatter of the individual iterations; the error of the centers and
+        FWHMs is the standard error of their mean over the iterations, with
+        the FWHM of every iteration interpolated within the bins. A FWHM of
+        up to two bins (a peak in one bin or straddling two) is not resolved
+        by the histogram and is left out of the dictionary. The relative
+        error of a center is given relative to the FWHM; the value of 'bins'
+        is the maximum relative bin error of the 2D histogram over the bins
+        above *binsConvergenceLevel* of the maximum.
+        """
+        errors = {}
+        n = len(self.fomSamples['flux'])
+        if n < 2:
+            return errors
+        fluxes = np.array(self.fomSamples['flux'])
+        fluxError = (n * fluxes.var(ddof=1))**0.5
+        errors['flux'] = self.intensity, fluxError,\
+            fluxError / abs(self.intensity) if self.intensity else np.inf
+
+        for axis, c, d in [(self.xaxis, 'cx', 'dx'), (self.yaxis, 'cy', 'dy'),
+                           (self.caxis, 'cE', 'dE')]:
+            if len(self.fomSamples[c]) < 2:
+                continue
+            center, fwhm = center_and_fwhm(axis.total1D, axis.binEdges)
+            cError = np.std(self.fomSamples[c], ddof=1) / n**0.5
+            dError = np.std(self.fomSamples[d], ddof=1) / n**0.5
+            errors[c] = center, cError, cError / fwhm if fwhm else np.inf
+            if fwhm > 2 * np.max(np.diff(axis.binEdges)):
+                errors[d] = fwhm, dError, dError / fwhm
+
+        total = np.abs(self.total2D)
+        var = (self.total2Dsq - total**2/n) / (n-1)
+        good = total >= total.max() * binsConvergenceLevel
+        if total.max() > 0:
+            binErrors = (n * np.maximum(var[good], 0))**0.5 / total[good]
+            errors['bins'] = binErrors.max(), None, binErrors.max()
+        else:
+            errors['bins'] = 0., None, np.inf
+        self.convergenceErrors = errors
+        return errors
+
+    def is_converged(self, tolerances):
+        """
+        Tells whether all the metrics in the dictionary *tolerances*
+        {metric: relative tolerance} have converged. A metric without an
+        error estimate, e.g. an unresolved FWHM, has not converged.
+        """
+        if len(self.fomSamples['flux']) < minConvergenceRepeats:
+            return False
+        errors = self.get_convergence_errors()
+        for metric, tolerance in tolerances.items():
+            if metric not in errors:
+                return False
+            if not errors[metric][2] <= tolerance:
+                return False
+        return True
+
+    def report_convergence(self, tolerances=None):
+        """
+        Prints the achieved errors of the figures of merit and names the
+        metrics of *tolerances* that have no error estimate.
+        """
+        errors = self.get_convergence_errors()
+        print('{0}: errors after {1} iterations:'.format(
+            self.title, len(self.fomSamples['flux'])))
+        for metric in convergenceMetrics:
+            if metric not in errors:
+                if tolerances and metric in tolerances:
+                    print('  {0}: not resolved, make the bins finer'.format(
+                        metric))
+                continue
+            value, error, relError = errors[metric]
+            if error is None:
+                print('  {0}: max relative error {1:.3g}'.format(
+                    metric, relError))
+            else:
+                print('  {0} = {1:.6g} +- {2:.3g} (relative {3:.3g})'.format(
+                    metric, value, error, relError))
+
     def set_negative(self):
         """
         Utility function. Makes all plots in the graph negative (in color).
@@ -1724,6 +1923,140 @@ class XYCPlotWithNumerOfReflections(XYCPlot):
             del self.textUser[:]
 
 
+class XYCAccumulator(XYCPlot):
+    u"""
+    A headless counterpart of :class:`XYCPlot` for batch jobs, e.g. on a
+    computing cluster. It accumulates the same histograms, flux and ray
+    counters as :class:`XYCPlot` (see :class:`SaveResults` for the fields) and
+    calculates the same figures of merit *dx*, *dy*, *dE*, *cx*, *cy*, *cE*,
+    *flux* and *power* but creates no matplotlib figures and renders nothing
+    during the run. matplotlib.pyplot is not imported if all the plots are
+    headless.
+
+    The constructor accepts the same parameters as :class:`XYCPlot`, so the
+    two classes are interchangeable in a script. The parameters related to
+    graphics are only kept for :meth:`render`. The results are persisted
+    by *persistentName* as in :class:`XYCPlot` and can later be rendered into
+    a figure by :meth:`render` or by creating an :class:`XYCPlot` with the
+    same *persistentName*.
+    """
+    headless = True
+
+    def __init__(
+        self, beam=None, rayFlag=(1,), xaxis=None, yaxis=None, caxis=None,
+        aspect='equal', ePos=1, title='', invertColorMap=False,
+        fluxKind='total', fluxUnit='auto', saveName=None,
+            persistentName=None, beamState=None, beamC=None, **kwargs):
+        self.plotKWargs = kwargs
+        self.colorSaturation = colorSaturation
+        self.fluxUnit = fluxUnit
+        self.ePos = self.set_beam_and_axes(
+            beam, rayFlag, xaxis, yaxis, caxis, ePos, fluxKind, beamState,
+            beamC)
+        if isinstance(aspect, (int, float)):
+            if aspect <= 0:
+                aspect = 1.
+        self.aspect = aspect
+        self.invertColorMap = invertColorMap
+        self.saveName = saveName
+        self.persistentName = persistentName
+        if title != '':
+            self.title = title
+        elif isinstance(beam, basestring):
+            self.title = beam
+        else:
+            self.title = ' '
+        self.cx, self.dx = 0, 0
+        self.cy, self.dy = 0, 0
+        self.cE, self.dE = 0, 0
+        self.fomSamples = dict((m, []) for m in convergenceMetrics[:-1])
+        self.convergenceErrors = {}
+        self.power = 0.
+        self.flux = 0.
+        self.displayAsAbsorbedPower = False
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.nRaysAll = np.long(0)
+        self.nRaysAllRestored = np.long(-1)
+        self.intensity = 0.
+        self.nRaysNeeded = np.long(0)
+        self.nRaysAlive = np.long(0)
+        self.nRaysGood = np.long(0)
+        self.nRaysOut = np.long(0)
+        self.nRaysOver = np.long(0)
+        self.nRaysDead = np.long(0)
+        self.nRaysAccepted = np.long(0)
+        self.nRaysAcceptedE = 0.
+        self.nRaysSeeded = np.long(0)
+        self.nRaysSeededI = 0.
+
+    def plot_plots(self):
+        """
+        Renders nothing, only calculates the figures of merit.
+        """
+        self.cx, self.dx = center_and_fwhm(
+            self.xaxis.total1D, self.xaxis.binEdges)
+        self.cy, self.dy = center_and_fwhm(
+            self.yaxis.total1D, self.yaxis.binEdges)
+        if self.ePos != 0:
+            self.cE, self.dE = center_and_fwhm(
+                self.caxis.total1D, self.caxis.binEdges)
+        if self.backend == 'raycing' and (self.nRaysAll > 0):
+            if self.fluxKind.startswith('power'):
+                self._get_power()
+            elif self.nRaysSeeded > 0:
+                self._get_flux()
+
+    def save(self, suffix=''):
+        """There is no figure to save. See :meth:`render`."""
+        pass
+
+    def clean_plots(self):
+        """
+        Cleans the accumulated histograms and counters in order to prepare
+        for the next ray tracing.
+        """
+        runner.runCardVals.iteration = 0
+        runner.runCardVals.stop_event.clear()
+        runner.runCardVals.finished_event.clear()
+        self.reset_bins2D()
+        for samples in self.fomSamples.values():
+            del samples[:]
+        self.convergenceErrors = {}
+        self.reset_counters()
+        self.plot_plots()
+
+    def results(self):
+        """Returns the accumulated results as a :class:`SaveResults`."""
+        return SaveResults(self)
+
+    def render(self, **kwargs):
+        """
+        Creates an :class:`XYCPlot` figure with the same parameters as given
+        to the constructor (which can be overridden by *kwargs*), fills it with
+        the accumulated results, plots and saves it. Returns the plot.
+        """
+        saved = self.results()
+        plotKWargs = dict(
+            beam=self.beam, rayFlag=self.rayFlag, xaxis=self.xaxis,
+            yaxis=self.yaxis, aspect=self.aspect, ePos=self.ePos,
+            title=self.title, invertColorMap=self.invertColorMap,
+            fluxKind=self.fluxKind, fluxUnit=self.fluxUnit,
+            saveName=self.saveName, beamState=self.beamState,
+            beamC=self.beamC)
+        plotKWargs['caxis'] = 'category' if self.caxis.useCategory else\
+            self.caxis
+        plotKWargs.update(self.plotKWargs)
+        plotKWargs.update(kwargs)
+        plot = XYCPlot(**plotKWargs)
+        saved.restore(plot)
+        plot.displayAsAbsorbedPower = self.displayAsAbsorbedPower
+        plot.plot_plots()
+        plot.save()
+        return plot
+
+
 class PlotCard2Pickle(object):
     """
     Container for a minimum set of properties (a "card") describing the plot.
@@ -1742,6 +2075,7 @@ class PlotCard2Pickle(object):
         self.ePos = plot.ePos
         self.colorFactor = colorFactor
         self.colorSaturation = colorSaturation
+        self.deferColor = plot.deferColor
         self.fluxKind = plot.fluxKind
         self.title = plot.title
 
@@ -1763,6 +2097,11 @@ class SaveResults(object):
         self.etotal1D_RGB = copy.copy(plot.caxis.total1D_RGB)
         self.total2D = copy.copy(plot.total2D)
         self.total2D_RGB = copy.copy(plot.total2D_RGB)
+        if plot.deferColor:
+            self.xtotal1D_HM = copy.copy(plot.xaxis.total1D_HM)
+            self.ytotal1D_HM = copy.copy(plot.yaxis.total1D_HM)
+            self.etotal1D_HM = copy.copy(plot.caxis.total1D_HM)
+            self.total2D_HM = copy.copy(plot.total2D_HM)
 
         axes = [plot.xaxis, plot.yaxis]
         if plot.ePos:
@@ -1803,6 +2142,17 @@ class SaveResults(object):
         Restores the arrays and values after unpickling or after running the
         ray-tracing series and finding the global histogram maxima.
         """
+        if plot.deferColor and not hasattr(self, 'total2D_HM'):
+# saved without deferColor: the colors cannot be deferred any more, the plot
+# continues with RGB histograms that start from its current colors
+            for axis in [plot.xaxis, plot.yaxis, plot.caxis]:
+                axis.total1D_RGB[:] = multipro.hue_moments_to_rgb(
+                    axis.total1D_HM, plot.colorSaturation)
+            plot.total2D_RGB[:] = multipro.hue_moments_to_rgb(
+                plot.total2D_HM, plot.colorSaturation)
+            plot.deferColor = False
+            print('{0}: restored without deferColor, which is now off'.format(
+                plot.title))
 # squeeze is needed even for floats,
 # otherwise for matlab it is returned as [[value]]
         plot.xaxis.total1D += np.squeeze(self.xtotal1D)
@@ -1813,6 +2163,11 @@ class SaveResults(object):
         plot.caxis.total1D_RGB += np.squeeze(self.etotal1D_RGB)
         plot.total2D += np.squeeze(self.total2D)
         plot.total2D_RGB += np.squeeze(self.total2D_RGB)
+        if plot.deferColor and hasattr(self, 'total2D_HM'):
+            plot.xaxis.total1D_HM += np.squeeze(self.xtotal1D_HM)
+            plot.yaxis.total1D_HM += np.squeeze(self.ytotal1D_HM)
+            plot.caxis.total1D_HM += np.squeeze(self.etotal1D_HM)
+            plot.total2D_HM += np.squeeze(self.total2D_HM)
 
         plot.nRaysAll += np.squeeze(self.nRaysAll)
         plot.nRaysAllRestored += np.squeeze(self.nRaysAll)
@@ -12,10 +12,10 @@ import sys
 import time
 import numpy as np
 import matplotlib as mpl
-import matplotlib.pyplot as plt
 import multiprocessing
 import errno
 import threading
+import pickle
 if sys.version_info < (3, 1):
     import Queue
 else:
@@ -30,6 +30,11 @@ from .backends import raycing
 runCardVals = None
 runCardProcs = None
 _plots = []
+_pool = None
+# the plot results that are unknown while the generator is expanded into
+# concurrent scan steps, see run_concurrent_scan():
+pendingResults = ('intensity', 'flux', 'power', 'cx', 'dx', 'cy', 'dy', 'cE',
+                  'dE')
 needLimits = False
 
 
@@ -56,7 +61,9 @@ class RunCardVals(object):
     objects for passing it to job processes or threads.
     """
     def __init__(self, threads, processes, repeats, updateEvery, pickleEvery,
-                 backend, globalNorm):
+                 backend, globalNorm, persistentWorkers=False,
+                 pilotRays=None, convergence=None, concurrentSteps=1,
+                 randomSeed=None):
         if threads >= processes:
             self.Event = threading.Event
             self.Queue = Queue.Queue
@@ -76,6 +83,13 @@ class RunCardVals(object):
         self.pickleEvery = pickleEvery
         self.backend = backend
         self.globalNorm = globalNorm
+        self.persistentWorkers = persistentWorkers
+        self.pilotRays = pilotRays
+        self.convergence = convergence
+        self.concurrentSteps = concurrentSteps
+        self.randomSeed = randomSeed
+        self.scanStep = 0
+        self.converged = False
         self.passNo = 0
         self.savedResults = []
         self.iteration = 0
@@ -112,12 +126,14 @@ def start_jobs():
     for plot in _plots:
         if plot.persistentName:
             plot.restore_plots()
-        plot.fig.canvas.set_window_title(plot.title)
+        if not plot.headless:
+            plot.fig.canvas.set_window_title(plot.title)
 
     runCardVals.iteration = np.long(0)
-    noTimer = len(_plots) == 0 or\
-        (plt.get_backend().lower() in (x.lower() for x in
-                                       mpl.rcsetup.non_interactive_bk))
+    runCardVals.converged = False
+    if runCardVals.persistentWorkers:
+        start_pool()
+    noTimer = len(figure_plots()) == 0 or not is_interactive()
     if noTimer:
         print("The job is running... ")
         while True:
@@ -133,25 +149,60 @@ def start_jobs():
             if res:
                 return
     else:
-        plot = _plots[0]
+        plot = figure_plots()[0]
         plot.areProcessAlreadyRunning = False
         plot.timer = plot.fig.canvas.new_timer()
         plot.timer.add_callback(plot.timer_callback)
         plot.timer.start()
 
 
+def figure_plots():
+    """Returns the plots that have matplotlib figures, i.e. all the plots
+    except the headless :class:`~xrt.plotter.XYCAccumulator` instances."""
+    return [plot for plot in _plots if not plot.headless]
+
+
+def is_interactive():
+    """Tells whether the matplotlib backend is interactive."""
+    return mpl.get_backend().lower() not in (
+        x.lower() for x in mpl.rcsetup.non_interactive_bk)
+
+
+def start_pool():
+    """Starts the pool of persistent workers or, if it already runs, sends the
+    (possibly modified by the generator) beamline and plot cards to it."""
+    global _pool
+    plots2Pickle = [plot.card_copy() for plot in _plots]
+    if _pool is None:
+        cpus = max(runCardVals.threads, runCardVals.processes)
+        _pool = multipro.WorkerPool(runCardVals, plots2Pickle, cpus)
+    else:
+        _pool.load(runCardVals, plots2Pickle)
+
+
+def close_pool():
+    """Stops the pool of persistent workers."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
 def dispatch_jobs():
     """Runs the jobs in separate processes or threads and collects the resulted
     histograms from the output queues. One cannot run this function in a loop
     because the redrawing will not work. Instead, it is started from a timer
     event handler of a qt-graph."""
     if (runCardVals.iteration >= runCardVals.repeats) or \
-            runCardVals.stop_event.is_set():
+            runCardVals.stop_event.is_set() or runCardVals.converged:
         on_finish()
         return True
     one_iteration()
+    if runCardVals.convergence:
+        runCardVals.converged = all(plot.is_converged(runCardVals.convergence)
+                                    for plot in _plots)
     if (runCardVals.iteration >= runCardVals.repeats) or \
-            runCardVals.stop_event.is_set():
+            runCardVals.stop_event.is_set() or runCardVals.converged:
         on_finish()
         return True
     if runCardVals.iteration % runCardVals.updateEvery == 0:
@@ -161,16 +212,129 @@ def dispatch_jobs():
         if runCardVals.iteration % runCardVals.pickleEvery == 0:
             for plot in _plots:
                 plot.store_plots()
-    if len(_plots) > 0:
-        _plots[0].areProcessAlreadyRunning = False
+    if len(figure_plots()) > 0:
+        figure_plots()[0].areProcessAlreadyRunning = False
+
+
+def add_histogram(total, outList, ind, iplot, returnSample=False):
+    """Adds the histogram *ind* of *outList* of the plot *iplot* to *total*,
+    taking it from the shared memory of the worker pool if needed. If
+    *returnSample* is True, the histogram itself is also returned."""
+    if returnSample:
+        sample = np.zeros_like(total)
+        add_histogram(sample, outList, ind, iplot)
+        total += sample
+        return sample
+    if _pool is not None:
+        _pool.add_histogram(total, outList, ind, iplot)
+    else:
+        total += outList[ind]
+
+
+def run_pilot(cpus):
+    """Runs a pilot with a reduced number of rays in *cpus* workers and fixes
+    the plot limits from the merged data ranges, see *pilotRays* in
+    :func:`run_ray_tracing`."""
+    runCardVals.beamLine.alarms = []
+    useProcesses = runCardVals.threads < runCardVals.processes
+    if _pool is not None and useProcesses:
+        saved = []  # the worker processes reduce their own beamline copies
+    else:
+        saved = multipro.reduce_source_rays(
+            runCardVals.beamLine, runCardVals.pilotRays)
+    try:
+        if _pool is not None:
+            outPlotQueues = _pool.outPlotQueues
+            alarmQueue = _pool.alarmQueue
+            processes = _pool.run_pilot(cpus, runCardVals.pilotRays)
+        else:
+            plots2Pickle = [plot.card_copy() for plot in _plots]
+            outPlotQueues = [runCardVals.Queue() for plot in _plots]
+            alarmQueue = runCardVals.Queue()
+            if useProcesses:
+                BackendOrProcess = multipro.BackendProcess
+            else:
+                BackendOrProcess = multipro.BackendThread
+            processes = [BackendOrProcess(runCardVals, plots2Pickle,
+                                          outPlotQueues, alarmQueue, icpu)
+                         for icpu in range(cpus)]
+            for p in processes:
+                p.pilot = True
+                p.start()
+
+        ranges = [[] for plot in _plots]
+        for p in processes:
+            for alarm in retry_on_eintr(alarmQueue.get):
+                print(alarm)
+            for iplot, aqueue in enumerate(outPlotQueues):
+                ranges[iplot].append(retry_on_eintr(aqueue.get))
+    finally:
+        multipro.restore_source_rays(saved)
+
+    for plot, plotRanges in zip(_plots, ranges):
+        xRange, yRange, cRange = [multipro.merge_data_ranges(r) for r in
+                                  zip(*plotRanges)]
+        plot.set_axes_limits(*multipro.update_plot_limits(
+            plot.card_copy(), xRange, yRange, cRange))
+    if _pool is not None:
+        _pool.load(plots=[plot.card_copy() for plot in _plots])
+    else:
+        for p in processes:
+            p.join(60.)
+
+
+def accumulate_output(plot, outList, iplot, first, convergence=False):
+    """Adds the histograms and the ray counters of one worker output
+    *outList* to the plot *iplot*. *first* is True for the 1st iteration,
+    where the bin edges and the automatic limits are taken over."""
+    plot.nRaysAll += outList[13]
+    if plot.backend == 'shadow':
+        plot.nRaysNeeded += outList[14]
+    elif plot.backend == 'raycing':
+        nRaysVarious = outList[14]
+        plot.nRaysAlive += nRaysVarious[0]
+        plot.nRaysGood += nRaysVarious[1]
+        plot.nRaysOut += nRaysVarious[2]
+        plot.nRaysOver += nRaysVarious[3]
+        plot.nRaysDead += nRaysVarious[4]
+        plot.nRaysAccepted += nRaysVarious[5]
+        plot.nRaysAcceptedE += nRaysVarious[6]
+        plot.nRaysSeeded += nRaysVarious[7]
+        plot.nRaysSeededI += nRaysVarious[8]
+        plot.displayAsAbsorbedPower = outList[15]
+
+    samples = [None, None, None]
+    for iaxis, axis in enumerate(
+            [plot.xaxis, plot.yaxis, plot.caxis]):
+        if (iaxis == 2) and (not plot.ePos):
+            continue
+        samples[iaxis] = add_histogram(
+            axis.total1D, outList, 0+iaxis*3, iplot, convergence)
+        add_histogram(axis.total1D_HM if plot.deferColor else
+                      axis.total1D_RGB, outList, 1+iaxis*3, iplot)
+        if first:
+            axis.binEdges = outList[2+iaxis*3]
+    samples.append(add_histogram(
+        plot.total2D, outList, 9, iplot, convergence))
+    if convergence:
+        plot.add_sample(*(samples + [outList[12]]))
+    add_histogram(plot.total2D_HM if plot.deferColor else
+                  plot.total2D_RGB, outList, 10, iplot)
+    is4d = (plot.fluxKind.lower().endswith('4d') or
+            plot.fluxKind.lower().endswith('pca'))
+    if is4d:
+        add_histogram(plot.total4D, outList, 11, iplot)
+    plot.intensity += outList[12]
+
+    if first:  # needed for multiprocessing
+        plot.set_axes_limits(*outList.pop())
 
 
 def one_iteration():
     """The body of :func:`dispatch_jobs`."""
     global needLimits
-    plots2Pickle = [plot.card_copy() for plot in _plots]
-    outPlotQueues = [runCardVals.Queue() for plot in _plots]
-    alarmQueue = runCardVals.Queue()
+    iteration0 = runCardVals.iteration
+    convergence = bool(runCardVals.convergence)
 
 # in the 1st iteration the plots may require some of x, y, e limits to be
 # calculated and thus this case is special:
@@ -186,6 +350,10 @@ def one_iteration():
             if not (xLimitsDefined and yLimitsDefined and cLimitsDefined):
                 needLimits = True
                 break
+        if needLimits and runCardVals.pilotRays and \
+                runCardVals.backend.startswith('raycing'):
+            run_pilot(cpus)
+            needLimits = False
         if needLimits:
             cpus = 1
     elif runCardVals.iteration == 1:  # balances the 1st one
@@ -197,16 +365,25 @@ def one_iteration():
     if runCardVals.backend.startswith('raycing'):
         runCardVals.beamLine.alarms = []
 
-    if runCardVals.threads >= runCardVals.processes:
-        BackendOrProcess = multipro.BackendThread
+    if _pool is not None:
+        outPlotQueues = _pool.outPlotQueues
+        alarmQueue = _pool.alarmQueue
+        processes = _pool.run_iteration(runCardVals.iteration, cpus)
     else:
-        BackendOrProcess = multipro.BackendProcess
-    processes = [BackendOrProcess(runCardVals, plots2Pickle, outPlotQueues,
-                                  alarmQueue, icpu) for icpu in range(cpus)]
-#    print('top process:', os.getpid())
-    for pid, p in enumerate(processes):
-        p.ppid = pid + runCardVals.iteration
-        p.start()
+        plots2Pickle = [plot.card_copy() for plot in _plots]
+        outPlotQueues = [runCardVals.Queue() for plot in _plots]
+        alarmQueue = runCardVals.Queue()
+        if runCardVals.threads >= runCardVals.processes:
+            BackendOrProcess = multipro.BackendThread
+        else:
+            BackendOrProcess = multipro.BackendProcess
+        processes = [BackendOrProcess(runCardVals, plots2Pickle,
+                                      outPlotQueues, alarmQueue, icpu)
+                     for icpu in range(cpus)]
+#        print('top process:', os.getpid())
+        for pid, p in enumerate(processes):
+            p.ppid = pid + runCardVals.iteration
+            p.start()
 
     for p in processes:
         if runCardVals.backend.startswith('raycing'):
@@ -214,72 +391,50 @@ def one_iteration():
             for alarm in runCardVals.beamLine.alarms:
                 print(alarm)
         outList = [0, ]
-        for plot, aqueue in zip(_plots, outPlotQueues):
+        for iplot, (plot, aqueue) in enumerate(zip(_plots, outPlotQueues)):
             outList = retry_on_eintr(aqueue.get)
 
             if len(outList) == 0:
                 continue
             if (runCardVals.iteration >= runCardVals.repeats) or \
                     runCardVals.stop_event.is_set():
+                if _pool is not None:
+                    _pool.discard_histograms(outList, iplot)
                 continue
-            plot.textStatus.set_text("{0} of {1} (right click to stop)".format(
-                runCardVals.iteration+1, runCardVals.repeats))
-
-            plot.nRaysAll += outList[13]
-            if runCardVals.backend.startswith('shadow'):
-                plot.nRaysNeeded += outList[14]
-            elif runCardVals.backend.startswith('raycing'):
-                nRaysVarious = outList[14]
-                plot.nRaysAlive += nRaysVarious[0]
-                plot.nRaysGood += nRaysVarious[1]
-                plot.nRaysOut += nRaysVarious[2]
-                plot.nRaysOver += nRaysVarious[3]
-                plot.nRaysDead += nRaysVarious[4]
-                plot.nRaysAccepted += nRaysVarious[5]
-                plot.nRaysAcceptedE += nRaysVarious[6]
-                plot.nRaysSeeded += nRaysVarious[7]
-                plot.nRaysSeededI += nRaysVarious[8]
-                plot.displayAsAbsorbedPower = outList[15]
-
-            for iaxis, axis in enumerate(
-                    [plot.xaxis, plot.yaxis, plot.caxis]):
-                if (iaxis == 2) and (not plot.ePos):
-                    continue
-                axis.total1D += outList[0+iaxis*3]
-                axis.total1D_RGB += outList[1+iaxis*3]
-                if runCardVals.iteration == 0:
-                    axis.binEdges = outList[2+iaxis*3]
-            plot.total2D += outList[9]
-            plot.total2D_RGB += outList[10]
-            is4d = (plot.fluxKind.lower().endswith('4d') or
-                    plot.fluxKind.lower().endswith('pca'))
-            if is4d:
-                plot.total4D += outList[11]
-            plot.intensity += outList[12]
-
-            if runCardVals.iteration == 0:  # needed for multiprocessing
-                plot.set_axes_limits(*outList.pop())
+            if not plot.headless:
+                plot.textStatus.set_text(
+                    "{0} of {1} (right click to stop)".format(
+                        runCardVals.iteration+1, runCardVals.repeats))
+
+            accumulate_output(plot, outList, iplot,
+                              runCardVals.iteration == 0, convergence)
 #            aqueue.task_done()
         if len(outList) > 0:
             runCardVals.iteration += 1
+    if _pool is not None:
+        if iteration0 == 0:  # the limits have been found, pass them over
+            _pool.load(plots=[plot.card_copy() for plot in _plots])
+        return
     for p in processes:
         p.join(60.)
 
 
 def on_finish():
     """Executed on exit from the ray-tracing iteration loop."""
-    if len(_plots) > 0:
-        plot = _plots[0]
-        if plt.get_backend().lower() not in (
-                x.lower() for x in mpl.rcsetup.non_interactive_bk):
+    if len(figure_plots()) > 0:
+        plot = figure_plots()[0]
+        if is_interactive():
             plot.timer.stop()
             plot.timer.remove_callback(plot.timer_callback)
         plot.areProcessAlreadyRunning = False
     for plot in _plots:
-        plot.textStatus.set_text('')
-        plot.fig.canvas.mpl_disconnect(plot.cidp)
+        if not plot.headless:
+            plot.textStatus.set_text('')
+            plot.fig.canvas.mpl_disconnect(plot.cidp)
         plot.plot_plots()
         plot.save()
+        if runCardVals.convergence:
+            plot.report_convergence(runCardVals.convergence)
     runCardVals.tstop = time.time()
     print('The ray tracing with {0} iteration{1} took {2:0.1f} s'.format(
           runCardVals.iteration, 's' if runCardVals.iteration > 1 else '',
@@ -289,6 +444,7 @@ def on_finish():
         if runCardVals.globalNorm or plot.persistentName:
             plot.store_plots()
     if runCardVals.stop_event.is_set():
+        close_pool()
         print('Interrupted by user after iteration {0}'.format(
               runCardVals.iteration))
         return
@@ -303,9 +459,17 @@ def on_finish():
     else:
         for plot in _plots:
             plot.clean_plots()
+        runCardVals.scanStep += 1
         start_jobs()
         return
 
+    finish_run()
+
+
+def finish_run():
+    """Normalizes the series of plots if requested and runs the
+    *afterScript*."""
+    close_pool()
     if runCardVals.globalNorm:
         aSavedResult = -1
         print('normalizing ...')
@@ -315,7 +479,8 @@ def on_finish():
                 saved = runCardVals.savedResults[aSavedResult]
                 plot.clean_plots()
                 saved.restore(plot)
-                plot.fig.canvas.set_window_title(plot.title)
+                if not plot.headless:
+                    plot.fig.canvas.set_window_title(plot.title)
                 for runCardVals.passNo in [1, 2]:
                     plot.plot_plots()
                     plot.save('_norm' + str(runCardVals.passNo))
@@ -327,6 +492,136 @@ def on_finish():
             *runCardProcs.afterScriptArgs, **runCardProcs.afterScriptKWargs)
 
 
+def run_scan_step(payload):
+    """Runs all the repeats of one generator scan step in a single process
+    and accumulates the histograms in :class:`~xrt.plotter.XYCAccumulator`
+    instances. *payload* is the pickled tuple of the worker card (with its own
+    beamline copy), the plot cards, the number of repeats and the step index.
+    The random streams of the step are selected by the scan step of the
+    worker card.
+    Returns the alarms of the 1st iteration and, per plot, a tuple of
+    :class:`~xrt.plotter.SaveResults`, the 4D histogram (or None) and the
+    *displayAsAbsorbedPower* flag."""
+    from . import plotter
+    locCard, plots2Pickle, repeats, istep = pickle.loads(payload)
+    accumulators = []
+    for card in plots2Pickle:
+        accumulator = plotter.XYCAccumulator(
+            beam=card.beam, rayFlag=card.rayFlag, xaxis=card.xaxis,
+            yaxis=card.yaxis, caxis=card.caxis, aspect=card.aspect,
+            ePos=card.ePos, title=card.title,
+            invertColorMap=card.invertColorMap, fluxKind=card.fluxKind,
+            beamState=card.beamState, beamC=card.beamC)
+        if accumulator.deferColor != card.deferColor:
+            accumulator.deferColor = card.deferColor
+            accumulator.reset_bins2D()
+        accumulators.append(accumulator)
+    outPlotQueues = [Queue.Queue() for card in plots2Pickle]
+    alarmQueue = Queue.Queue()
+    worker = multipro.GenericProcessOrThread(
+        locCard, plots2Pickle, outPlotQueues, alarmQueue, 0)
+    alarms = []
+    for iteration in range(repeats):
+        worker.iteration = iteration
+        worker.ppid = iteration
+        if locCard.backend.startswith('raycing'):
+            locCard.beamLine.alarms = []
+        worker.do_iteration()
+        stepAlarms = alarmQueue.get()
+        if iteration == 0:
+            alarms = stepAlarms
+        for iplot, (accumulator, aqueue) in enumerate(
+                zip(accumulators, outPlotQueues)):
+            outList = aqueue.get()
+            if len(outList) == 0:
+                continue
+            accumulate_output(accumulator, outList, iplot, iteration == 0)
+    return alarms, [(plotter.SaveResults(accumulator),
+                     getattr(accumulator, 'total4D', None),
+                     accumulator.displayAsAbsorbedPower)
+                    for accumulator in accumulators]
+
+
+def run_concurrent_scan():
+    """
+    Expands the generator into independent scan steps, runs them in a pool
+    of *concurrentSteps* processes, each step with its own beamline copy, and
+    collects the results into the plots in scan order. See *concurrentSteps*
+    in :func:`run_ray_tracing`. While the generator is expanded, the results
+    of the plots (see ``pendingResults``) are NaN, so that the code after
+    ``yield`` that reads them gets NaN and not zeros.
+    """
+    print('concurrent scan: the generator is run through all its steps '
+          'before the ray tracing; the plot results read in it after yield '
+          'are NaN')
+    steps = []
+    while True:
+        for plot in _plots:
+            if plot.persistentName:
+                plot.clean_plots()
+                plot.restore_plots()  # the restored limits go to the card
+        runCardVals.scanStep = len(steps)
+        payload = pickle.dumps(
+            (multipro.WorkerCard(runCardVals),
+             [plot.card_copy() for plot in _plots], runCardVals.repeats,
+             len(steps)), protocol=2)
+        steps.append((payload, [(plot.title, plot.saveName,
+                                 plot.persistentName) for plot in _plots]))
+        for plot in _plots:  # not traced yet
+            for name in pendingResults:
+                setattr(plot, name, np.nan)
+        try:
+            if sys.version_info < (3, 1):
+                runCardProcs.generatorPlot.next()
+            else:
+                next(runCardProcs.generatorPlot)
+        except StopIteration:
+            break
+
+    print('{0} scan step{1} in {2} processes'.format(
+        len(steps), 's' if len(steps) > 1 else '',
+        min(runCardVals.concurrentSteps, len(steps))))
+    pool = multiprocessing.Pool(min(runCardVals.concurrentSteps, len(steps)))
+    try:
+        stepResults = pool.imap(run_scan_step, [step[0] for step in steps])
+        for istep, ((payload, names), (alarms, results)) in enumerate(
+                zip(steps, stepResults)):
+            for alarm in alarms:
+                print(alarm)
+            for plot, (title, saveName, persistentName), \
+                    (saved, total4D, displayAsAbsorbedPower) in zip(
+                        _plots, names, results):
+                plot.title = title
+                plot.saveName = saveName
+                plot.persistentName = persistentName
+                plot.clean_plots()
+                for name in pendingResults:
+                    setattr(plot, name, 0)
+                if plot.persistentName:
+                    plot.restore_plots()
+                saved.restore(plot)
+                if total4D is not None:
+                    plot.total4D += total4D
+                plot.displayAsAbsorbedPower = displayAsAbsorbedPower
+                if not plot.headless:
+                    plot.fig.canvas.set_window_title(plot.title)
+                plot.plot_plots()
+                plot.save()
+                if runCardVals.globalNorm or plot.persistentName:
+                    plot.store_plots()
+            print('scan step {0} of {1} done'.format(istep+1, len(steps)))
+    finally:
+        pool.close()
+        pool.join()
+    runCardVals.iteration = runCardVals.repeats
+    runCardVals.tstop = time.time()
+    print('The ray tracing of {0} scan step{1} took {2:0.1f} s'.format(
+          len(steps), 's' if len(steps) > 1 else '',
+          runCardVals.tstop-runCardVals.tstart))
+    runCardVals.finished_event.set()
+    finish_run()
+
+
 def normalize_sibling_plots(plots):
     print('normalization started')
     max1Dx = 0
@@ -372,7 +667,9 @@ def run_ray_tracing(
     plots=[], repeats=1, updateEvery=1, pickleEvery=None, energyRange=None,
     backend='raycing', beamLine=None, threads=1, processes=1,
     generator=None, generatorArgs=[], generatorKWargs='auto', globalNorm=0,
-        afterScript=None, afterScriptArgs=[], afterScriptKWargs={}):
+    afterScript=None, afterScriptArgs=[], afterScriptKWargs={},
+        persistentWorkers=False, pilotRays=None, convergence=None,
+        concurrentSteps=1, randomSeed=None):
     u"""
     This function is the entry point of xrt.
     Parameters are all optional except the 1st one. Please use them as keyword
@@ -380,6 +677,9 @@ def run_ray_tracing(
 
         *plots*: instance of :class:`~xrt.plotter.XYCPlot` or a sequence of
             instances or an empty sequence if no graphical output is wanted.
+            For batch jobs without figures, use the headless
+            :class:`~xrt.plotter.XYCAccumulator` instead of
+            :class:`~xrt.plotter.XYCPlot`.
 
         *repeats*: int
             The number of ray tracing runs. It should be stressed that
@@ -493,6 +793,75 @@ def run_ray_tracing(
         *afterScriptArgs*, *afterScriptKWargs*: list and dictionary
             args and kwargs for *afterScript*.
 
+        *persistentWorkers*: bool
+            If True, the threads or processes are started only once and are
+            reused over all the repeats and all the generator steps. The
+            beamline is passed to the workers once per generator step instead
+            of once per repeat, which saves the process start-up and pickling
+            time for runs with many repeats. With *processes* the histograms
+            are accumulated in shared memory and only the ray counters are
+            passed through the queues. Every process has its own shared slab
+            per plot, so the shared memory grows as *processes* times the
+            size of all plot histograms: a 2D histogram of nx*ny bins takes
+            8*nx*ny*(1+3) bytes, or 8*nx*ny*(1+12) bytes with *deferColor*,
+            e.g. 27 MB for 512x512 bins, i.e. 0.27 GB for 10 processes; a 4D
+            flux takes 8*(nx*ny)**2 bytes more. Reduce the bins or the
+            processes if this is too much.
+
+        *pilotRays*: int or None
+            If some plot limits are to be found automatically, the 1st
+            iteration is normally run by one thread or process only. If
+            *pilotRays* is given, a short pilot run with the sources reduced to
+            *pilotRays* rays (the mesh sources are not changed) is done by all
+            the threads or processes, the data ranges are merged and the limits
+            are fixed before the 1st iteration, which is then run in parallel.
+            Only for raycing backend. Note that the limits found from a smaller
+            sample can be narrower.
+
+        *convergence*: dict or None
+            If given, e.g. as {'flux': 1e-3, 'dx': 1e-2}, the ray tracing
+            stops as soon as the relative errors of all the given figures of
+            merit of all the plots are within the given tolerances, but not
+            before :data:`~xrt.plotter.minConvergenceRepeats` iterations and
+            not after *repeats* iterations. The metrics are 'flux', 'cx', 'dx',
+            'cy', 'dy', 'cE', 'dE' (centers and FWHMs) and 'bins' (the max
+            relative error of the 2D histogram bins), see
+            :meth:`~xrt.plotter.XYCPlot.get_convergence_errors`. The errors
+            are estimated from the scatter of the individual iterations (one
+            per thread or process). Other metrics raise ValueError. A FWHM of
+            up to two bins has no error estimate and counts as not converged,
+            so the run goes on to *repeats* iterations; make the bins finer
+            for it. The achieved errors are printed at the end, together with
+            the unresolved metrics, and are stored in the plots as
+            *convergenceErrors*.
+
+        *concurrentSteps*: int
+            If > 1 and a *generator* is given, the generator is first run
+            through all its steps, the beamline and the plot cards are copied
+            at every ``yield`` and the scan steps are then ray traced
+            concurrently by *concurrentSteps* processes, each step with its own
+            beamline copy and all its *repeats* in one process (*threads* and
+            *processes* are not used then). The results are collected into the
+            plots, plotted and saved in scan order. This is only valid if the
+            scan steps are independent: the generator must not read the
+            results of a step after its ``yield``, as they do not exist yet;
+            they are set to NaN then (*intensity*, *flux*, *power* and the
+            centers and FWHMs), so that the lists collected by the generator
+            for *afterScript* show NaN and not zeros. Read the results from
+            the saved files instead. The automatic plot limits are found for
+            each step separately. Only for raycing backend.
+
+        *randomSeed*: int or None
+            The seed of the whole run. Every worker draws its rays from an
+            independent stream of ``numpy.random.Generator`` selected by the
+            scan step, the iteration and the worker index, see
+            :func:`~xrt.backends.raycing.seed_rng`. With the same seed and the
+            same *threads* or *processes*, the run is repeated with the same
+            rays; the summed histograms may differ only by the rounding due to
+            the order in which the workers return. If None, the seed is taken
+            from fresh entropy and is kept in
+            ``xrt.runner.runCardVals.randomSeed``. Only for raycing backend.
+
 
     """
     global runCardVals, runCardProcs, _plots
@@ -506,6 +875,14 @@ def run_ray_tracing(
                 plot.caxis.limits = [raycing.hueMin, raycing.hueMax]
             if isinstance(plot.rayFlag, int):
                 plot.rayFlag = plot.rayFlag,
+    if convergence:
+        from . import plotter
+        unknown = [m for m in convergence if m not in
+                   plotter.convergenceMetrics]
+        if unknown:
+            raise ValueError('unknown convergence metrics {0}; the metrics '
+                             'are {1}'.format(unknown,
+                                              plotter.convergenceMetrics))
     if updateEvery < 1:
         updateEvery = 1
     if (repeats > 1) and (updateEvery > repeats):
@@ -522,7 +899,9 @@ def run_ray_tracing(
         else:
             threads = max(cpuCount // 2, 1)
     runCardVals = RunCardVals(threads, processes, repeats, updateEvery,
-                              pickleEvery, backend, globalNorm)
+                              pickleEvery, backend, globalNorm,
+                              persistentWorkers, pilotRays, convergence,
+                              concurrentSteps, randomSeed)
     runCardProcs = RunCardProcs(
         afterScript, afterScriptArgs, afterScriptKWargs)
 
@@ -535,6 +914,7 @@ def run_ray_tracing(
             shadow.init_shadow(cpus, runCardVals.cwd, energyRange)
     elif backend == 'raycing':
         runCardVals.beamLine = beamLine
+        runCardVals.randomSeed = raycing.seed_rng(randomSeed)
 
     if generator is None:
         runCardProcs.generatorPlot = _simple_generator()
@@ -560,5 +940,11 @@ def run_ray_tracing(
             next(runCardProcs.generatorPlot)
 
     runCardVals.tstart = time.time()
-    start_jobs()
-    plt.show()
+    if concurrentSteps > 1 and generator is not None and \
+            backend == 'raycing':
+        run_concurrent_scan()
+    else:
+        start_jobs()
+    if len(figure_plots()) > 0:
+        import matplotlib.pyplot as plt
+        plt.show()